@@ -1,30 +1,187 @@
 #!/usr/bin/env python3
 
-import random, time, os
-from datetime import datetime
+import random, time, os, hashlib, json
+from datetime import datetime, timezone
 
-os.system('envsubst < cli.ini.template > /etc/letsencrypt/cli.ini')
+from cryptography import x509
 
-print('certbot renew loop start', datetime.now())
+import runner
 
-time.sleep(random.randint(1, 7))  # не сразу после запуска контейнера стучаться на letsencrypt
+# метрики в формате Prometheus для node_exporter textfile collector, пишутся если папка примонтирована
+METRICS_DIR = os.environ.get('METRICS_DIR', '/metrics')
+DOMAIN = os.environ.get('VPS_DOMAIN', '')
+CERT_PATH = f'/etc/letsencrypt/live/{DOMAIN}/fullchain.pem'
+
+CLI_INI = '/etc/letsencrypt/cli.ini'
+STATE_PATH = '/etc/letsencrypt/renew_loop.json'  # хэш cli.ini, с которым последний раз успешно отработал certonly
 
 seconds_in_hour = 60 * 60
+seconds_in_day = 24 * seconds_in_hour
+
+RENEW_BEFORE = 30 * seconds_in_day   # как у certbot по умолчанию: обновлять за 30 дней до окончания,
+                                     # но не раньше последней трети срока для короткоживущих сертификатов
+MAX_SLEEP = 12 * seconds_in_hour     # просыпаться хотя бы так часто - перечитать сертификат, обновить метрики
+JITTER = 6 * seconds_in_hour         # чтобы все узлы не шли на letsencrypt в одно время
+
+last_runs = {}  # certonly/renew -> (время запуска, длительность, код выхода, исход)
+failures = {}   # certonly/renew -> сколько раз подряд не удалось
+
+
+def cert_validity():
+  """(notBefore, notAfter) сертификата в unix time или None, если его нет"""
+  try:
+    with open(CERT_PATH, 'rb') as f:
+      cert = x509.load_pem_x509_certificate(f.read())
+  except (OSError, ValueError):
+    return None
+  not_before = getattr(cert, 'not_valid_before_utc', None) or cert.not_valid_before.replace(tzinfo=timezone.utc)
+  not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after.replace(tzinfo=timezone.utc)
+  return not_before.timestamp(), not_after.timestamp()
+
+
+def cert_expiry():
+  validity = cert_validity()
+  return validity[1] if validity else None
+
+
+def renew_at(validity):
+  """Когда сертификат пора обновлять"""
+  not_before, not_after = validity
+  return not_after - min(RENEW_BEFORE, (not_after - not_before) / 3)
+
+
+def config_hash():
+  """cli.ini включает домен, email и сервер - если что-то поменялось, нужен certonly"""
+  with open(CLI_INI, 'rb') as f:
+    return hashlib.sha256(f.read()).hexdigest()
+
+
+def read_state():
+  try:
+    with open(STATE_PATH) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return {}
+
+
+def save_state(state):
+  with open(STATE_PATH + '.tmp', 'w') as f:
+    json.dump(state, f)
+  os.replace(STATE_PATH + '.tmp', STATE_PATH)
+
+
+def write_metrics():
+  if not os.path.isdir(METRICS_DIR):
+    return
+  lines = []
+  expiry = cert_expiry()
+  if expiry is not None:
+    lines += ['# HELP certbot_certificate_expiry_timestamp_seconds Certificate notAfter time',
+              '# TYPE certbot_certificate_expiry_timestamp_seconds gauge',
+              f'certbot_certificate_expiry_timestamp_seconds{{domain="{DOMAIN}"}} {expiry}',
+              '# HELP certbot_certificate_days_to_expiry Days left when metrics were written',
+              '# TYPE certbot_certificate_days_to_expiry gauge',
+              f'certbot_certificate_days_to_expiry{{domain="{DOMAIN}"}} {(expiry - time.time()) / 86400:.2f}']
+  run_gauges = (('certbot_last_run_timestamp_seconds', 'Start time of the last certbot run'),
+                ('certbot_last_run_duration_seconds', 'Duration of the last certbot run'),
+                ('certbot_last_run_exit_code', 'Exit code of the last certbot run'))
+  for index, (name, help_text) in enumerate(run_gauges if last_runs else ()):
+    lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+    lines += [f'{name}{{command="{command}"}} {run[index]}' for command, run in sorted(last_runs.items())]
+  if last_runs:
+    lines += ['# HELP certbot_last_run_outcome Outcome of the last certbot run (1 for the current one)',
+              '# TYPE certbot_last_run_outcome gauge']
+    lines += [f'certbot_last_run_outcome{{command="{command}",outcome="{run[3]}"}} 1'
+              for command, run in sorted(last_runs.items())]
+
+  path = os.path.join(METRICS_DIR, 'certbot.prom')
+  try:
+    with open(path + '.tmp', 'w') as f:
+      f.write(''.join(line + '\n' for line in lines))
+    os.replace(path + '.tmp', path)  # collector не должен увидеть недописанный файл
+  except OSError as e:
+    print('ERROR writing metrics:', e)
+
+
+def certbot(command):
+  """Запустить certbot, запомнить результат для метрик, вернуть (исход, вывод certbot)"""
+  start = time.time()
+  outcome, output = runner.run_certbot([command], cert_validity)
+  failed = outcome not in (runner.RENEWED, runner.NOT_DUE)
+  last_runs[command] = (int(start), round(time.time() - start, 1), int(failed), outcome)
+  write_metrics()
+  if failed:
+    print('ERROR certbot', command, outcome)
+  return outcome, output
+
+
+def retry(command, outcome, output):
+  """Через сколько секунд повторить неудавшийся certbot; подряд идущие неудачи считаются в failures"""
+  failures[command] = failures.get(command, 0) + 1
+  delay = runner.retry_delay(outcome, failures[command], output)
+  print('Wait', int(delay) // 60, 'minutes before retry of certbot', command)
+  return delay
+
+
+def need_certonly(validity):
+  """Сертификата нет или cli.ini поменялся с последнего успешного certonly"""
+  return validity is None or read_state().get('config_hash') != config_hash()
+
 
 # создать/обновить сертификат
-# если не удалось - ждать несколько часов и пробовать снова, не выходя из скрипта, 
+# если не удалось - ждать несколько часов и пробовать снова, не выходя из скрипта,
 # чтобы контейнер не перезапускался часто и не долбил letsencrypt, иначе забанят.
 # если такое случится, они пришлют письмо на email, указанный при создании сертификата с инструкцией как разблокировать
-while os.system('certbot certonly'):
-  some_hours = (1 + random.randint(0, 4)) * seconds_in_hour
-  print('ERROR certbot certonly. Wait', some_hours // 60, 'minutes before retry')
-  time.sleep(some_hours)
-  print(datetime.now())
-  
-
-# раз в пару дней проверять обновление
-while True:
-  day_or_two = (24 + random.randint(0, 24)) * seconds_in_hour
-  time.sleep(day_or_two)
-  print(datetime.now())
-  os.system('certbot renew')
+# certbot запускается, только если сертификата нет, поменялся cli.ini (домен) или подошёл срок обновления,
+# остальное время скрипт спит до окна обновления
+# пауза после неудачи зависит от причины: не прошла проверка домена - минуты, rate limit letsencrypt - сутки
+def step(next_renew):
+  """Один проход цикла. next_renew - время следующей попытки renew с jitter или None, если его надо посчитать.
+  Вернуть (новое next_renew, сколько секунд спать перед следующим проходом)"""
+  validity = cert_validity()
+  if need_certonly(validity):
+    print('No certificate or cli.ini changed, certbot certonly', datetime.now())
+    outcome, output = certbot('certonly')
+    if outcome not in (runner.RENEWED, runner.NOT_DUE):
+      return next_renew, retry('certonly', outcome, output)
+    failures.pop('certonly', None)
+    save_state({'config_hash': config_hash()})
+    if cert_validity() is None:
+      print('ERROR no certificate at', CERT_PATH, 'after certbot certonly. Wait', MAX_SLEEP // 60, 'minutes')
+      return None, MAX_SLEEP
+    return None, 0
+
+  if next_renew is None:
+    next_renew = renew_at(validity) + random.randint(0, JITTER)
+    print('Certificate valid until', datetime.fromtimestamp(validity[1]),
+          'renewal after', datetime.fromtimestamp(next_renew))
+
+  if time.time() >= next_renew:
+    print('Renewal is due, certbot renew', datetime.now())
+    outcome, output = certbot('renew')
+    if outcome == runner.RENEWED:
+      failures.pop('renew', None)
+      return None, 0
+    if outcome == runner.NOT_DUE:
+      # certbot посчитал, что ещё рано (другой renew_before_expiry в renewal/*.conf) - не долбить каждый цикл
+      failures.pop('renew', None)
+      return time.time() + seconds_in_day, 0
+    return time.time() + retry('renew', outcome, output), 0
+
+  write_metrics()  # days_to_expiry
+  return next_renew, max(1, min(MAX_SLEEP, next_renew - time.time()))
+
+
+def main():
+  runner.render_template('cli.ini.template', CLI_INI)
+  print('certbot renew loop start', datetime.now())
+  time.sleep(random.randint(1, 7))  # не сразу после запуска контейнера стучаться на letsencrypt
+  next_renew = None
+  while True:
+    next_renew, delay = step(next_renew)
+    if delay:
+      time.sleep(delay)
+
+
+if __name__ == '__main__':
+  main()
@@ -1,18 +1,183 @@
 #!/usr/bin/env python3
 
+import glob, os, shlex, socket, ssl, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
 import docker
 
+# значение метки certbot_restart выбирает, как контейнер подхватит новый сертификат:
+#   certbot_restart                  - полный рестарт (как раньше)
+#   certbot_restart=signal:HUP       - послать сигнал, nginx по HUP перечитывает конфиг и сертификаты без разрыва соединений
+#   certbot_restart=exec:nginx -s reload  - выполнить команду внутри контейнера
+# если сигнал или команда не сработали - полный рестарт
+LABEL = 'certbot_restart'
+# как понять, что контейнер снова работает (кроме docker healthcheck, который учитывается всегда):
+#   certbot_restart.probe=tcp:host:port  - порт принимает соединения
+#   certbot_restart.probe=tls:host:port  - TLS handshake проходит и отдаётся новый сертификат
+PROBE_LABEL = 'certbot_restart.probe'
+# зависимости из compose (depends_on) - такой контейнер перезапускается после готовности тех, от кого зависит
+DEPENDS_LABEL = 'com.docker.compose.depends_on'
+SERVICE_LABEL = 'com.docker.compose.service'
+
+READY_TIMEOUT = int(os.environ.get('CERTBOT_RESTART_TIMEOUT', 120))  # сколько ждать готовности контейнера
+PROBE_INTERVAL = 1
+DOMAIN = os.environ.get('VPS_DOMAIN', '')
+
+
+def first_certificate():
+  """Сертификат выпущен впервые (в archive только cert1.pem) - контейнеры могли стартовать без него,
+  например nginx выключает ssl server при старте без сертификата, reload тут не поможет"""
+  lineage = os.environ.get('RENEWED_LINEAGE')  # certbot передаёт deploy-hook путь live/<домен>
+  if not lineage:
+    return False
+  archive = os.path.join(os.path.dirname(os.path.dirname(lineage)), 'archive', os.path.basename(lineage))
+  return len(glob.glob(os.path.join(archive, 'cert*.pem'))) <= 1
+
+
+def new_certificate():
+  """DER нового сертификата, чтобы TLS проба убедилась, что отдаётся именно он"""
+  lineage = os.environ.get('RENEWED_LINEAGE')
+  try:
+    with open(os.path.join(lineage, 'cert.pem')) as f:
+      return ssl.PEM_cert_to_DER_cert(f.read())
+  except (TypeError, OSError, ValueError):
+    return None
+
+
+def parse_strategy(value):
+  """'signal:HUP' -> ('signal', 'HUP'), '' -> ('restart', '')"""
+  kind, _, arg = (value or 'restart').partition(':')
+  kind, arg = kind.strip().lower(), arg.strip()
+  if kind == 'signal':
+    return kind, arg or 'HUP'
+  if kind == 'exec' and arg:
+    return kind, arg
+  if kind != 'restart':
+    print(f'Unknown {LABEL} value "{value}", fallback to restart')
+  return 'restart', ''
+
+
+def reload_container(c, kind, arg):
+  """Применить стратегию к контейнеру, вернуть имя того, что в итоге сделано"""
+  try:
+    if kind == 'signal':
+      print(f'Send {arg} to container {c.name}')
+      c.kill(signal=arg)
+      return f'signal {arg}'
+    if kind == 'exec':
+      print(f'Exec "{arg}" in container {c.name}')
+      code, output = c.exec_run(shlex.split(arg))
+      if code == 0:
+        return 'exec'
+      print(f'ERROR exec in {c.name} exit code {code}: {output.decode(errors="replace").strip()}')
+  except docker.errors.APIError as e:
+    print(f'ERROR {kind} {c.name}: {e}')
+  print(f'Restart container {c.name}')
+  c.restart()
+  return 'restart'
+
+
+def probe(spec, cert):
+  """Одна попытка пробы 'tcp:host:port' / 'tls:host:port', вернуть текст ошибки или None"""
+  kind, _, address = spec.partition(':')
+  host, _, port = address.rpartition(':')
+  try:
+    with socket.create_connection((host, int(port)), timeout=5) as sock:
+      if kind != 'tls':
+        return None
+      context = ssl.create_default_context()
+      context.check_hostname = False
+      context.verify_mode = ssl.CERT_NONE  # проверяем совпадение с новым сертификатом, а не цепочку
+      with context.wrap_socket(sock, server_hostname=DOMAIN or host) as tls:
+        served = tls.getpeercert(binary_form=True)
+    if cert and served != cert:
+      return 'old certificate is served'
+  except (OSError, ValueError) as e:
+    return str(e) or type(e).__name__
+  return None
+
+
+def container_ready(c, cert):
+  """None, если контейнер работает (и здоров по healthcheck и пробе), иначе причина"""
+  c.reload()
+  state = c.attrs.get('State', {})
+  if state.get('Status') != 'running':
+    return f'status {state.get("Status")}'
+  health = state.get('Health', {}).get('Status')
+  if health not in (None, 'healthy'):
+    return f'health {health}'
+  spec = c.labels.get(PROBE_LABEL)
+  return probe(spec, cert) if spec else None
+
+
+def wait_ready(c, cert, deadline):
+  reason = container_ready(c, cert)
+  while reason and time.monotonic() < deadline:
+    time.sleep(PROBE_INTERVAL)
+    reason = container_ready(c, cert)
+  return reason
+
+
+def dependencies(c, services):
+  """Сервисы из того же набора, от которых контейнер зависит в compose"""
+  value = c.labels.get(DEPENDS_LABEL, '')  # "nginx:service_started:false,db:service_healthy:false"
+  names = {item.split(':')[0] for item in value.split(',') if item}
+  return [services[name] for name in names if name in services and services[name] is not c]
+
+
 def restart_certbot_containers():
-  print('Restarting containers with "certbot_restart" label')
+  print(f'Reloading containers with "{LABEL}" label')
   client = docker.from_env()
-  n = 0
-  for c in client.containers.list():
-    if 'certbot_restart' in c.labels:
-      print(f'Restart container {c.name}')
-      c.restart()
-      n += 1
-  
-  if n == 0:
+  force_restart = first_certificate()
+  if force_restart:
+    print('First certificate for this domain, restart containers instead of reload')
+  cert = new_certificate()
+  containers = client.containers.list(filters={'label': LABEL})  # фильтр на стороне docker, не весь список
+  if not containers:
     print(f'No containers has been restarted. Is it OK?')
+    return True
+
+  services = {c.labels.get(SERVICE_LABEL): c for c in containers if c.labels.get(SERVICE_LABEL)}
+  futures = {}
+  submitted = threading.Event()
+
+  def handle(c):
+    """Дождаться зависимостей, применить стратегию, дождаться готовности; вернуть (действие, простой, ошибка)"""
+    submitted.wait()
+    for dependency in dependencies(c, services):
+      futures[dependency.id].result()
+    kind, arg = ('restart', '') if force_restart else parse_strategy(c.labels.get(LABEL))
+    start = time.monotonic()
+    try:
+      action = reload_container(c, kind, arg)
+      reason = wait_ready(c, cert, start + READY_TIMEOUT)
+    except docker.errors.APIError as e:
+      action, reason = kind, str(e)
+    return action, time.monotonic() - start, reason
+
+  # независимые контейнеры - параллельно, общий простой = самый долгий, а не сумма;
+  # потоков по числу контейнеров, чтобы ожидание зависимостей не заняло все потоки
+  with ThreadPoolExecutor(max_workers=len(containers)) as pool:
+    for c in containers:
+      futures[c.id] = pool.submit(handle, c)
+    submitted.set()
+
+  ok = True
+  for c in containers:
+    try:
+      action, seconds, reason = futures[c.id].result()
+    except Exception as e:
+      action, seconds, reason = 'reload', 0, f'{type(e).__name__}: {e}'
+    if reason:
+      ok = False
+      print(f'ERROR {c.name}: {action}, not ready after {seconds:.1f}s: {reason}')
+    elif action == 'restart':
+      print(f'{c.name}: restart, downtime {seconds:.1f}s')
+    else:
+      print(f'{c.name}: {action}, no downtime, ready after {seconds:.1f}s')
+  return ok
+
 
-restart_certbot_containers()
+if __name__ == '__main__':
+  # ненулевой код - certbot покажет ошибку deploy-hook в логе
+  sys.exit(0 if restart_certbot_containers() else 1)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# запуск certbot из main.py с разбором результата вместо одного кода выхода.
+# certbot запускается отдельным процессом: блокировки /etc/letsencrypt и /var/lib/letsencrypt
+# он снимает только при выходе (atexit), внутри вечного main.py они остались бы навсегда
+# и ручной `docker compose exec certbot certbot ...` падал бы с "Another instance of Certbot is already running"
+
+import os, random, re, subprocess, sys
+from datetime import datetime, timezone
+
+RENEWED = 'renewed'                    # получен новый сертификат
+NOT_DUE = 'not_due'                    # certbot отработал, сертификат не поменялся
+RATE_LIMITED = 'rate_limited'          # letsencrypt ответил rateLimited
+CHALLENGE_FAILED = 'challenge_failed'  # не прошла проверка домена (nginx не отдал .well-known, DNS и т.п.)
+ERROR = 'error'                        # всё остальное
+
+seconds_in_hour = 60 * 60
+
+# признаки в выводе certbot: он печатает ответ ACME ("Type: unauthorized", "urn:...:rateLimited", "retry after ...")
+RATE_LIMIT_RE = re.compile(r'rateLimited|too many (certificates|failed authorizations|requests|new orders)', re.I)
+CHALLENGE_RE = re.compile(r'Some challenges have failed|Challenge failed|failed to authenticate some domains|'
+                          r'\bunauthorized\b|acme:error:(connection|dns|incorrectResponse)', re.I)
+VAR_RE = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)')  # имена как у envsubst, $1 не трогается
+RETRY_AFTER_RE = re.compile(r'retry after (\d{4}-\d\d-\d\d[ T]\d\d:\d\d:\d\d)', re.I)
+
+
+def render_template(template_path, output_path, env=os.environ):
+  """Как envsubst: $VAR и ${VAR} заменяются значениями из окружения, неизвестные - пустой строкой"""
+  with open(template_path) as f:
+    text = f.read()
+  text = VAR_RE.sub(lambda m: env.get(m.group(1) or m.group(2), ''), text)
+  with open(output_path + '.tmp', 'w') as f:
+    f.write(text)
+  os.replace(output_path + '.tmp', output_path)
+
+
+def classify(text):
+  """Класс неудачи по выводу certbot"""
+  if RATE_LIMIT_RE.search(text):
+    return RATE_LIMITED
+  if CHALLENGE_RE.search(text):
+    return CHALLENGE_FAILED
+  return ERROR
+
+
+def run_certbot(args, cert_fingerprint):
+  """Запустить certbot с аргументами `args`, вывод идёт в лог контейнера как раньше.
+  `cert_fingerprint()` - что-то, меняющееся при выпуске нового сертификата (например, срок действия).
+  Вернуть (исход, весь вывод certbot) - в выводе причина ошибки и "retry after" от letsencrypt."""
+  before = cert_fingerprint()
+  lines = []
+  try:
+    with subprocess.Popen(['certbot', *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          text=True, errors='replace') as process:
+      for line in process.stdout:
+        sys.stdout.write(line)
+        lines.append(line)
+  except OSError as e:
+    return ERROR, f'{type(e).__name__}: {e}'
+  output = ''.join(lines)
+  if process.returncode:
+    return classify(output), output
+  return (RENEWED if cert_fingerprint() != before else NOT_DUE), output
+
+
+def retry_after(text, now=None):
+  """Время из "retry after 2025-01-01 00:00:00 UTC" в ответе letsencrypt или None"""
+  m = RETRY_AFTER_RE.search(text)
+  if not m:
+    return None
+  when = datetime.fromisoformat(m.group(1).replace(' ', 'T')).replace(tzinfo=timezone.utc).timestamp()
+  return max(0, when - (datetime.now(timezone.utc).timestamp() if now is None else now))
+
+
+def retry_delay(outcome, failures, output=''):
+  """Пауза перед повтором в секундах по классу ошибки; failures - сколько раз подряд уже не удалось,
+  output - вывод certbot, из него берётся "retry after" при rate limit"""
+  if outcome == CHALLENGE_FAILED:
+    # обычно временное (nginx ещё не поднялся) - повторить через минуты, с каждым разом дольше, до 5 часов
+    return min(5 * seconds_in_hour, 10 * 60 * 2 ** (failures - 1)) + random.randint(0, 5 * 60)
+  if outcome == RATE_LIMITED:
+    # лимиты letsencrypt считаются за часы и дни, частые попытки только продлевают бан
+    delay = retry_after(output)
+    return (delay if delay is not None else 24 * seconds_in_hour) + random.randint(0, seconds_in_hour)
+  return (1 + random.randint(0, 4)) * seconds_in_hour
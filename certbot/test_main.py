@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+
+import os, sys, time
+from unittest.mock import patch
+
+import pytest
+
+pytest.importorskip('cryptography')  # есть в образе certbot
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main, runner
+
+DAY = main.seconds_in_day
+
+
+@pytest.fixture(autouse=True)
+def paths(tmp_path, monkeypatch):
+  """cli.ini, состояние и метрики внутри tmp_path, счётчики неудач с нуля"""
+  (tmp_path / 'cli.ini').write_text('domain = example.com\n')
+  monkeypatch.setattr(main, 'CLI_INI', str(tmp_path / 'cli.ini'))
+  monkeypatch.setattr(main, 'STATE_PATH', str(tmp_path / 'renew_loop.json'))
+  monkeypatch.setattr(main, 'METRICS_DIR', str(tmp_path / 'metrics'))
+  monkeypatch.setattr(main, 'failures', {})
+  monkeypatch.setattr(main, 'last_runs', {})
+  return tmp_path
+
+
+def valid_for(days, since=0):
+  """(notBefore, notAfter) сертификата, выпущенного `since` дней назад"""
+  not_before = time.time() - since * DAY
+  return not_before, not_before + days * DAY
+
+
+class TestRenewAt:
+
+  def test_90_days(self):
+    not_before, not_after = valid_for(90)
+    assert main.renew_at((not_before, not_after)) == not_after - 30 * DAY
+
+  def test_short_lived(self):
+    not_before, not_after = valid_for(6)
+    assert main.renew_at((not_before, not_after)) == pytest.approx(not_after - 2 * DAY)
+
+
+class TestStep:
+
+  def test_missing_certificate_runs_certonly(self):
+    with patch('main.cert_validity', side_effect=[None, valid_for(90)]), \
+        patch('main.certbot', return_value=(runner.RENEWED, '')) as mock_certbot:
+      assert main.step(None) == (None, 0)
+    mock_certbot.assert_called_once_with('certonly')
+    assert main.read_state() == {'config_hash': main.config_hash()}
+
+  def test_changed_cli_ini_runs_certonly(self, paths):
+    main.save_state({'config_hash': main.config_hash()})
+    (paths / 'cli.ini').write_text('domain = example.org\n')
+    with patch('main.cert_validity', return_value=valid_for(90)), \
+        patch('main.certbot', return_value=(runner.NOT_DUE, '')) as mock_certbot:
+      main.step(None)
+      mock_certbot.assert_called_once_with('certonly')
+
+      # тот же cli.ini - certonly больше не нужен, до окна обновления только сон
+      mock_certbot.reset_mock()
+      next_renew, delay = main.step(None)
+    mock_certbot.assert_not_called()
+    assert delay == main.MAX_SLEEP
+    assert next_renew > time.time() + 50 * DAY
+
+  def test_failed_certonly_waits_for_retry(self):
+    with patch('main.cert_validity', return_value=None), \
+        patch('main.certbot', return_value=(runner.CHALLENGE_FAILED, '')), \
+        patch('runner.random.randint', return_value=0):
+      assert main.step(None) == (None, 600)
+      assert main.step(None) == (None, 1200)
+    assert main.read_state() == {}
+
+  def test_not_due_renew_waits_a_day(self):
+    main.save_state({'config_hash': main.config_hash()})
+    with patch('main.cert_validity', return_value=valid_for(90, since=70)), \
+        patch('main.certbot', return_value=(runner.NOT_DUE, '')) as mock_certbot:
+      next_renew, delay = main.step(time.time() - 1)
+    mock_certbot.assert_called_once_with('renew')
+    assert next_renew == pytest.approx(time.time() + DAY, abs=5)
+    assert delay == 0
+
+  def test_failed_renew_is_retried(self):
+    main.save_state({'config_hash': main.config_hash()})
+    with patch('main.cert_validity', return_value=valid_for(90, since=70)), \
+        patch('main.certbot', return_value=(runner.ERROR, '')), \
+        patch('runner.random.randint', return_value=1):
+      next_renew, delay = main.step(time.time() - 1)
+    assert next_renew == pytest.approx(time.time() + 2 * main.seconds_in_hour, abs=5)
+    assert main.failures == {'renew': 1}
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+import os, runpy, shutil, socket, ssl, subprocess, sys, threading
+from unittest.mock import Mock, patch
+
+import docker
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import restart_certbot_containers as rcc
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'restart_certbot_containers.py')
+
+
+def make_container(name, labels=None, status='running', health=None, events=None):
+  """Mock контейнера compose-сервиса `name`; действия над ним пишутся в `events`"""
+  state = {'Status': status}
+  if health:
+    state['Health'] = {'Status': health}
+  container = Mock(id=f'{name}-id', attrs={'State': state},
+                   labels={rcc.SERVICE_LABEL: name, rcc.LABEL: '', **(labels or {})})
+  container.name = name
+  container.exec_run.return_value = (0, b'')
+  if events is not None:
+    container.kill.side_effect = lambda signal: events.append((name, f'signal {signal}'))
+    container.restart.side_effect = lambda: events.append((name, 'restart'))
+    container.reload.side_effect = lambda: events.append((name, 'reload'))
+  return container
+
+
+@pytest.fixture(autouse=True)
+def environment(monkeypatch):
+  """Без RENEWED_LINEAGE и с короткими ожиданиями"""
+  monkeypatch.delenv('RENEWED_LINEAGE', raising=False)
+  monkeypatch.setattr(rcc, 'READY_TIMEOUT', 0.2)
+  monkeypatch.setattr(rcc, 'PROBE_INTERVAL', 0.01)
+
+
+@pytest.fixture
+def docker_client():
+  client = Mock()
+  with patch('docker.from_env', return_value=client):
+    yield client
+
+
+@pytest.fixture
+def lineage(tmp_path, monkeypatch):
+  """letsencrypt/live/example.com с archive, как его передаёт certbot в deploy-hook"""
+  live = tmp_path / 'live' / 'example.com'
+  archive = tmp_path / 'archive' / 'example.com'
+  live.mkdir(parents=True)
+  archive.mkdir(parents=True)
+  monkeypatch.setenv('RENEWED_LINEAGE', str(live))
+  return live, archive
+
+
+class TestParseStrategy:
+
+  @pytest.mark.parametrize('value, strategy', [
+    ('', ('restart', '')),
+    (None, ('restart', '')),
+    ('restart', ('restart', '')),
+    ('signal:HUP', ('signal', 'HUP')),
+    ('Signal: USR1 ', ('signal', 'USR1')),
+    ('signal', ('signal', 'HUP')),
+    ('exec:nginx -s reload', ('exec', 'nginx -s reload')),
+    ('exec:', ('restart', '')),
+    ('reboot', ('restart', '')),
+  ])
+  def test_parse_strategy(self, value, strategy):
+    assert rcc.parse_strategy(value) == strategy
+
+
+class TestReloadContainer:
+
+  def test_signal(self):
+    c = make_container('nginx')
+    assert rcc.reload_container(c, 'signal', 'HUP') == 'signal HUP'
+    c.kill.assert_called_once_with(signal='HUP')
+    c.restart.assert_not_called()
+
+  def test_exec(self):
+    c = make_container('nginx')
+    assert rcc.reload_container(c, 'exec', 'nginx -s reload') == 'exec'
+    c.exec_run.assert_called_once_with(['nginx', '-s', 'reload'])
+    c.restart.assert_not_called()
+
+  def test_failed_exec_falls_back_to_restart(self):
+    c = make_container('nginx')
+    c.exec_run.return_value = (1, b'nginx: [emerg] cannot load certificate')
+    assert rcc.reload_container(c, 'exec', 'nginx -s reload') == 'restart'
+    c.restart.assert_called_once()
+
+  def test_failed_signal_falls_back_to_restart(self):
+    c = make_container('nginx')
+    c.kill.side_effect = docker.errors.APIError('container is not running')
+    assert rcc.reload_container(c, 'signal', 'HUP') == 'restart'
+    c.restart.assert_called_once()
+
+
+class TestDependencies:
+
+  def test_dependencies(self):
+    nginx = make_container('nginx')
+    db = make_container('db')
+    app = make_container('app', {rcc.DEPENDS_LABEL: 'nginx:service_started:false,other:service_healthy:false,'
+                                                    'db:service_healthy:true'})
+    services = {'nginx': nginx, 'db': db, 'app': app}
+    assert sorted(c.name for c in rcc.dependencies(app, services)) == ['db', 'nginx']
+    assert rcc.dependencies(nginx, services) == []
+
+  def test_self_dependency_is_ignored(self):
+    nginx = make_container('nginx', {rcc.DEPENDS_LABEL: 'nginx:service_started:false'})
+    assert rcc.dependencies(nginx, {'nginx': nginx}) == []
+
+
+class TestCertificates:
+
+  def test_first_certificate(self, lineage):
+    live, archive = lineage
+    (archive / 'cert1.pem').write_text('')
+    assert rcc.first_certificate()
+    (archive / 'cert2.pem').write_text('')
+    assert not rcc.first_certificate()
+
+  def test_no_lineage(self):
+    assert not rcc.first_certificate()
+    assert rcc.new_certificate() is None
+
+
+@pytest.fixture(scope='module')
+def certificates(tmp_path_factory):
+  """Два самоподписанных сертификата: старый и новый"""
+  directory = tmp_path_factory.mktemp('certs')
+  for name in ('old', 'new'):
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-keyout', str(directory / f'{name}.key'), '-out', str(directory / f'{name}.pem')],
+                   check=True, capture_output=True)
+  return directory
+
+
+@pytest.mark.skipif(not shutil.which('openssl'), reason='openssl is not installed')
+class TestProbe:
+
+  @pytest.fixture
+  def tls_server(self, certificates):
+    """TLS сервер на localhost, отдающий сертификат `name`; вернуть его порт"""
+    servers = []
+
+    def start(name):
+      context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+      context.load_cert_chain(certificates / f'{name}.pem', certificates / f'{name}.key')
+      server = socket.create_server(('127.0.0.1', 0))
+      servers.append(server)
+
+      def serve():
+        while True:
+          try:
+            conn, _ = server.accept()
+          except OSError:
+            return
+          try:
+            with context.wrap_socket(conn, server_side=True):
+              pass
+          except (OSError, ssl.SSLError):
+            pass
+      threading.Thread(target=serve, daemon=True).start()
+      return server.getsockname()[1]
+
+    yield start
+    for server in servers:
+      server.close()
+
+  def der(self, certificates, name):
+    return ssl.PEM_cert_to_DER_cert((certificates / f'{name}.pem').read_text())
+
+  def test_tls_new_certificate(self, tls_server, certificates):
+    port = tls_server('new')
+    assert rcc.probe(f'tls:127.0.0.1:{port}', self.der(certificates, 'new')) is None
+
+  def test_tls_old_certificate(self, tls_server, certificates):
+    port = tls_server('old')
+    assert rcc.probe(f'tls:127.0.0.1:{port}', self.der(certificates, 'new')) == 'old certificate is served'
+
+  def test_new_certificate_from_lineage(self, lineage, certificates):
+    live, _ = lineage
+    shutil.copy(certificates / 'new.pem', live / 'cert.pem')
+    assert rcc.new_certificate() == self.der(certificates, 'new')
+
+  def test_tcp(self):
+    with socket.create_server(('127.0.0.1', 0)) as server:
+      assert rcc.probe(f'tcp:127.0.0.1:{server.getsockname()[1]}', None) is None
+
+  def test_closed_port_times_out(self):
+    with socket.create_server(('127.0.0.1', 0)) as server:
+      port = server.getsockname()[1]
+    c = make_container('nginx', {rcc.PROBE_LABEL: f'tcp:127.0.0.1:{port}'})
+    assert rcc.wait_ready(c, None, rcc.time.monotonic() + 0.05)
+    assert c.reload.call_count > 1
+
+
+class TestContainerReady:
+
+  def test_running(self):
+    assert rcc.container_ready(make_container('nginx'), None) is None
+
+  def test_exited(self):
+    assert rcc.container_ready(make_container('nginx', status='exited'), None) == 'status exited'
+
+  def test_unhealthy(self):
+    assert rcc.container_ready(make_container('nginx', health='starting'), None) == 'health starting'
+
+  def test_probe_is_used(self):
+    c = make_container('nginx', {rcc.PROBE_LABEL: 'tls:nginx:443'})
+    with patch('restart_certbot_containers.probe', return_value='refused') as mock_probe:
+      assert rcc.container_ready(c, b'cert') == 'refused'
+    mock_probe.assert_called_once_with('tls:nginx:443', b'cert')
+
+
+class TestRestartCertbotContainers:
+
+  def test_no_containers(self, docker_client):
+    docker_client.containers.list.return_value = []
+    assert rcc.restart_certbot_containers()
+    docker_client.containers.list.assert_called_once_with(filters={'label': rcc.LABEL})
+
+  def test_strategies(self, docker_client):
+    nginx = make_container('nginx', {rcc.LABEL: 'signal:HUP'})
+    xui = make_container('3x-ui', {rcc.LABEL: 'restart'})
+    docker_client.containers.list.return_value = [nginx, xui]
+    assert rcc.restart_certbot_containers()
+    nginx.kill.assert_called_once_with(signal='HUP')
+    nginx.restart.assert_not_called()
+    xui.restart.assert_called_once()
+
+  def test_first_certificate_restarts(self, docker_client, lineage):
+    (lineage[1] / 'cert1.pem').write_text('')
+    nginx = make_container('nginx', {rcc.LABEL: 'signal:HUP'})
+    docker_client.containers.list.return_value = [nginx]
+    assert rcc.restart_certbot_containers()
+    nginx.kill.assert_not_called()
+    nginx.restart.assert_called_once()
+
+  def test_dependency_goes_after_ready(self, docker_client):
+    events = []
+    nginx = make_container('nginx', {rcc.LABEL: 'signal:HUP'}, events=events)
+    app = make_container('app', {rcc.DEPENDS_LABEL: 'nginx:service_started:false'}, events=events)
+    docker_client.containers.list.return_value = [app, nginx]
+    assert rcc.restart_certbot_containers()
+    assert events.index(('nginx', 'reload')) < events.index(('app', 'restart'))
+    assert events.index(('nginx', 'signal HUP')) < events.index(('app', 'restart'))
+
+  def test_not_ready_fails(self, docker_client):
+    nginx = make_container('nginx', status='restarting')
+    docker_client.containers.list.return_value = [nginx, make_container('3x-ui')]
+    assert not rcc.restart_certbot_containers()
+
+  def test_api_error_fails(self, docker_client):
+    nginx = make_container('nginx')
+    nginx.restart.side_effect = docker.errors.APIError('conflict')
+    docker_client.containers.list.return_value = [nginx]
+    assert not rcc.restart_certbot_containers()
+
+  @pytest.mark.parametrize('status, code', [('running', 0), ('exited', 1)])
+  def test_exit_code(self, docker_client, monkeypatch, status, code):
+    monkeypatch.setenv('CERTBOT_RESTART_TIMEOUT', '0')
+    docker_client.containers.list.return_value = [make_container('nginx', status=status)]
+    with pytest.raises(SystemExit) as exc_info:
+      runpy.run_path(SCRIPT, run_name='__main__')
+    assert exc_info.value.code == code
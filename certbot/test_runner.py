@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+import os, shutil, subprocess, sys
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import runner
+
+# вывод certbot 2.x при реальных ошибках ACME
+RATE_LIMITED_CERTONLY = '''\
+Requesting a certificate for example.com
+An unexpected error occurred:
+Error creating new order :: too many certificates (5) already issued for this exact set of domains in the last 168 hours: example.com, retry after 2024-05-02 10:11:12 UTC: see https://letsencrypt.org/docs/rate-limits/#new-certificates-per-exact-set-of-hostnames
+Ask for help or search for solutions at https://community.letsencrypt.org. See the logfile /var/log/letsencrypt/letsencrypt.log or re-run Certbot with -v for more details.
+'''
+
+RATE_LIMITED_RENEW = '''\
+Processing /etc/letsencrypt/renewal/example.com.conf
+Renewing an existing certificate for example.com
+Failed to renew certificate example.com with error: urn:ietf:params:acme:error:rateLimited :: There were too many requests of a given type :: Error creating new order :: too many certificates (5) already issued for this exact set of domains in the last 168 hours: example.com, retry after 2024-05-02 10:11:12 UTC: see https://letsencrypt.org/docs/rate-limits/
+All renewals failed. The following certificates could not be renewed:
+  /etc/letsencrypt/live/example.com/fullchain.pem (failure)
+1 renew failure(s), 0 parse failure(s)
+'''
+
+FAILED_AUTHORIZATIONS = '''\
+An unexpected error occurred:
+Error creating new order :: too many failed authorizations recently: see https://letsencrypt.org/docs/failed-validation-limit/
+'''
+
+CHALLENGE_UNAUTHORIZED = '''\
+Requesting a certificate for example.com
+
+Certbot failed to authenticate some domains (authenticator: webroot). The Certificate Authority reported these problems:
+  Domain: example.com
+  Type:   unauthorized
+  Detail: 203.0.113.5: Invalid response from http://example.com/.well-known/acme-challenge/abc: 404
+
+Hint: The Certificate Authority failed to download the temporary challenge files created by Certbot. Ensure that the listed domains serve their content from the provided --webroot-path/-w and that files created there can be downloaded from the internet.
+
+Some challenges have failed.
+'''
+
+CHALLENGE_RENEW_CONNECTION = '''\
+Processing /etc/letsencrypt/renewal/example.com.conf
+Renewing an existing certificate for example.com
+Failed to renew certificate example.com with error: Some challenges have failed.
+  Domain: example.com
+  Type:   connection
+  Detail: 203.0.113.5: Fetching http://example.com/.well-known/acme-challenge/abc: Timeout during connect (likely firewall problem)
+1 renew failure(s), 0 parse failure(s)
+'''
+
+NETWORK_ERROR = '''\
+An unexpected error occurred:
+requests.exceptions.ConnectionError: HTTPSConnectionPool(host='acme-v02.api.letsencrypt.org', port=443): Max retries exceeded with url: /directory
+'''
+
+RETRY_AT = 1714644672  # 2024-05-02 10:11:12 UTC
+
+
+class TestRenderTemplate:
+
+  def test_variables_like_envsubst(self, tmp_path):
+    template = tmp_path / 'cli.ini.template'
+    template.write_text('domain = $VPS_DOMAIN\nemail = ${VPS_EMAIL}\nserver = $ACME_SERVER\n'
+                        'keep $1 and $ alone, $$VPS_DOMAIN\n')
+    output = tmp_path / 'cli.ini'
+    runner.render_template(str(template), str(output), {'VPS_DOMAIN': 'example.com', 'VPS_EMAIL': 'me@example.com'})
+    assert output.read_text() == ('domain = example.com\nemail = me@example.com\nserver = \n'
+                                  'keep $1 and $ alone, $example.com\n')
+
+  @pytest.mark.skipif(not shutil.which('envsubst'), reason='envsubst is not installed')
+  def test_same_as_envsubst(self, tmp_path):
+    template = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.ini.template')
+    env = {'PATH': os.environ.get('PATH', ''), 'VPS_DOMAIN': 'example.com', 'VPS_EMAIL': ''}
+    with open(template) as f:
+      expected = subprocess.run(['envsubst'], stdin=f, capture_output=True, text=True, env=env).stdout
+    runner.render_template(template, str(tmp_path / 'cli.ini'), env)
+    assert (tmp_path / 'cli.ini').read_text() == expected
+
+  def test_cli_ini_template_has_no_variables_left(self, tmp_path):
+    template = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cli.ini.template')
+    runner.render_template(template, str(tmp_path / 'cli.ini'),
+                           {'VPS_DOMAIN': 'example.com', 'VPS_EMAIL': 'me@example.com', 'ACME_SERVER': 'https://acme'})
+    text = (tmp_path / 'cli.ini').read_text()
+    assert '$' not in text
+    assert 'domain = example.com' in text
+
+
+class TestClassify:
+
+  @pytest.mark.parametrize('output, outcome', [
+    (RATE_LIMITED_CERTONLY, runner.RATE_LIMITED),
+    (RATE_LIMITED_RENEW, runner.RATE_LIMITED),
+    (FAILED_AUTHORIZATIONS, runner.RATE_LIMITED),
+    (CHALLENGE_UNAUTHORIZED, runner.CHALLENGE_FAILED),
+    (CHALLENGE_RENEW_CONNECTION, runner.CHALLENGE_FAILED),
+    (NETWORK_ERROR, runner.ERROR),
+    ('', runner.ERROR),
+  ])
+  def test_classify(self, output, outcome):
+    assert runner.classify(output) == outcome
+
+
+class TestRetry:
+
+  def test_retry_after_from_renew_output(self):
+    assert runner.retry_after(RATE_LIMITED_RENEW, now=RETRY_AT - 3600) == 3600
+    assert runner.retry_after(RATE_LIMITED_CERTONLY, now=RETRY_AT + 60) == 0
+    assert runner.retry_after(CHALLENGE_UNAUTHORIZED) is None
+
+  @patch('runner.random.randint', return_value=0)
+  def test_rate_limit_waits_for_letsencrypt(self, mock_randint):
+    retry_at = datetime.now(timezone.utc).replace(microsecond=0) + timedelta(hours=2)
+    output = RATE_LIMITED_RENEW.replace('2024-05-02 10:11:12', retry_at.strftime('%Y-%m-%d %H:%M:%S'))
+    assert 7190 < runner.retry_delay(runner.RATE_LIMITED, 1, output) <= 7200
+    assert runner.retry_delay(runner.RATE_LIMITED, 1, FAILED_AUTHORIZATIONS) == 24 * 3600
+
+  @patch('runner.random.randint', return_value=0)
+  def test_challenge_failure_retries_in_minutes(self, mock_randint):
+    delays = [runner.retry_delay(runner.CHALLENGE_FAILED, n, CHALLENGE_UNAUTHORIZED) for n in range(1, 9)]
+    assert delays[:3] == [600, 1200, 2400]
+    assert delays[-1] == 5 * 3600
+
+  @patch('runner.random.randint', return_value=2)
+  def test_other_errors_retry_in_hours(self, mock_randint):
+    assert runner.retry_delay(runner.ERROR, 1, NETWORK_ERROR) == 3 * 3600
+
+
+class TestRunCertbot:
+
+  @pytest.fixture
+  def fake_certbot(self, tmp_path, monkeypatch):
+    """certbot на PATH, печатающий `output` и выходящий с `code`"""
+    def install(output, code):
+      (tmp_path / 'output.txt').write_text(output)
+      script = tmp_path / 'certbot'
+      script.write_text(f'#!/bin/sh\ncat {tmp_path / "output.txt"}\nexit {code}\n')
+      script.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{tmp_path}{os.pathsep}{os.environ.get("PATH", "")}')
+    return install
+
+  def test_renewed(self, fake_certbot):
+    fake_certbot('Congratulations, all renewals succeeded\n', 0)
+    fingerprints = iter([(1, 2), (3, 4)])
+    assert runner.run_certbot(['renew'], lambda: next(fingerprints)) == \
+      (runner.RENEWED, 'Congratulations, all renewals succeeded\n')
+
+  def test_not_due(self, fake_certbot):
+    fake_certbot('Certificate not yet due for renewal\n', 0)
+    assert runner.run_certbot(['renew'], lambda: (1, 2))[0] == runner.NOT_DUE
+
+  def test_failure_keeps_output_for_retry_after(self, fake_certbot):
+    fake_certbot(RATE_LIMITED_RENEW, 1)
+    outcome, output = runner.run_certbot(['renew'], lambda: (1, 2))
+    assert outcome == runner.RATE_LIMITED
+    assert runner.retry_after(output, now=RETRY_AT) == 0
+
+  def test_missing_certbot(self, monkeypatch, tmp_path):
+    monkeypatch.setenv('PATH', str(tmp_path))
+    assert runner.run_certbot(['renew'], lambda: None)[0] == runner.ERROR
@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+"""Offline end-to-end benchmark of the geo update cycle.
+
+Runs real geo_update() cycles against a local HTTP origin (separate process, GitHub-like
+redirects, ETag/Last-Modified, Range/If-Range) and a fake 3x-ui container whose filesystem
+is a local directory, or a throwaway alpine container with --docker.
+
+Scenarios, run in order on the same state:
+  cold       empty WORKDIR and container: everything is downloaded and pushed
+  warm       all sources are due again but unchanged upstream: conditional GETs only
+  partial    one source changed upstream: one download, one push, one restart
+  recreated  the container is recreated with stock files: push from WORKDIR only
+
+For each cycle: wall time, peak RSS of this process, bytes written by geo-update
+(write() calls, the directory container's own writes excluded) and Docker API calls.
+
+    python bench_geo_update.py --size-mb 80
+    python bench_geo_update.py --docker --json results.json
+"""
+
+import argparse
+import collections
+import email.utils
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import shlex
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path, PurePosixPath
+
+import geo_dat
+import geo_update
+
+FILENAMES = ("geoip.dat", "geosite.dat", "geoip_RU.dat", "geosite_RU.dat")
+ITEMS_PER_ENTRY = 50_000
+
+ExecResult = collections.namedtuple("ExecResult", "exit_code output")
+
+
+def make_dat(path, size, seed):
+    """Write a valid geoip/geosite .dat file of about `size` bytes, content depends on `seed`"""
+    rnd = random.Random(seed)
+    kind = geo_dat.dat_kind(path.name)
+    written = entry = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            items = []
+            for i in range(ITEMS_PER_ENTRY):
+                if kind == "geoip":
+                    # CIDR { ip = 1; prefix = 2; }
+                    item = b"\x0a\x04" + rnd.randbytes(4) + b"\x10" + bytes([rnd.randint(8, 32)])
+                else:
+                    # Domain { type = 1; value = 2; }
+                    value = f"d{i}-{rnd.getrandbits(32):x}.example{entry}.com".encode()
+                    item = b"\x08\x02\x12" + geo_dat.encode_varint(len(value)) + value
+                items.append(b"\x12" + geo_dat.encode_varint(len(item)) + item)
+            code = f"C{entry:04d}".encode()
+            payload = b"\x0a" + geo_dat.encode_varint(len(code)) + code + b"".join(items)
+            data = b"\x0a" + geo_dat.encode_varint(len(payload)) + payload
+            f.write(data)
+            written += len(data)
+            entry += 1
+
+    digest = geo_update.sha256_file(path)
+    path.with_name(path.name + ".sha256sum").write_text(f"{digest}  {path.name}\n")
+
+
+def make_dats(paths_seeds, size):
+    """Generate payloads in a child process, so that its memory does not count in peak RSS"""
+    procs = [multiprocessing.Process(target=make_dat, args=(path, size, seed)) for path, seed in paths_seeds]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+        if proc.exitcode:
+            raise RuntimeError(f"Generating payloads failed with exit code {proc.exitcode}")
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """Serves /download/<name> as a redirect to /assets/<name>, like GitHub release links"""
+
+    protocol_version = "HTTP/1.1"
+    root = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.serve(head=True)
+
+    def do_GET(self):
+        self.serve(head=False)
+
+    def send_empty(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def serve(self, head):
+        name = PurePosixPath(self.path).name
+        if self.path.startswith("/download/"):
+            self.send_empty(302, [("Location", f"/assets/{name}")])
+            return
+        path = self.root / name
+        if not self.path.startswith("/assets/") or not path.is_file():
+            self.send_empty(404)
+            return
+
+        st = path.stat()
+        etag = f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        validators = [("ETag", etag), ("Last-Modified", last_modified), ("Accept-Ranges", "bytes")]
+        if self.headers.get("If-None-Match") == etag:
+            self.send_empty(304, validators)
+            return
+
+        start = 0
+        range_header = self.headers.get("Range", "")
+        if range_header.startswith("bytes=") and self.headers.get("If-Range") in (None, etag, last_modified):
+            start = int(range_header[len("bytes="):].split("-")[0])
+            if start >= st.st_size:
+                self.send_empty(416, [("Content-Range", f"bytes */{st.st_size}")])
+                return
+
+        self.send_response(206 if start else 200)
+        for header in validators:
+            self.send_header(*header)
+        if start:
+            self.send_header("Content-Range", f"bytes {start}-{st.st_size - 1}/{st.st_size}")
+        self.send_header("Content-Length", str(st.st_size - start))
+        self.end_headers()
+        if not head:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                shutil.copyfileobj(f, self.wfile, 1024*1024)
+
+
+def serve_origin(root, port_queue):
+    """Origin process entry point"""
+    OriginHandler.root = Path(root)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class ChunkReader(io.RawIOBase):
+    """File-like view of an iterable of byte chunks, for reading a streamed tar"""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buf:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._buf = memoryview(chunk)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+
+class DirContainer:
+    """Stand-in for a running 3x-ui container: its filesystem is a local directory and
+    xray is a pid that changes when signaled"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.name = "3x-ui"
+        self.status = "running"
+        self.bytes_written = 0
+        self.recreate()
+
+    def recreate(self):
+        """New container instance with an empty /app/bin"""
+        shutil.rmtree(self.root, ignore_errors=True)
+        (self.root / "app" / "bin").mkdir(parents=True)
+        self.id = os.urandom(6).hex()
+        self.attrs = {"State": {"StartedAt": datetime.now(timezone.utc).isoformat()}}
+        self.pid = 100
+
+    def reload(self):
+        pass
+
+    def local(self, path):
+        return self.root / PurePosixPath(path).relative_to("/")
+
+    def put_archive(self, path, data):
+        with tarfile.open(fileobj=ChunkReader(data), mode="r|") as tar:
+            for member in tar:
+                target = self.local(PurePosixPath(path) / member.name)
+                if member.isdir():
+                    target.mkdir(parents=True, exist_ok=True)
+                    continue
+                with tar.extractfile(member) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1024*1024)
+                self.bytes_written += member.size
+        return True
+
+    def exec_run(self, cmd, user=None):
+        if cmd[0] == "sha256sum":
+            lines = [f"{geo_update.sha256_file(self.local(p))}  {p}" for p in cmd[1:] if self.local(p).is_file()]
+            return ExecResult(0 if len(lines) == len(cmd) - 1 else 1, "".join(l + "\n" for l in lines).encode())
+        if cmd[0] == "pgrep":
+            return ExecResult(0, f"{self.pid}\n".encode())
+        if cmd[:2] == ["sh", "-c"] and "pgrep" in cmd[2]:
+            old, self.pid = self.pid, self.pid + 1
+            return ExecResult(0, f"{old}\n".encode())
+        if cmd[:2] == ["sh", "-c"]:
+            for step in cmd[2].split(" && "):
+                args = shlex.split(step)
+                assert args[:2] == ["mv", "-f"], step
+                os.replace(self.local(args[2]), self.local(args[3]))
+            return ExecResult(0, b"")
+        raise NotImplementedError(cmd)
+
+
+# fake xray: a script named xray-linux, restarted by the container's main loop when killed
+DOCKER_XRAY_SCRIPT = (
+    "printf '#!/bin/sh\\nwhile :; do sleep 3600; done\\n' > /usr/local/bin/xray-linux"
+    " && chmod +x /usr/local/bin/xray-linux && mkdir -p /app/bin"
+    " && while :; do xray-linux; done")
+
+
+class DockerTarget:
+    """Throwaway alpine container on the local Docker daemon"""
+
+    def __init__(self, client):
+        self.client = client
+        self.name = f"geo-bench-{os.getpid()}"
+        self.container = None
+        self.bytes_written = 0  # written by the daemon, not by this process
+        self.recreate()
+
+    def recreate(self):
+        self.remove()
+        self.container = self.client.containers.run("alpine", ["sh", "-c", DOCKER_XRAY_SCRIPT],
+                                                    name=self.name, detach=True)
+        geo_update.wait_for_xray(self.container)
+
+    def remove(self):
+        if self.container is not None:
+            self.container.remove(force=True)
+
+
+class CallCounter:
+    """Proxy counting method calls of the wrapped object: each one is a Docker API round trip"""
+
+    def __init__(self, target, counts, prefix):
+        self._target = target
+        self._counts = counts
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self._counts[f"{self._prefix}.{name}"] += 1
+            return attr(*args, **kwargs)
+        return counted
+
+
+class BenchContainers:
+    """client.containers replacement returning counted handles of the benchmark container"""
+
+    def __init__(self, target, counts):
+        self._target = target
+        self._counts = counts
+
+    def _handle(self):
+        container = getattr(self._target, "container", self._target)
+        return CallCounter(container, self._counts, "container")
+
+    def list(self, filters=None):
+        self._counts["containers.list"] += 1
+        return [self._handle()]
+
+    def get(self, container_id):
+        self._counts["containers.get"] += 1
+        return self._handle()
+
+
+class BenchClient:
+    def __init__(self, target, counts):
+        self.containers = BenchContainers(target, counts)
+
+
+def reset_peak_rss():
+    """Reset VmHWM of this process (Linux >= 4.0), return False if it is not supported"""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb(resettable):
+    if resettable:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    # lifetime peak, in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bytes_written():
+    """Bytes passed to write() by this process so far"""
+    try:
+        for line in Path("/proc/self/io").read_text().splitlines():
+            if line.startswith("wchar:"):
+                return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def run_cycle(scenario, target, counts, push_only=False):
+    """Run one geo_update() cycle and measure it"""
+    counts.clear()
+    resettable = reset_peak_rss()
+    container_before = target.bytes_written
+    written_before = bytes_written()
+    start = time.perf_counter()
+    updated = geo_update.geo_update(push_only=push_only)
+    wall = time.perf_counter() - start
+    written = bytes_written() - written_before - (target.bytes_written - container_before)
+    return {
+        "scenario": scenario,
+        "updated": updated,
+        "wall_seconds": round(wall, 3),
+        "peak_rss_mb": round(peak_rss_mb(resettable), 1),
+        "written_mb": round(max(0, written) / 2**20, 1),
+        "docker_calls": sum(counts.values()),
+        "docker_calls_by_method": dict(sorted(counts.items())),
+    }
+
+
+def make_all_due():
+    """Forget the schedule, as if the update interval of every source has passed"""
+    (geo_update.WORKDIR / geo_update.SCHEDULE_FILENAME).unlink(missing_ok=True)
+
+
+def run_benchmark(size_mb, use_docker=False, root=None):
+    """Prepare the origin and the container, run all scenarios, return list of results"""
+    root = Path(root or tempfile.mkdtemp(prefix="geo-bench-"))
+    assets = root / "assets"
+    assets.mkdir(parents=True, exist_ok=True)
+    size = int(size_mb * 2**20)
+    make_dats([(assets / filename, seed) for seed, filename in enumerate(FILENAMES)], size)
+
+    port_queue = multiprocessing.Queue()
+    origin = multiprocessing.Process(target=serve_origin, args=(str(assets), port_queue), daemon=True)
+    origin.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=10)}/download"
+
+    if use_docker:
+        import docker
+        target = DockerTarget(docker.from_env())
+    else:
+        target = DirContainer(root / "container")
+
+    counts = collections.Counter()
+    saved = {name: getattr(geo_update, name) for name in
+             ("WORKDIR", "GEO_FILES", "GEO_TRIM", "METRICS_DIR", "docker_client", "xray_container")}
+    geo_update.WORKDIR = root / "work"
+    geo_update.WORKDIR.mkdir(exist_ok=True)
+    geo_update.GEO_FILES = [{"url": f"{base_url}/{name}", "sha256_url": f"{base_url}/{name}.sha256sum",
+                             "filename": name} for name in FILENAMES]
+    geo_update.GEO_TRIM = False
+    geo_update.METRICS_DIR = root / "no-metrics"
+    geo_update.docker_client = BenchClient(target, counts)
+    geo_update.xray_container = None
+
+    results = []
+    try:
+        results.append(run_cycle("cold", target, counts))
+
+        make_all_due()
+        results.append(run_cycle("warm", target, counts))
+
+        make_all_due()
+        make_dats([(assets / FILENAMES[0], len(FILENAMES))], size)
+        results.append(run_cycle("partial", target, counts))
+
+        target.recreate()
+        results.append(run_cycle("recreated", target, counts, push_only=True))
+    finally:
+        for name, value in saved.items():
+            setattr(geo_update, name, value)
+        origin.terminate()
+        if use_docker:
+            target.remove()
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    header = f"{'scenario':<10} {'updated':>7} {'wall s':>8} {'peak RSS MB':>11} {'written MB':>10} {'docker calls':>12}"
+    out.write(header + "\n")
+    for r in results:
+        out.write(f"{r['scenario']:<10} {str(r['updated']):>7} {r['wall_seconds']:>8.3f} {r['peak_rss_mb']:>11.1f} "
+                  f"{r['written_mb']:>10.1f} {r['docker_calls']:>12}\n")
+    for r in results:
+        calls = ", ".join(f"{method}={n}" for method, n in r["docker_calls_by_method"].items())
+        out.write(f"  {r['scenario']}: {calls}\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark geo_update() cycles against a local origin and container")
+    parser.add_argument("--size-mb", type=float, default=10, help="size of each of the 4 geo files (default 10)")
+    parser.add_argument("--docker", action="store_true", help="push into a throwaway alpine container on local Docker")
+    parser.add_argument("--dir", help="work directory, kept after the run (default: temporary, removed)")
+    parser.add_argument("--json", help="also write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show geo_update logs")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        geo_update.log.setLevel(logging.WARNING)
+    root = Path(args.dir) if args.dir else Path(tempfile.mkdtemp(prefix="geo-bench-"))
+    try:
+        results = run_benchmark(args.size_mb, use_docker=args.docker, root=root)
+    finally:
+        if not args.dir:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_results(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
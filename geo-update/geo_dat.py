@@ -0,0 +1,206 @@
+"""Streaming reader/writer for xray geoip/geosite .dat files.
+
+Both files are protobuf lists with the same top-level framing:
+
+    GeoIPList   { repeated GeoIP   entry = 1; }   GeoIP   { string country_code = 1; repeated CIDR   cidr   = 2; ... }
+    GeoSiteList { repeated GeoSite entry = 1; }   GeoSite { string country_code = 1; repeated Domain domain = 2; ... }
+
+Entries are read one at a time, the whole file is never loaded into memory.
+"""
+
+ENTRY_TAG = (1 << 3) | 2  # field 1, length-delimited
+
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LEN = 2
+WIRE_FIXED32 = 5
+
+
+class DatFormatError(ValueError):
+    """File is not a valid GeoIPList/GeoSiteList"""
+
+
+def read_varint(f):
+    """Read a varint from a binary stream, return None at a clean end of stream"""
+    result = shift = 0
+    while True:
+        b = f.read(1)
+        if not b:
+            if shift == 0:
+                return None
+            raise DatFormatError("truncated varint")
+        result |= (b[0] & 0x7f) << shift
+        if not b[0] & 0x80:
+            return result
+        shift += 7
+        if shift > 63:
+            raise DatFormatError("varint is too long")
+
+
+def decode_varint(buf, pos):
+    """Decode a varint from `buf` at `pos`, return (value, new pos)"""
+    result = shift = 0
+    while True:
+        if pos >= len(buf):
+            raise DatFormatError("truncated varint")
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise DatFormatError("varint is too long")
+
+
+def encode_varint(value):
+    """Encode a non-negative int as varint"""
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def iter_fields(buf):
+    """Yield (field number, wire type, value) of a message; value is int for numeric types
+    and a memoryview for length-delimited ones"""
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        tag, pos = decode_varint(buf, pos)
+        field, wire = tag >> 3, tag & 7
+        if field == 0:
+            raise DatFormatError("field number 0")
+        if wire == WIRE_VARINT:
+            value, pos = decode_varint(buf, pos)
+        elif wire == WIRE_LEN:
+            length, pos = decode_varint(buf, pos)
+            if pos + length > len(buf):
+                raise DatFormatError("truncated field")
+            value = view[pos:pos + length]
+            pos += length
+        elif wire == WIRE_FIXED64:
+            if pos + 8 > len(buf):
+                raise DatFormatError("truncated field")
+            value = int.from_bytes(buf[pos:pos + 8], "little")
+            pos += 8
+        elif wire == WIRE_FIXED32:
+            if pos + 4 > len(buf):
+                raise DatFormatError("truncated field")
+            value = int.from_bytes(buf[pos:pos + 4], "little")
+            pos += 4
+        else:
+            raise DatFormatError(f"unsupported wire type {wire}")
+        yield field, wire, value
+
+
+def entry_code(payload):
+    """Return country_code (category name) of a GeoIP/GeoSite entry"""
+    for field, wire, value in iter_fields(payload):
+        if field == 1 and wire == WIRE_LEN:
+            try:
+                return bytes(value).decode()
+            except UnicodeDecodeError:
+                raise DatFormatError("country_code is not utf-8")
+    raise DatFormatError("entry has no country_code")
+
+
+def iter_entries(f):
+    """Yield (code, header, payload) for each entry of an open .dat file.
+    `header` + `payload` is the entry exactly as encoded in the file."""
+    while True:
+        tag = read_varint(f)
+        if tag is None:
+            return
+        if tag != ENTRY_TAG:
+            raise DatFormatError(f"unexpected top-level tag {tag}")
+        length = read_varint(f)
+        if length is None:
+            raise DatFormatError("truncated entry length")
+        payload = f.read(length)
+        if len(payload) != length:
+            raise DatFormatError("truncated entry")
+        yield entry_code(payload), encode_varint(tag) + encode_varint(length), payload
+
+
+def trim_dat(src, dst, codes):
+    """Copy entries whose code is in `codes` (case-insensitive) from `src` to `dst`.
+    Return (set of copied codes upper-cased, total number of entries in src)."""
+    wanted = {code.upper() for code in codes}
+    kept = set()
+    total = 0
+    with open(src, 'rb') as fin, open(dst, 'wb') as fout:
+        for code, header, payload in iter_entries(fin):
+            total += 1
+            if code.upper() in wanted:
+                kept.add(code.upper())
+                fout.write(header)
+                fout.write(payload)
+    return kept, total
+
+
+def dat_kind(filename):
+    """Guess list type from file name: "geoip", "geosite" or None"""
+    name = filename.lower()
+    if name.startswith("geoip"):
+        return "geoip"
+    if name.startswith("geosite"):
+        return "geosite"
+    return None
+
+
+def check_cidr(buf):
+    """CIDR { bytes ip = 1; uint32 prefix = 2; }"""
+    ip_len = None
+    prefix = 0
+    for field, wire, value in iter_fields(buf):
+        if field == 1 and wire == WIRE_LEN:
+            ip_len = len(value)
+        elif field == 2 and wire == WIRE_VARINT:
+            prefix = value
+    if ip_len not in (4, 16):
+        raise DatFormatError(f"bad CIDR address length {ip_len}")
+    if prefix > ip_len * 8:
+        raise DatFormatError(f"bad CIDR prefix /{prefix}")
+
+
+def check_domain(buf):
+    """Domain { Type type = 1; string value = 2; repeated Attribute attribute = 3; }"""
+    domain_type = 0
+    has_value = False
+    for field, wire, value in iter_fields(buf):
+        if field == 1 and wire == WIRE_VARINT:
+            domain_type = value
+        elif field == 2 and wire == WIRE_LEN:
+            has_value = len(value) > 0
+    if domain_type > 3:
+        raise DatFormatError(f"bad domain type {domain_type}")
+    if not has_value:
+        raise DatFormatError("domain without value")
+
+
+def validate_dat(path, kind=None):
+    """Walk all entries of a .dat file and check their structure; CIDRs or domains
+    are checked too when `kind` is "geoip" or "geosite".
+    Return {"entries": number of categories, "items": number of CIDRs/domains}."""
+    check_item = {"geoip": check_cidr, "geosite": check_domain}.get(kind)
+    entries = items = 0
+    with open(path, 'rb') as f:
+        for _, _, payload in iter_entries(f):
+            entries += 1
+            for field, wire, value in iter_fields(payload):
+                if field != 2:
+                    continue
+                if wire != WIRE_LEN:
+                    raise DatFormatError(f"bad item wire type {wire}")
+                if check_item:
+                    check_item(value)
+                items += 1
+    if entries == 0:
+        raise DatFormatError("no entries")
+    return {"entries": entries, "items": items}
@@ -0,0 +1,295 @@
+"""Compiled, memory-mapped lookup index over a geoip/geosite .dat file.
+
+geoip: CIDRs of all categories are split into disjoint intervals, each mapped to the set
+of categories covering it. Interval starts are stored as sorted arrays (IPv4: uint32,
+IPv6: two uint64 arrays hi/lo) and looked up by binary search.
+
+geosite: "domain" and "full" rules form a trie over reversed domain labels
+(com -> google -> www), stored as flat node and edge arrays with children sorted by
+label. "plain" (keyword) and "regex" rules are few and kept in the header.
+
+File layout: MAGIC, uint32 header length, JSON header, then 8-byte aligned sections
+whose offsets are listed in the header.
+"""
+
+import bisect
+import ipaddress
+import json
+import mmap
+import re
+import struct
+import sys
+from array import array
+
+import geo_dat
+
+MAGIC = b"GEOIDX1\0"
+FORMAT_VERSION = 1
+
+NODE = struct.Struct("<IIII")  # first edge, edge count, "domain" set id, "full" set id
+EDGE = struct.Struct("<III")   # label offset, label length, child node
+
+DOMAIN_PLAIN, DOMAIN_REGEX, DOMAIN_SUFFIX, DOMAIN_FULL = range(4)
+
+
+class _SetTable:
+    """Deduplicated category sets; id 0 is the empty set"""
+
+    def __init__(self):
+        self.sets = [()]
+        self.ids = {(): 0}
+
+    def id(self, codes):
+        key = tuple(sorted(codes))
+        if key not in self.ids:
+            self.ids[key] = len(self.sets)
+            self.sets.append(key)
+        return self.ids[key]
+
+
+def _iter_items(src):
+    """Yield (code, item payload) for each CIDR/domain of a .dat file"""
+    with open(src, 'rb') as f:
+        for code, _, payload in geo_dat.iter_entries(f):
+            for field, wire, value in geo_dat.iter_fields(payload):
+                if field == 2 and wire == geo_dat.WIRE_LEN:
+                    yield code, value
+
+
+def _disjoint_intervals(ranges, bits, set_table):
+    """Turn (start, end, code_id) ranges into sorted (start, set id) of disjoint intervals"""
+    events = {}
+    for start, end, code_id in ranges:
+        events.setdefault(start, []).append((1, code_id))
+        if end + 1 < 1 << bits:
+            events.setdefault(end + 1, []).append((-1, code_id))
+
+    active = {}
+    result = []
+    for point in sorted(events):
+        for delta, code_id in events[point]:
+            active[code_id] = active.get(code_id, 0) + delta
+            if not active[code_id]:
+                del active[code_id]
+        set_id = set_table.id(active)
+        if not result or result[-1][1] != set_id:
+            result.append((point, set_id))
+    return result
+
+
+def _build_geoip(src, codes, set_table, sections):
+    v4, v6 = [], []
+    for code, cidr in _iter_items(src):
+        ip = b""
+        prefix = 0
+        for field, wire, value in geo_dat.iter_fields(cidr):
+            if field == 1 and wire == geo_dat.WIRE_LEN:
+                ip = bytes(value)
+            elif field == 2 and wire == geo_dat.WIRE_VARINT:
+                prefix = value
+        bits = len(ip) * 8
+        start = int.from_bytes(ip, "big") & ~((1 << (bits - prefix)) - 1) & ((1 << bits) - 1)
+        end = start | ((1 << (bits - prefix)) - 1)
+        (v4 if bits == 32 else v6).append((start, end, codes.setdefault(code, len(codes))))
+
+    v4 = _disjoint_intervals(v4, 32, set_table)
+    v6 = _disjoint_intervals(v6, 128, set_table)
+    sections["v4_keys"] = array("I", (start for start, _ in v4)).tobytes()
+    sections["v4_sets"] = array("I", (set_id for _, set_id in v4)).tobytes()
+    sections["v6_hi"] = array("Q", (start >> 64 for start, _ in v6)).tobytes()
+    sections["v6_lo"] = array("Q", (start & (2**64 - 1) for start, _ in v6)).tobytes()
+    sections["v6_sets"] = array("I", (set_id for _, set_id in v6)).tobytes()
+
+
+def _build_geosite(src, codes, set_table, sections, header):
+    # in-memory trie: node = [children dict, domain codes, full codes]
+    root = [{}, set(), set()]
+    keywords, regexes = {}, {}
+    for code, domain in _iter_items(src):
+        code_id = codes.setdefault(code, len(codes))
+        domain_type, value = 0, ""
+        for field, wire, v in geo_dat.iter_fields(domain):
+            if field == 1 and wire == geo_dat.WIRE_VARINT:
+                domain_type = v
+            elif field == 2 and wire == geo_dat.WIRE_LEN:
+                value = bytes(v).decode()
+        if domain_type == DOMAIN_PLAIN:
+            keywords.setdefault(value.lower(), set()).add(code_id)
+        elif domain_type == DOMAIN_REGEX:
+            regexes.setdefault(value, set()).add(code_id)
+        else:
+            node = root
+            for label in reversed(value.lower().rstrip(".").split(".")):
+                node = node[0].setdefault(label, [{}, set(), set()])
+            node[1 if domain_type == DOMAIN_SUFFIX else 2].add(code_id)
+
+    nodes, edges, labels = bytearray(), bytearray(), bytearray()
+    order = [root]
+    first_edge = {}
+    # breadth-first numbering, children of a node get consecutive edges sorted by label
+    i = 0
+    while i < len(order):
+        node = order[i]
+        first_edge[i] = len(edges) // EDGE.size
+        for label in sorted(node[0], key=lambda l: l.encode()):
+            encoded = label.encode()
+            edges += EDGE.pack(len(labels), len(encoded), len(order))
+            labels += encoded
+            order.append(node[0][label])
+        i += 1
+    for i, node in enumerate(order):
+        nodes += NODE.pack(first_edge[i], len(node[0]), set_table.id(node[1]), set_table.id(node[2]))
+
+    sections["nodes"] = bytes(nodes)
+    sections["edges"] = bytes(edges)
+    sections["labels"] = bytes(labels)
+    header["keywords"] = [[k, set_table.id(v)] for k, v in sorted(keywords.items())]
+    header["regexes"] = [[r, set_table.id(v)] for r, v in sorted(regexes.items())]
+
+
+def build_index(src, dst, kind, source_sha256):
+    """Compile .dat file `src` of given kind ("geoip"/"geosite") into index file `dst`"""
+    codes = {}
+    set_table = _SetTable()
+    sections = {}
+    header = {"version": FORMAT_VERSION, "kind": kind, "source_sha256": source_sha256,
+              "byteorder": sys.byteorder}
+    if kind == "geoip":
+        _build_geoip(src, codes, set_table, sections)
+    elif kind == "geosite":
+        _build_geosite(src, codes, set_table, sections, header)
+    else:
+        raise ValueError(f"Unknown geo file kind {kind!r}")
+    header["codes"] = [code for code, _ in sorted(codes.items(), key=lambda item: item[1])]
+    header["sets"] = [list(s) for s in set_table.sets]
+
+    # section offsets depend on the header length, iterate until it is stable
+    offsets = {}
+    while True:
+        header["sections"] = offsets
+        header_bytes = json.dumps(header, separators=(",", ":")).encode()
+        pos = len(MAGIC) + 4 + len(header_bytes)
+        new_offsets = {}
+        for name, data in sections.items():
+            pos += -pos % 8
+            new_offsets[name] = [pos, len(data)]
+            pos += len(data)
+        if new_offsets == offsets:
+            break
+        offsets = new_offsets
+
+    with open(dst, 'wb') as f:
+        f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+        for name, data in sections.items():
+            f.write(b"\0" * (offsets[name][0] - f.tell()))
+            f.write(data)
+
+
+class GeoIndex:
+    """Read-only memory-mapped index built by build_index()"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a geo index")
+        (header_len,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self._mm[start:start + header_len])
+        if header.get("version") != FORMAT_VERSION or header.get("byteorder") != sys.byteorder:
+            self.close()
+            raise ValueError(f"{path} has incompatible format")
+
+        self.kind = header["kind"]
+        self.source_sha256 = header["source_sha256"]
+        codes = header["codes"]
+        self._sets = [tuple(codes[i] for i in s) for s in header["sets"]]
+        self._view = memoryview(self._mm)
+        self._sections = header["sections"]
+        if self.kind == "geoip":
+            self._v4_keys = self._section("v4_keys").cast("I")
+            self._v4_sets = self._section("v4_sets").cast("I")
+            self._v6_hi = self._section("v6_hi").cast("Q")
+            self._v6_lo = self._section("v6_lo").cast("Q")
+            self._v6_sets = self._section("v6_sets").cast("I")
+        else:
+            self._nodes = self._section("nodes")
+            self._edges = self._section("edges")
+            self._labels = self._section("labels")
+            self._keywords = [(k, self._sets[s]) for k, s in header["keywords"]]
+            self._regexes = [(re.compile(r), self._sets[s]) for r, s in header["regexes"]]
+
+    def _section(self, name):
+        offset, length = self._sections[name]
+        return self._view[offset:offset + length]
+
+    def close(self):
+        for name in ("_v4_keys", "_v4_sets", "_v6_hi", "_v6_lo", "_v6_sets", "_nodes", "_edges", "_labels"):
+            if hasattr(self, name):
+                getattr(self, name).release()
+        if hasattr(self, "_view"):
+            self._view.release()
+        self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def lookup_ip(self, ip):
+        """Return categories whose CIDRs contain `ip` (str or ipaddress object)"""
+        if self.kind != "geoip":
+            return ()
+        ip = ipaddress.ip_address(ip)
+        value = int(ip)
+        if ip.version == 4:
+            i = bisect.bisect_right(self._v4_keys, value) - 1
+            return self._sets[self._v4_sets[i]] if i >= 0 else ()
+
+        hi, lo = value >> 64, value & (2**64 - 1)
+        first = bisect.bisect_left(self._v6_hi, hi)
+        last = bisect.bisect_right(self._v6_hi, hi)
+        k = bisect.bisect_right(self._v6_lo, lo, first, last)
+        i = k - 1 if k > first else first - 1
+        return self._sets[self._v6_sets[i]] if i >= 0 else ()
+
+    def _child(self, node, label):
+        first, count, _, _ = NODE.unpack_from(self._nodes, node * NODE.size)
+        lo, hi = first, first + count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, length, child = EDGE.unpack_from(self._edges, mid * EDGE.size)
+            current = self._labels[offset:offset + length]
+            if current == label:
+                return child
+            if bytes(current) < label:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def lookup_domain(self, domain):
+        """Return categories matching `domain` by suffix, full, keyword or regex rules"""
+        if self.kind != "geosite":
+            return ()
+        domain = domain.lower().rstrip(".")
+        found = set()
+        node = 0
+        labels = domain.split(".")
+        for depth, label in enumerate(reversed(labels), 1):
+            node = self._child(node, label.encode())
+            if node is None:
+                break
+            _, _, domain_set, full_set = NODE.unpack_from(self._nodes, node * NODE.size)
+            found.update(self._sets[domain_set])
+            if depth == len(labels):
+                found.update(self._sets[full_set])
+        for keyword, codes in self._keywords:
+            if keyword in domain:
+                found.update(codes)
+        for regex, codes in self._regexes:
+            if regex.search(domain):
+                found.update(codes)
+        return tuple(sorted(found))
@@ -5,45 +5,167 @@ import sys
 import time
 import random
 import argparse
+import functools
+import hashlib
+import http.client
+import importlib
+import ipaddress
+import json
+import itertools
+import re
+import shlex
+import shutil
+import socket
+import sqlite3
 import tarfile
-import tempfile
 import logging
 from datetime import datetime
-from pathlib import Path
+from pathlib import Path, PurePosixPath
 import signal
 import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import closing, contextmanager
 from typing import Iterator
+from urllib.parse import quote
 
-import docker
-import requests
+import geo_dat
+import geo_index
+from metrics import Metrics
 
 # Configuration
 WORKDIR = Path("/app/geo")     # Persistent volume mounted from host
 APPDIR = Path("/app/bin")      # Target directory in 3x-ui container
 XRAY_CONTAINER_NAME = "3x-ui"  # Docker compose service name
 PROCESS_NAME = "xray-linux"    # Xray process name to signal
+XRAY_RESTART_TIMEOUT = 30      # seconds to wait for xray to come back after the signal
+XRAY_RESTART_POLL = 0.2        # seconds between checks while xray is restarting
+EVENTS_RETRY_SECONDS = 10      # pause before resubscribing to docker events
 
 # Update scheduling
-UPDATE_INTERVAL_HOURS = 18  # base interval in hours
+UPDATE_INTERVAL_HOURS = 18  # base interval in hours, GEO_FILES entries may set their own "interval_hours"
 UPDATE_INTERVAL = UPDATE_INTERVAL_HOURS * 60 * 60  # seconds
 MAX_JITTER_SECONDS = 5 * 60  # add up to 5 minutes random jitter
+RETRY_MIN_SECONDS = 10 * 60      # first retry after a failed download
+RETRY_MAX_SECONDS = 6 * 60 * 60  # retry delay doubles with each failure up to this
+MIN_UPDATE_DELAY = 60            # never loop faster than this
+SCHEDULE_FILENAME = "schedule.json"  # last attempt/success per source, stored in WORKDIR
 
-# Geo file URLs and target filenames
+# HTTP validators (ETag/Last-Modified) of downloaded files, stored in WORKDIR
+META_CACHE_FILENAME = "geo_cache.json"
+# SHA-256 of local files, stored in WORKDIR
+MANIFEST_FILENAME = "manifest.json"
+# SHA-256 of files last seen in the running container instance, stored in WORKDIR
+CONTAINER_STATE_FILENAME = "container_state.json"
+
+# Attempts to resume an interrupted download within one cycle
+DOWNLOAD_ATTEMPTS = 3
+
+# Trimming: push only the geoip/geosite categories used by 3x-ui routing
+GEO_TRIM = os.environ.get('GEO_TRIM', '0') == '1'
+XUI_DB = Path("/etc/x-ui/x-ui.db")     # 3x-ui database, mounted read-only
+TRIM_DIRNAME = "trimmed"               # trimmed copies of geo files, inside WORKDIR
+TRIM_STATE_FILENAME = "trim_state.json"
+# seconds between checks of the xray template for categories missing in the trimmed files
+TRIM_CHECK_INTERVAL = int(os.environ.get('GEO_TRIM_CHECK_INTERVAL', '30'))
+
+# Lookup indexes of geo files (--lookup), inside WORKDIR
+INDEX_DIRNAME = "index"
+
+# Prometheus textfile collector directory, metrics are not written if it is not mounted
+METRICS_DIR = Path(os.environ.get('METRICS_DIR', '/metrics'))
+METRICS_FILENAME = "geo_update.prom"
+
+METRIC_FAMILIES = {
+    "geo_update_phase_seconds": ("summary", "Time spent in update phases: check, download, container_stat, push, xray_restart"),
+    "geo_update_downloaded_bytes_total": ("counter", "Bytes received from geo file sources"),
+    "geo_update_pushed_bytes_total": ("counter", "Bytes of tar archives sent to the xray container"),
+    "geo_update_cache_total": ("counter", "Cache lookups by cache (http, manifest, container) and result (hit, miss)"),
+    "geo_update_cycles_total": ("counter", "Update cycles by result: updated, unchanged, failed"),
+    "geo_update_last_success_timestamp_seconds": ("gauge", "Time of the last successful update cycle"),
+    "geo_update_source_last_success_timestamp_seconds": ("gauge", "Time of the last successful check of a source"),
+    "geo_update_xray_outage_seconds": ("gauge", "Duration of the last xray restart"),
+    "geo_update_mirror_failovers_total": ("counter", "Downloads that failed on a mirror and moved on to the next one"),
+    "geo_update_target_pushes_total": ("counter", "Update cycles per push target by result: updated, unchanged, failed"),
+}
+
+# Mirrors: each GEO_FILES entry may list "mirrors" (urls or {"url", "sha256_url"}) after its own url.
+# The fastest healthy mirror is tried first, by scores kept in WORKDIR. The mirror the local file
+# came from stays first until it fails or another one is clearly faster: mirrors lag behind each
+# other, and switching loses the conditional GET of the mirror.
+MIRROR_STATE_FILENAME = "mirrors.json"
+MIRROR_PROBE_TIMEOUT = 5              # seconds, HEAD probe of a mirror without a fresh score
+MIRROR_PROBE_INTERVAL = 24 * 60 * 60  # re-probe latency of mirrors not used for this long
+MIRROR_RETRY_SECONDS = 10 * 60        # a failed mirror is tried first again after this, doubling per failure
+MIRROR_SCORE_ALPHA = 0.3              # weight of the newest sample in the rolling latency/throughput
+MIRROR_MIN_SAMPLE_BYTES = 256 * 1024  # smaller downloads say nothing about throughput
+MIRROR_SWITCH_RATIO = 0.5             # switch to a mirror expected to take at most this part of the time
+MIRROR_SWITCH_SECONDS = 1.0           # and to save at least this many seconds
+
+# Sources can be replaced by a JSON list shaped like GEO_FILES: inline or a path to a file
+GEO_SOURCES = os.environ.get('GEO_SOURCES', '')
+
+# Push targets: "[docker host#]container" entries separated by commas, e.g.
+# "unix:///var/run/docker.sock#3x-ui, ssh://root@node2#3x-ui, tcp://10.0.0.3:2375".
+# Empty: only XRAY_CONTAINER_NAME on the local docker (DOCKER_HOST or the mounted socket).
+XRAY_TARGETS = os.environ.get('XRAY_TARGETS', '')
+TARGET_WORKERS = max(1, int(os.environ.get('GEO_TARGET_WORKERS', '4')))  # targets pushed to in parallel
+RESTART_STAGGER_SECONDS = int(os.environ.get('GEO_RESTART_STAGGER', '30'))  # pause between xray restarts of targets
+
+# Delivery of geo files to xray: "docker" copies them into the container through the Docker API,
+# "shared" publishes them to SHARED_DIRNAME in WORKDIR, mounted into 3x-ui at SHARED_MOUNT, and
+# links APPDIR files there once per container instance; Docker is then used only to restart xray.
+GEO_DELIVERY = os.environ.get('GEO_DELIVERY', 'docker')
+SHARED_DIRNAME = "shared"
+SHARED_MOUNT = PurePosixPath(os.environ.get('GEO_SHARED_MOUNT', '/app/geo-shared'))
+SHARED_MANIFEST = "sha256.json"   # {filename: sha256} of a published version
+SHARED_KEEP_VERSIONS = 2          # the current version and the one before it
+
+# Profiling: GEO_PROFILE=1 runs every cycle under cProfile and tracemalloc, which slows it down
+# several times; for diagnosing slow or memory-hungry cycles only
+GEO_PROFILE = os.environ.get('GEO_PROFILE', '0') == '1'
+PROFILE_DIRNAME = "profiles"  # inside WORKDIR: cycle-<time>.prof (pstats) and cycle-<time>.alloc.txt
+PROFILE_KEEP = max(1, int(os.environ.get('GEO_PROFILE_KEEP', '10')))  # profiles of this many last cycles
+PROFILE_TOP = 15              # hot functions and allocation sites in the summary
+TRACEMALLOC_FRAMES = 10
+
+# Exit codes of --once: one cycle for a systemd timer or cron instead of the resident loop
+EXIT_UNCHANGED = 0
+EXIT_FAILED = 1
+EXIT_UPDATED = 3
+DOCKER_API_TIMEOUT = 10  # seconds, inspect over the docker socket in the --once cache check
+
+# Number of geo files downloaded in parallel
+DOWNLOAD_WORKERS = max(1, int(os.environ.get('GEO_DOWNLOAD_WORKERS', '4')))
+
+# HTTP: one keep-alive session for all requests, GET/HEAD are retried with exponential backoff
+# on connection errors and on 429/5xx responses (honouring Retry-After)
+HTTP_CONNECT_TIMEOUT = 10   # seconds to establish a connection
+HTTP_READ_TIMEOUT = 30      # seconds without a byte from the server
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5          # seconds before the first retry, doubles with each one
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+HTTP_POOL_HOSTS = 10        # hosts with pooled connections: sources, mirrors and their redirect targets
+
+# Geo file URLs, optional published checksums and target filenames
 GEO_FILES = [
     {
         "url": "https://github.com/Loyalsoldier/v2ray-rules-dat/releases/latest/download/geoip.dat",
+        "sha256_url": "https://github.com/Loyalsoldier/v2ray-rules-dat/releases/latest/download/geoip.dat.sha256sum",
         "filename": "geoip.dat"
     },
     {
         "url": "https://github.com/Loyalsoldier/v2ray-rules-dat/releases/latest/download/geosite.dat",
+        "sha256_url": "https://github.com/Loyalsoldier/v2ray-rules-dat/releases/latest/download/geosite.dat.sha256sum",
         "filename": "geosite.dat"
     },
     {
         "url": "https://github.com/runetfreedom/russia-v2ray-rules-dat/releases/latest/download/geoip.dat",
+        "sha256_url": "https://github.com/runetfreedom/russia-v2ray-rules-dat/releases/latest/download/geoip.dat.sha256sum",
         "filename": "geoip_RU.dat"
     },
     {
         "url": "https://github.com/runetfreedom/russia-v2ray-rules-dat/releases/latest/download/geosite.dat",
+        "sha256_url": "https://github.com/runetfreedom/russia-v2ray-rules-dat/releases/latest/download/geosite.dat.sha256sum",
         "filename": "geosite_RU.dat"
     }
 ]
@@ -55,7 +177,51 @@ logger = logging.getLogger(__name__)
 logger.setLevel(numeric_level)
 
 log = logger
+
+
+class LazyModule:
+    """Module imported on first attribute access. docker and requests add tens of MB of RSS,
+    a --once run that finds nothing to do never loads them."""
+
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+docker = LazyModule("docker")
+requests = LazyModule("requests")
+
 docker_client = None
+xray_container = None  # long-lived handle, see get_xray_container()
+targets = []  # parsed XRAY_TARGETS, see get_targets()
+metrics = Metrics(METRIC_FAMILIES)
+
+def load_geo_files(value):
+    """Parse GEO_SOURCES: inline JSON list or path to a JSON file, entries shaped like GEO_FILES"""
+    text = value if value.lstrip().startswith("[") else Path(value).read_text()
+    geo_files = json.loads(text)
+    if not isinstance(geo_files, list) or not geo_files:
+        raise ValueError("GEO_SOURCES must be a non-empty JSON list")
+    for geo_file in geo_files:
+        if not isinstance(geo_file, dict) or not geo_file.get("filename") or not geo_file.get("url"):
+            raise ValueError(f"GEO_SOURCES entry needs 'filename' and 'url': {geo_file!r}")
+        if PurePosixPath(geo_file["filename"]).name != geo_file["filename"]:
+            raise ValueError(f"GEO_SOURCES filename must not contain a path: {geo_file['filename']!r}")
+    return geo_files
+
+
+def source_mirrors(geo_file):
+    """Return [{"url", "sha256_url"}] of a GEO_FILES entry: its own url first, then "mirrors" """
+    mirrors = [{"url": geo_file["url"], "sha256_url": geo_file.get("sha256_url")}]
+    for mirror in geo_file.get("mirrors", []):
+        if isinstance(mirror, str):
+            mirror = {"url": mirror}
+        if all(mirror["url"] != m["url"] for m in mirrors):
+            mirrors.append({"url": mirror["url"], "sha256_url": mirror.get("sha256_url")})
+    return mirrors
+
 
 def iter_geo_files() -> Iterator[tuple[str, str]]:
     """Generator yielding (url, filename) tuples from GEO_FILES."""
@@ -63,9 +229,51 @@ def iter_geo_files() -> Iterator[tuple[str, str]]:
         yield geo_file["url"], geo_file["filename"]
 
 
+def http_session():
+    """Shared requests session with per-host connection pools and the retry policy"""
+    global _http_session
+    with _http_lock:
+        if _http_session is None:
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=HTTP_RETRIES, backoff_factor=HTTP_BACKOFF, status_forcelist=HTTP_RETRY_STATUSES,
+                          allowed_methods=frozenset({"GET", "HEAD"}), raise_on_status=False)
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=DOWNLOAD_WORKERS, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _http_session = session
+        return _http_session
+
+
+def http_request(method, url, timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), **kwargs):
+    """Request url through the shared session following redirects. A redirect resolved earlier
+    in the cycle is followed directly; if its target fails (signed release URLs expire),
+    the original url is asked again."""
+    target = _redirects.get(url)
+    if target:
+        response = http_session().request(method, target, allow_redirects=True, timeout=timeout, **kwargs)
+        if response.status_code < 400:
+            return response
+        response.close()
+        _redirects.pop(url, None)
+    response = http_session().request(method, url, allow_redirects=True, timeout=timeout, **kwargs)
+    if response.history and response.status_code < 400:
+        _redirects[url] = response.url
+    return response
+
+
+def http_get(url, **kwargs):
+    return http_request("GET", url, **kwargs)
+
+
+def http_head(url, **kwargs):
+    return http_request("HEAD", url, **kwargs)
+
+
 def get_url_size(url):
     """Get file size from URL using HTTP HEAD request"""
-    response = requests.head(url, allow_redirects=True, timeout=30)
+    response = http_head(url)
     response.raise_for_status()
     content_length = response.headers.get('Content-Length')
     if not content_length:
@@ -80,115 +288,1201 @@ def get_file_size(filepath):
     return 0
 
 
+def read_json(path, default):
+    """Read JSON state file, return `default` if it is missing or broken"""
+    try:
+        return json.loads(path.read_text())
+    except FileNotFoundError:
+        return default
+    except (OSError, ValueError) as e:
+        log.warning(f"Ignoring unreadable {path.name}: {e}")
+        return default
+
+
+def write_json(path, data):
+    """Atomically write JSON state file"""
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_text(json.dumps(data, indent=2, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+# Guards read-modify-write of the JSON state files in WORKDIR
+_state_lock = threading.Lock()
+
+_http_lock = threading.Lock()
+_http_session = None  # see http_session()
+_redirects = {}       # url -> final url of its redirect chain, cleared every cycle
+
+
+def get_source_meta(url, local_file):
+    """Return cached HTTP metadata of a downloaded file from mirror `url`, or {} if it is unusable.
+    Every mirror has its own metadata, valid only while the local file is what that mirror served."""
+    with _state_lock:
+        entry = read_json(WORKDIR / META_CACHE_FILENAME, {}).get(local_file.name, {}).get(url, {})
+    if entry.get("size") != get_file_size(local_file) or entry.get("sha256") != get_local_sha256(local_file):
+        return {}
+    return entry
+
+
+def current_mirror(local_file):
+    """Url of the mirror the local file was last downloaded from, None if unknown"""
+    with _state_lock:
+        entries = read_json(WORKDIR / META_CACHE_FILENAME, {}).get(local_file.name, {})
+    urls = sorted((entry.get("saved", 0), url) for url, entry in entries.items() if isinstance(entry, dict))
+    for _, url in reversed(urls):
+        if get_source_meta(url, local_file):
+            return url
+    return None
+
+
+def update_meta_cache(key, entry):
+    """Set or remove (entry=None) one record of the download metadata cache"""
+    try:
+        with _state_lock:
+            path = WORKDIR / META_CACHE_FILENAME
+            cache = read_json(path, {})
+            if entry is None:
+                if cache.pop(key, None) is None:
+                    return
+            else:
+                cache[key] = entry
+            write_json(path, cache)
+    except OSError as e:
+        log.warning(f"Cannot save download metadata for {key}: {e}")
+
+
+def save_source_meta(url, local_file, response, sha256):
+    """Remember validators and final redirect url of a file downloaded from mirror `url`"""
+    try:
+        with _state_lock:
+            path = WORKDIR / META_CACHE_FILENAME
+            cache = read_json(path, {})
+            entries = cache.get(local_file.name)
+            if not isinstance(entries, dict) or "url" in entries:
+                entries = cache[local_file.name] = {}  # one entry per file before mirrors had their own
+            entries[url] = {
+                "final_url": response.url,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "size": get_file_size(local_file),
+                "sha256": sha256,
+                "saved": time.time(),
+            }
+            write_json(path, cache)
+    except OSError as e:
+        log.warning(f"Cannot save download metadata for {local_file.name}: {e}")
+
+
+def part_path(filepath):
+    """Partially downloaded file, renamed to `filepath` when complete"""
+    return filepath.with_name(filepath.name + ".part")
+
+
+def get_part_validator(url, part):
+    """Return If-Range validator of a partial download from the same url, or None"""
+    with _state_lock:
+        entry = read_json(WORKDIR / META_CACHE_FILENAME, {}).get(part.name, {})
+    if entry.get("url") != url:
+        return None
+    return entry.get("validator")
+
+
+def save_part_validator(url, part, response):
+    """Remember what a partial download can be resumed against: a strong ETag or Last-Modified"""
+    etag = response.headers.get("ETag")
+    validator = etag if etag and not etag.startswith("W/") else response.headers.get("Last-Modified")
+    update_meta_cache(part.name, {"url": url, "validator": validator} if validator else None)
+
+
+def conditional_headers(meta):
+    """Build If-None-Match/If-Modified-Since headers from cached metadata"""
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
+
 def need_download(url, local_file):
-    """Check if file needs to be downloaded by comparing sizes"""
+    """Check if file needs to be downloaded.
+    When validators are cached the conditional GET in download_file() decides,
+    otherwise fall back to comparing sizes with HTTP HEAD."""
     if not local_file.exists():
         log.info(f"{local_file.name} has not been downloaded yet")
         return True
-    latest_size = get_url_size(url)
+    if conditional_headers(get_source_meta(url, local_file)):
+        return True
+
+    with metrics.timer("geo_update_phase_seconds", phase="check"):
+        start = time.monotonic()
+        latest_size = get_url_size(url)
+    record_mirror(url, latency=time.monotonic() - start)
     existing_size = get_file_size(local_file)
 
     if latest_size != existing_size:
         log.info(f"{local_file.name} size has changed, '{latest_size}' != '{existing_size}'")
+        metrics.inc("geo_update_cache_total", cache="http", result="miss")
         return True
+    metrics.inc("geo_update_cache_total", cache="http", result="hit")
     return False
 
 
-def download_file(url, filepath):
-    """Download file from URL"""
-    log.info(f"Downloading {filepath.name} from {url}")
-    response = requests.get(url, allow_redirects=True, timeout=20, stream=True)
+def sha256_file(filepath):
+    """Compute SHA-256 of a local file"""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def manifest_key(local_file):
+    """Manifest key of a file: path relative to WORKDIR"""
+    try:
+        return str(local_file.relative_to(WORKDIR))
+    except ValueError:
+        return local_file.name
+
+
+def save_manifest_entry(local_file, sha256, stats=None):
+    """Record SHA-256 of a local file together with its size, mtime and optional content stats"""
+    st = local_file.stat()
+    entry = {"sha256": sha256, "size": st.st_size, "mtime_ns": st.st_mtime_ns, **(stats or {})}
+    try:
+        with _state_lock:
+            path = WORKDIR / MANIFEST_FILENAME
+            manifest = read_json(path, {})
+            manifest[manifest_key(local_file)] = entry
+            write_json(path, manifest)
+    except OSError as e:
+        log.warning(f"Cannot save manifest entry for {local_file.name}: {e}")
+
+
+def get_local_sha256(local_file):
+    """Return SHA-256 of a local file, or None if it is missing.
+    The manifest value is used while the file size and mtime are unchanged."""
+    if not local_file.exists():
+        return None
+    with _state_lock:
+        entry = read_json(WORKDIR / MANIFEST_FILENAME, {}).get(manifest_key(local_file), {})
+    st = local_file.stat()
+    if entry.get("size") == st.st_size and entry.get("mtime_ns") == st.st_mtime_ns:
+        metrics.inc("geo_update_cache_total", cache="manifest", result="hit")
+        return entry["sha256"]
+
+    metrics.inc("geo_update_cache_total", cache="manifest", result="miss")
+    log.debug(f"Hashing {local_file.name}, manifest entry is missing or stale")
+    sha256 = sha256_file(local_file)
+    save_manifest_entry(local_file, sha256)
+    return sha256
+
+
+def get_upstream_sha256(sha256_url):
+    """Get checksum published next to a release file, or None if there is none"""
+    response = http_get(sha256_url)
+    if response.status_code == 404:
+        log.debug(f"No published checksum at {sha256_url}")
+        return None
+    response.raise_for_status()
+    # sha256sum format: "<hex digest>  <filename>"
+    return response.text.split()[0].lower()
+
+
+def download_to_part(url, filepath, part):
+    """Stream url into the `part` file, resuming it with a Range request when the server allows.
+    Return (response, sha256 of the whole part) or (None, None) if the local file is not modified."""
+    meta = get_source_meta(url, filepath) if filepath.exists() else {}
+    headers = conditional_headers(meta)
+
+    offset = get_file_size(part)
+    validator = get_part_validator(url, part) if offset else None
+    if validator:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+
+    with metrics.timer("geo_update_phase_seconds", phase="check"):
+        start = time.monotonic()
+        response = http_get(url, stream=True, headers=headers)
+        latency = time.monotonic() - start
+    if response.status_code == 304:
+        response.close()
+        part.unlink(missing_ok=True)
+        log.info(f"{filepath.name} is not modified ({meta.get('final_url')})")
+        metrics.inc("geo_update_cache_total", cache="http", result="hit")
+        record_mirror(url, latency=latency)
+        return None, None
+    if response.status_code == 416:
+        # the part does not fit the current file, start over
+        response.close()
+        part.unlink(missing_ok=True)
+        return download_to_part(url, filepath, part)
     response.raise_for_status()
+    if meta:
+        metrics.inc("geo_update_cache_total", cache="http", result="miss")
 
-    with open(filepath, 'wb') as f:
+    digest = hashlib.sha256()
+    resumed = validator and response.status_code == 206 and \
+        response.headers.get("Content-Range", "").startswith(f"bytes {offset}-")
+    if resumed:
+        log.info(f"Resuming {filepath.name} from byte {offset}")
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                digest.update(chunk)
+    save_part_validator(url, part, response)
+
+    received = 0
+    start = time.monotonic()
+    with metrics.timer("geo_update_phase_seconds", phase="download"), open(part, 'ab' if resumed else 'wb') as f:
         for chunk in response.iter_content(chunk_size=1024*1024):
+            digest.update(chunk)
             f.write(chunk)
+            received += len(chunk)
+            metrics.inc("geo_update_downloaded_bytes_total", len(chunk), file=filepath.name)
+        elapsed = time.monotonic() - start
+        f.flush()
+        os.fsync(f.fileno())
+    throughput = received / elapsed if received >= MIRROR_MIN_SAMPLE_BYTES and elapsed > 0 else None
+    record_mirror(url, latency=latency, throughput=throughput)
+    return response, digest.hexdigest()
+
+
+def download_file(url, filepath, sha256_url=None):
+    """Download file from URL with a conditional GET, hashing it on the fly.
+    Data goes to a .part file that is resumed after a dropped connection and
+    renamed to `filepath` only when complete and verified.
+    Return False if the server says the local copy is not modified."""
+    part = part_path(filepath)
+    log.info(f"Downloading {filepath.name} from {url}")
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        before = part.stat().st_mtime_ns if part.exists() else None
+        try:
+            response, sha256 = download_to_part(url, filepath, part)
+            break
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            # only a transfer that started is resumed here, the session already retried connecting
+            started = isinstance(e, requests.exceptions.ChunkedEncodingError) or \
+                (part.exists() and part.stat().st_mtime_ns != before)
+            if attempt == DOWNLOAD_ATTEMPTS or not started:
+                raise
+            log.warning(f"Download of {filepath.name} interrupted ({e}), {get_file_size(part)} bytes kept, retrying")
 
-    if get_file_size(filepath) == 0:
+    if response is None:
+        return False
+
+    if get_file_size(part) == 0:
+        part.unlink(missing_ok=True)
         raise RuntimeError(f"Downloaded file {filepath.name} is empty")
 
-    log.debug(f"Downloaded {filepath.name} ({get_file_size(filepath)} bytes)")
+    if sha256_url:
+        expected = get_upstream_sha256(sha256_url)
+        if expected and expected != sha256:
+            part.unlink()
+            raise RuntimeError(f"Checksum mismatch for {filepath.name}: {sha256} != published {expected}")
+
+    try:
+        stats = geo_dat.validate_dat(part, geo_dat.dat_kind(filepath.name))
+    except geo_dat.DatFormatError as e:
+        part.unlink()
+        raise RuntimeError(f"Downloaded file {filepath.name} is not a valid geo file: {e}")
+
+    os.replace(part, filepath)
+    fsync_dir(filepath.parent)
+    update_meta_cache(part.name, None)
+
+    log.info(f"Downloaded {filepath.name}: {stats['entries']} categories, {stats['items']} items")
+    log.debug(f"Downloaded {filepath.name} ({get_file_size(filepath)} bytes, sha256 {sha256}) from {response.url}")
+    save_manifest_entry(filepath, sha256, stats)
+    save_source_meta(url, filepath, response, sha256)
+    return True
 
 
-def copy_file_to_container(container, local_file, remote_path):
-    """Copy file to container using Docker API"""
-    target_dir = os.path.dirname(remote_path)
-    tar_path = None
+def fsync_dir(path):
+    """Make a rename in the directory durable"""
+    fd = os.open(path, os.O_RDONLY)
     try:
-        # Create tar archive        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.tar') as tar_file:
-            tar_path = tar_file.name
-            with tarfile.open(name=tar_path, mode='w') as tar:
-                tar.add(local_file, arcname=os.path.basename(remote_path))
-
-        # Put the archive into container
-        with open(tar_path, 'rb') as f:
-            container.exec_run(f"mkdir -p {target_dir}", user="root")
-            result = container.put_archive(target_dir, f)
-            if not result:
-                raise RuntimeError(f"Failed to copy to container: {local_file.name}")
-            log.debug(f"Copied {local_file.name} to {remote_path} in container")
+        os.fsync(fd)
     finally:
-        try:
-            if tar_path:
-                os.unlink(tar_path)
-        except Exception:
-            pass
+        os.close(fd)
+
+
+def tar_stream(files, chunk_size=1024*1024):
+    """Generate an uncompressed tar archive of (local_file, remote_path) pairs chunk by chunk,
+    without temp files. Parent directories are included so that the archive can be put into "/"."""
+    added_dirs = set()
+    for local_file, remote_path in files:
+        remote_path = PurePosixPath(remote_path)
+        for parent in reversed(remote_path.parents[:-1]):
+            name = str(parent.relative_to("/"))
+            if name not in added_dirs:
+                added_dirs.add(name)
+                info = tarfile.TarInfo(name)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = int(time.time())
+                yield info.tobuf(tarfile.GNU_FORMAT)
+
+        with open(local_file, 'rb') as f:
+            st = os.fstat(f.fileno())
+            info = tarfile.TarInfo(str(remote_path.relative_to("/")))
+            info.size = st.st_size
+            info.mode = 0o644
+            info.mtime = int(st.st_mtime)
+            yield info.tobuf(tarfile.GNU_FORMAT)
+
+            remaining = info.size
+            while remaining:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    raise RuntimeError(f"{local_file.name} was truncated while copying")
+                remaining -= len(chunk)
+                yield chunk
+
+        padding = -info.size % tarfile.BLOCKSIZE
+        if padding:
+            yield tarfile.NUL * padding
+
+    # end of archive: two zero blocks
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def staged_path(remote_path):
+    """Temporary name next to the target, files are uploaded there before the swap"""
+    remote_path = PurePosixPath(remote_path)
+    return remote_path.with_name(f".{remote_path.name}.new")
+
+
+def count_pushed_bytes(stream):
+    """Pass archive chunks through, counting them in metrics"""
+    for chunk in stream:
+        metrics.inc("geo_update_pushed_bytes_total", len(chunk))
+        yield chunk
+
+
+def copy_files_to_container(container, files):
+    """Copy (local_file, remote_path) pairs to container in one streamed tar archive.
+    `files` may be a lazy iterable, entries are sent as they are produced.
+    Files are uploaded under temporary names and renamed into place together after the upload,
+    so xray never sees a partially written file.
+    Return the list of copied local files."""
+    copied = []
+
+    def stage(files):
+        for local_file, remote_path in files:
+            copied.append((local_file, PurePosixPath(remote_path)))
+            yield local_file, staged_path(remote_path)
+
+    with metrics.timer("geo_update_phase_seconds", phase="push"):
+        result = container.put_archive("/", count_pushed_bytes(tar_stream(stage(files))))
+        names = ', '.join(local_file.name for local_file, _ in copied)
+        if not result:
+            raise RuntimeError(f"Failed to copy to container: {names}")
+
+        swap = " && ".join(f"mv -f {shlex.quote(str(staged_path(remote_path)))} {shlex.quote(str(remote_path))}"
+                           for _, remote_path in copied)
+        r = container.exec_run(["sh", "-c", swap], user="root")
+        if r.exit_code != 0:
+            raise RuntimeError(f"Failed to move {names} into place: {r.output.decode()}")
+
+    log.debug(f"Copied {names} to container")
+    return [local_file for local_file, _ in copied]
+
+
+def get_xray_pids(container):
+    """Return set of running xray process ids in container"""
+    r = container.exec_run(["pgrep", PROCESS_NAME], user="root")
+    if r.exit_code != 0:
+        return set()
+    return set(r.output.decode().split())
+
+
+def wait_for_xray(container, old_pids=frozenset(), since=None):
+    """Wait until an xray process other than `old_pids` runs in container.
+    Return seconds passed since `since` (time.monotonic(), default now)."""
+    since = time.monotonic() if since is None else since
+    while time.monotonic() - since < XRAY_RESTART_TIMEOUT:
+        if get_xray_pids(container) - old_pids:
+            return time.monotonic() - since
+        time.sleep(XRAY_RESTART_POLL)
+
+    raise RuntimeError(f"{PROCESS_NAME} is not running in {XRAY_RESTART_TIMEOUT} sec")
 
 
 def restart_xray(container):
-    """Restart xray process by sending SIGTERM"""
-    
-    r = container.exec_run(f"sh -c 'kill $(pgrep {PROCESS_NAME})'", user="root")
+    """Restart xray process by sending SIGTERM and wait until it is running again.
+    Return the outage duration in seconds, or None if xray is not running: it loads the files when it starts."""
+
+    r = container.exec_run(["sh", "-c", f"pids=$(pgrep {PROCESS_NAME}) || exit 3; kill $pids && echo $pids"],
+                           user="root")
+    signaled_at = time.monotonic()
+    if r.exit_code == 3:
+        log.warning(f"{PROCESS_NAME} is not running, nothing to restart")
+        return None
     if not r.exit_code == 0:
         raise RuntimeError(f"Error sending restart signal to {PROCESS_NAME}: {r.output.decode()}")
-    else:
-        log.info(f"Signaled {PROCESS_NAME} to restart")
+    log.info(f"Signaled {PROCESS_NAME} to restart")
 
-def get_container_file_size(container, path):
-    """Return file size in bytes for a path inside container, or 0 if missing."""
-    cmd = f"stat -c %s {path}"
-    r = container.exec_run(cmd, user="root")
-    if r.exit_code != 0:
-        return 0
-    out = r.output.decode().strip()
-    return int(out)
+    outage = wait_for_xray(container, set(r.output.decode().split()), signaled_at)
+    log.info(f"{PROCESS_NAME} is running again, outage {outage:.2f} sec")
+    metrics.set("geo_update_xray_outage_seconds", outage)
+    return outage
 
 
-def geo_update():
-    """Main update function: find container by name, download and copy files."""
+def get_container_hashes(container, paths):
+    """Return {path: sha256} for files inside container with one exec; missing files are omitted."""
+    r = container.exec_run(["sha256sum", *map(str, paths)], user="root")
+    # exit code is non-zero if some files are missing, the rest are still listed
+    hashes = {}
+    for line in r.output.decode(errors="replace").splitlines():
+        digest, sep, path = line.partition("  ")
+        if sep and len(digest) == 64:
+            hashes[path] = digest
+    return hashes
 
-    for url, filename in iter_geo_files():
-        local_file = WORKDIR / filename
-        if need_download(url, local_file):
-            download_file(url, local_file)
+
+def get_container_instance(container):
+    """Identify a running container instance: recreating or restarting the container changes it"""
+    return f"{container.id}@{container.attrs['State']['StartedAt']}"
+
+
+def container_state_path(target_name=None):
+    """State file of a push target, the default target keeps CONTAINER_STATE_FILENAME"""
+    if target_name is None:
+        return WORKDIR / CONTAINER_STATE_FILENAME
+    safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', target_name)
+    return WORKDIR / f"container_state.{safe_name}.json"
+
+
+def load_container_hashes(container, paths, target_name=None):
+    """Return {path: sha256} of files inside container.
+    While the same container instance is running, the hashes recorded after the last cycle
+    are used and no exec is needed; a new instance is listed with one sha256sum exec."""
+    state = read_json(container_state_path(target_name), {})
+    if state.get("instance") == get_container_instance(container) and "files" in state:
+        log.debug(f"Container {container.name} is the same instance, using recorded file hashes")
+        metrics.inc("geo_update_cache_total", cache="container", result="hit")
+        return state["files"]
+
+    log.info(f"Checking geo files in new container instance {container.name}")
+    metrics.inc("geo_update_cache_total", cache="container", result="miss")
+    with metrics.timer("geo_update_phase_seconds", phase="container_stat"):
+        return get_container_hashes(container, paths)
+
+
+def save_container_hashes(container, hashes, target_name=None):
+    """Record file hashes of the running container instance, or forget them if `hashes` is None"""
+    path = container_state_path(target_name)
+    try:
+        if hashes is None:
+            path.unlink(missing_ok=True)
         else:
-            log.info(f"{filename} is up-to-date ({local_file})")
+            write_json(path, {"instance": get_container_instance(container), "files": hashes})
+    except OSError as e:
+        log.warning(f"Cannot save container state: {e}")
 
-    copied_any = False
-    container = get_container(XRAY_CONTAINER_NAME)
 
-    # Always check all files to handle the case when some files were downloaded but 
-    # not copied for some reason (e.g. xray container was stopped)
-    for url, filename in iter_geo_files():
-        local_file = WORKDIR / filename
-        local_size = get_file_size(local_file)
-        
-        container_file = APPDIR / filename;
-        container_size = get_container_file_size(container, container_file)
-        
-        if local_size != container_size:
-            log.info(f"Copy {filename} to container. sizes: local={local_size} container={container_size}")
-            copy_file_to_container(container, local_file, container_file)
-            copied_any = True
+# geoip:cn, geosite:!google@ads, ext:geosite_RU.dat:ru-blocked, ext-ip:geoip_RU.dat:ru
+GEO_TAG_RE = re.compile(r'^(geoip|geosite):!?([^@]+)')
+EXT_TAG_RE = re.compile(r'^ext(?:-ip|-domain)?:([^:]+):!?([^@]+)')
+
+
+def iter_config_strings(node):
+    """Yield all string values of a parsed JSON document"""
+    if isinstance(node, str):
+        yield node
+    elif isinstance(node, dict):
+        for value in node.values():
+            yield from iter_config_strings(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from iter_config_strings(value)
+
+
+def get_used_geo_codes(config):
+    """Collect geoip/geosite categories referenced by xray config, as {filename: {CODE, ...}}"""
+    used = {}
+    for value in iter_config_strings(config):
+        value = value.strip()
+        if m := GEO_TAG_RE.match(value):
+            filename, code = f"{m.group(1)}.dat", m.group(2)
+        elif m := EXT_TAG_RE.match(value):
+            filename, code = m.group(1), m.group(2)
         else:
-            log.debug(f"{filename} in container is up-to-date (size {local_size})")
+            continue
+        used.setdefault(filename, set()).add(code.upper())
+    return used
+
+
+def load_xray_template():
+    """Read xray config template from the 3x-ui database, None if it is not available"""
+    try:
+        with closing(sqlite3.connect(f"file:{XUI_DB}?mode=ro", uri=True)) as db:
+            row = db.execute("SELECT value FROM settings WHERE key = 'xrayTemplateConfig'").fetchone()
+    except sqlite3.Error as e:
+        log.warning(f"Cannot read xray template from {XUI_DB}: {e}")
+        return None
+    if not row:
+        log.info("3x-ui uses built-in xray template, routing rules are unknown")
+        return None
+    try:
+        return json.loads(row[0])
+    except ValueError as e:
+        log.warning(f"Broken xray template in {XUI_DB}: {e}")
+        return None
+
+
+def get_trim_codes():
+    """Return categories to keep per geo file, or None when files must not be trimmed"""
+    if not GEO_TRIM:
+        return None
+    config = load_xray_template()
+    if config is None:
+        log.warning("Geo files are not trimmed")
+        return None
+    return get_used_geo_codes(config)
+
+
+def template_signature():
+    """mtime and size of the 3x-ui database with its WAL, to re-read the template only when they change"""
+    signature = []
+    for path in (XUI_DB, XUI_DB.with_name(XUI_DB.name + "-wal")):
+        try:
+            stat = path.stat()
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+
+def get_missing_codes(codes, trimmed_codes):
+    """Return {filename: {CODE, ...}} of categories used in `codes` but left out of the files
+    trimmed with `trimmed_codes`; files that were not trimmed have everything"""
+    missing = {filename: used - set(trimmed_codes[filename]) for filename, used in codes.items()
+               if filename in trimmed_codes}
+    return {filename: used for filename, used in missing.items() if used}
+
+
+def load_trimmed_codes():
+    """Return {filename: [CODE, ...]} the trimmed copies in WORKDIR were made with"""
+    with _state_lock:
+        state = read_json(WORKDIR / TRIM_STATE_FILENAME, {})
+    return {filename: entry["codes"] for filename, entry in state.items()}
+
+
+def trim_geo_file(local_file, codes):
+    """Write a copy of local_file with only `codes` categories to WORKDIR/trimmed, return its path.
+    Nothing is done when the source file and the codes are the same as for the existing copy."""
+    trimmed = WORKDIR / TRIM_DIRNAME / local_file.name
+    wanted = {"source_sha256": get_local_sha256(local_file), "codes": sorted(codes)}
+    state_path = WORKDIR / TRIM_STATE_FILENAME
+    with _state_lock:
+        state = read_json(state_path, {})
+    if trimmed.exists() and state.get(local_file.name) == wanted:
+        return trimmed
+
+    trimmed.parent.mkdir(exist_ok=True)
+    tmp_path = trimmed.with_name(trimmed.name + ".tmp")
+    kept, total = geo_dat.trim_dat(local_file, tmp_path, codes)
+    os.replace(tmp_path, trimmed)
+    log.info(f"Trimmed {local_file.name}: {len(kept)} of {total} categories, "
+             f"{get_file_size(local_file)} -> {get_file_size(trimmed)} bytes")
+    if missing := set(codes) - kept:
+        log.warning(f"{local_file.name} has no categories {', '.join(sorted(missing))} used in routing")
+
+    with _state_lock:
+        state = read_json(state_path, {})
+        state[local_file.name] = wanted
+        write_json(state_path, state)
+    return trimmed
+
+
+def source_interval(geo_file):
+    """Update interval of a GEO_FILES entry in seconds"""
+    if "interval_hours" in geo_file:
+        return int(geo_file["interval_hours"] * 60 * 60)
+    return UPDATE_INTERVAL
+
+
+def get_next_due(geo_file, schedule):
+    """Return time.time() when the source should be checked next: after its interval since
+    the last success, or with exponential backoff after failed attempts"""
+    entry = schedule.get(geo_file["filename"], {})
+    failures = entry.get("failures", 0)
+    if failures:
+        return entry["last_attempt"] + min(RETRY_MAX_SECONDS, RETRY_MIN_SECONDS * 2 ** (failures - 1))
+    return entry.get("last_success", 0) + source_interval(geo_file)
+
+
+def get_due_sources(now=None):
+    """Return filenames of GEO_FILES entries that should be downloaded now"""
+    now = time.time() if now is None else now
+    with _state_lock:
+        schedule = read_json(WORKDIR / SCHEDULE_FILENAME, {})
+    return {f["filename"] for f in GEO_FILES if get_next_due(f, schedule) <= now}
 
-    if copied_any:
-        restart_xray(container)
+
+def record_source_attempt(filename, ok):
+    """Persist result of a download attempt of one source"""
+    now = time.time()
+    try:
+        with _state_lock:
+            path = WORKDIR / SCHEDULE_FILENAME
+            schedule = read_json(path, {})
+            entry = schedule.setdefault(filename, {})
+            entry["last_attempt"] = now
+            if ok:
+                entry["last_success"] = now
+                entry["failures"] = 0
+            else:
+                entry["failures"] = entry.get("failures", 0) + 1
+            write_json(path, schedule)
+    except OSError as e:
+        log.warning(f"Cannot save schedule of {filename}: {e}")
+
+
+def write_metrics():
+    """Write metrics for the textfile collector, if METRICS_DIR is mounted.
+    Per-source success times come from the persisted schedule, so they survive restarts."""
+    if not METRICS_DIR.is_dir():
+        return
+    with _state_lock:
+        schedule = read_json(WORKDIR / SCHEDULE_FILENAME, {})
+    for filename, entry in schedule.items():
+        if "last_success" in entry:
+            metrics.set("geo_update_source_last_success_timestamp_seconds", entry["last_success"], file=filename)
+    try:
+        metrics.write(METRICS_DIR / METRICS_FILENAME)
+    except OSError as e:
+        log.warning(f"Cannot write metrics: {e}")
+
+
+def record_mirror(url, latency=None, throughput=None, ok=True):
+    """Update the rolling score of a mirror with one request: latency to the response headers
+    in seconds, download throughput in bytes/sec, or a failure"""
+    now = time.time()
+    try:
+        with _state_lock:
+            path = WORKDIR / MIRROR_STATE_FILENAME
+            state = read_json(path, {})
+            entry = state.setdefault(url, {})
+            if ok:
+                entry["failures"] = 0
+                entry["last_ok"] = now
+                for key, sample in (("latency", latency), ("throughput", throughput)):
+                    if sample is not None:
+                        entry[key] = entry[key] + MIRROR_SCORE_ALPHA * (sample - entry[key]) if key in entry else sample
+            else:
+                entry["failures"] = entry.get("failures", 0) + 1
+                entry["last_failure"] = now
+            write_json(path, state)
+    except OSError as e:
+        log.warning(f"Cannot save score of mirror {url}: {e}")
+
+
+def probe_mirror(url):
+    """Measure latency of a mirror with HTTP HEAD"""
+    start = time.monotonic()
+    try:
+        response = http_head(url, timeout=MIRROR_PROBE_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        log.info(f"Mirror {url} is unavailable: {e}")
+        record_mirror(url, ok=False)
+    else:
+        record_mirror(url, latency=time.monotonic() - start)
+
+
+def mirror_is_healthy(entry, now):
+    """A mirror that failed is skipped for a backoff period doubling with each failure"""
+    failures = entry.get("failures", 0)
+    if not failures:
         return True
+    backoff = min(RETRY_MAX_SECONDS, MIRROR_RETRY_SECONDS * 2 ** (failures - 1))
+    return now - entry.get("last_failure", 0) >= backoff
+
+
+def rank_mirrors(mirrors, expected_size, current=None):
+    """Order mirrors by expected download time of `expected_size` bytes, fastest first.
+    Healthy mirrors without a fresh score are probed first; failed ones go last, in config order.
+    The `current` mirror stays first while it is healthy, unless another one is clearly faster."""
+    if len(mirrors) < 2:
+        return mirrors
+    now = time.time()
+    with _state_lock:
+        state = read_json(WORKDIR / MIRROR_STATE_FILENAME, {})
+    stale = [m["url"] for m in mirrors if mirror_is_healthy(state.get(m["url"], {}), now)
+             and now - state.get(m["url"], {}).get("last_ok", 0) > MIRROR_PROBE_INTERVAL]
+    if stale:
+        with ThreadPoolExecutor(max_workers=len(stale), thread_name_prefix="probe") as pool:
+            list(pool.map(probe_mirror, stale))
+        with _state_lock:
+            state = read_json(WORKDIR / MIRROR_STATE_FILENAME, {})
+
+    # a mirror never downloaded from is assumed as fast as the best one, so it gets a chance
+    best_throughput = max((state.get(m["url"], {}).get("throughput", 0) for m in mirrors
+                           if mirror_is_healthy(state.get(m["url"], {}), now)), default=0)
+
+    def expected_time(item):
+        index, mirror = item
+        entry = state.get(mirror["url"], {})
+        if not mirror_is_healthy(entry, now):
+            return (1, 0, index)
+        if "latency" not in entry:
+            return (0, float("inf"), index)
+        throughput = entry.get("throughput", best_throughput)
+        return (0, entry["latency"] + (expected_size / throughput if throughput else 0), index)
+
+    ranked = [mirror for _, mirror in sorted(enumerate(mirrors), key=expected_time)]
+    # stay with the mirror of the local file unless it failed or another one is clearly faster
+    index = next((i for i, m in enumerate(mirrors) if m["url"] == current), None)
+    if index is not None and ranked[0] is not mirrors[index]:
+        unhealthy, current_time, _ = expected_time((index, mirrors[index]))
+        _, best_time, _ = expected_time((mirrors.index(ranked[0]), ranked[0]))
+        if not unhealthy and (best_time > current_time * MIRROR_SWITCH_RATIO
+                              or current_time - best_time < MIRROR_SWITCH_SECONDS):
+            ranked.insert(0, ranked.pop(ranked.index(mirrors[index])))
+    log.debug(f"Mirror order: {', '.join(m['url'] for m in ranked)}")
+    return ranked
 
-    return False
+
+def download_from_mirrors(mirrors, local_file):
+    """Check and download a file from the first mirror that works, failing over to the next ones"""
+    for i, mirror in enumerate(mirrors):
+        try:
+            if not (need_download(mirror["url"], local_file) and
+                    download_file(mirror["url"], local_file, mirror["sha256_url"])):
+                log.info(f"{local_file.name} is up-to-date ({local_file})")
+            return
+        except Exception as e:
+            record_mirror(mirror["url"], ok=False)
+            if i == len(mirrors) - 1:
+                raise
+            metrics.inc("geo_update_mirror_failovers_total", file=local_file.name)
+            log.warning(f"{local_file.name} failed from {mirror['url']} ({e}), trying {mirrors[i + 1]['url']}")
+
+
+def fetch_geo_file(url, filename, sha256_url=None, trim_codes=None, download=True, mirrors=None):
+    """Download one geo file if needed, return local path of the file to push:
+    the downloaded file, or its trimmed copy when `trim_codes` are given.
+    `mirrors` ([{"url", "sha256_url"}], default: just `url`) are tried fastest first."""
+    local_file = WORKDIR / filename
+    if download:
+        try:
+            mirrors = mirrors or [{"url": url, "sha256_url": sha256_url}]
+            ranked = rank_mirrors(mirrors, get_file_size(local_file), current_mirror(local_file))
+            download_from_mirrors(ranked, local_file)
+        except Exception:
+            record_source_attempt(filename, ok=False)
+            raise
+        record_source_attempt(filename, ok=True)
+    else:
+        log.debug(f"{filename} is not due for download")
+    if trim_codes is not None and local_file.exists():
+        return trim_geo_file(local_file, trim_codes.get(filename, set()))
+    return local_file
+
+
+def iter_changed_files(futures, container_hashes):
+    """Yield (local_file, container_file) for fetched files that differ from the container,
+    in the order downloads complete. Failed downloads are skipped, update_cycle() reports them."""
+    for future in as_completed(futures):
+        filename = futures[future]
+        if future.exception():
+            continue
+        local_file = future.result()
+
+        # Always compare with the container to handle the case when the file was downloaded
+        # but not copied for some reason (e.g. xray container was stopped)
+        local_hash = get_local_sha256(local_file)
+        if local_hash is None:
+            log.warning(f"{filename} is missing in {WORKDIR}, nothing to copy")
+            continue
+
+        container_file = APPDIR / filename
+        container_hash = container_hashes.get(str(container_file))
+        if local_hash == container_hash:
+            log.debug(f"{filename} in container is up-to-date (sha256 {local_hash})")
+            continue
+
+        log.info(f"Copy {filename} to container. sha256: local={local_hash} container={container_hash}")
+        yield local_file, container_file
+
+
+# One cycle at a time: the update loop and the docker events watcher share the container
+_cycle_lock = threading.Lock()
+
+
+@contextmanager
+def profile_cycle():
+    """Profile the with-block with cProfile and tracemalloc if GEO_PROFILE is set, see save_profile()"""
+    if not GEO_PROFILE:
+        yield
+        return
+    import cProfile
+    import tracemalloc
+
+    profilers = [cProfile.Profile()]
+    per_thread = sys.version_info < (3, 12)
+    if per_thread:
+        # before 3.12 a profiler sees only its own thread: worker threads started during
+        # the cycle get their own one on their first call
+        def start_thread_profiler(frame, event, arg):
+            profiler = cProfile.Profile()
+            profilers.append(profiler)
+            profiler.enable()
+        threading.setprofile(start_thread_profiler)
+    tracemalloc.start(TRACEMALLOC_FRAMES)
+    start = time.monotonic()
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        if per_thread:
+            threading.setprofile(None)
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        try:
+            save_profile(profilers, snapshot, peak, time.monotonic() - start)
+        except OSError as e:
+            log.warning(f"Cannot save profile: {e}")
+
+
+def save_profile(profilers, snapshot, peak, elapsed):
+    """Dump merged cProfile stats and top allocation sites of a cycle to WORKDIR/profiles,
+    keep the last PROFILE_KEEP cycles and log the functions with the most own time"""
+    import pstats
+    import tracemalloc
+
+    directory = WORKDIR / PROFILE_DIRNAME
+    directory.mkdir(exist_ok=True)
+    name = f"cycle-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+    stats = pstats.Stats(*profilers)
+    stats.dump_stats(directory / f"{name}.prof")
+
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                       tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")])
+    allocations = snapshot.statistics("lineno")[:PROFILE_TOP]
+    lines = [f"peak traced memory {peak} bytes, cycle {elapsed:.2f} sec", ""]
+    lines += [str(stat) for stat in allocations]
+    (directory / f"{name}.alloc.txt").write_text("".join(line + "\n" for line in lines))
+
+    for old in sorted(directory.glob("cycle-*.prof"))[:-PROFILE_KEEP]:
+        old.unlink()
+        old.with_suffix(".alloc.txt").unlink(missing_ok=True)
+
+    hot = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:PROFILE_TOP]
+    log.info(f"Profile {directory / name}.prof: cycle {elapsed:.2f} sec, peak traced memory {peak // 1024} KiB")
+    for func, (_, calls, own, cumulative, _) in hot:
+        log.info(f"  {own:8.3f}s own {cumulative:8.3f}s cum {calls:8d} calls  {pstats.func_std_string(func)}")
+
+
+def geo_update(push_only=False):
+    """Main update function: download files concurrently and stream changed ones
+    to the xray container in one archive as soon as they are ready.
+    Only sources that are due by the schedule are downloaded. With `push_only` nothing
+    is downloaded, the container gets the files from WORKDIR.
+    Metrics are written after each cycle, successful or not."""
+    with _cycle_lock:
+        try:
+            with profile_cycle():
+                updated = update_cycle(push_only)
+        except Exception:
+            metrics.inc("geo_update_cycles_total", result="failed")
+            raise
+        else:
+            metrics.inc("geo_update_cycles_total", result="updated" if updated else "unchanged")
+            metrics.set("geo_update_last_success_timestamp_seconds", time.time())
+            return updated
+        finally:
+            write_metrics()
+
+
+def update_cycle(push_only):
+    """One update cycle, see geo_update(); the caller holds _cycle_lock"""
+    _redirects.clear()
+    paths = [APPDIR / filename for _, filename in iter_geo_files()]
+    all_targets = get_targets()
+    errors = []
+    statuses = [{"target": target} for target in all_targets]
+
+    # containers of all targets are looked up first, nothing is downloaded if none is reachable
+    with ThreadPoolExecutor(max_workers=TARGET_WORKERS, thread_name_prefix="target") as target_pool:
+        for status, future in zip(statuses, [target_pool.submit(prepare_target, t, paths) for t in all_targets]):
+            try:
+                status["container"], status["hashes"] = future.result()
+            except Exception as e:
+                log.error(f"Target {target_label(status['target'])} is unavailable: {e}")
+                status["error"] = e
+                errors.append(e)
+    ready = [status for status in statuses if "error" not in status]
+    if not ready:
+        raise errors[0]
+
+    trim_codes = get_trim_codes()
+    due = set() if push_only else get_due_sources()
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="geo") as pool, \
+            ThreadPoolExecutor(max_workers=TARGET_WORKERS, thread_name_prefix="target") as target_pool:
+        futures = {pool.submit(fetch_geo_file, f["url"], f["filename"], f.get("sha256_url"), trim_codes,
+                               f["filename"] in due, source_mirrors(f)): f["filename"]
+                   for f in GEO_FILES}
+        # every target streams its changed files as downloads land, shared delivery publishes them once below
+        pushes = [target_pool.submit(push_to_target, status, futures) for status in ready
+                  if GEO_DELIVERY != "shared"]
+        download_errors = []
+        for future in as_completed(futures):
+            if e := future.exception():
+                log.error(f"Failed to update {futures[future]}: {e}")
+                download_errors.append(e)
+        for status, push in zip(ready, pushes):
+            try:
+                status["copied"] = push.result()
+            except Exception as e:
+                log.error(f"Failed to push geo files to {target_label(status['target'])}: {e}")
+                status["error"] = e
+        if GEO_DELIVERY == "shared":
+            link_shared_targets(ready, futures)
+        errors[:0] = download_errors
+        errors += [status["error"] for status in ready if "error" in status]
+
+    # Files already copied are picked up even if another file failed.
+    # Restarts go one target at a time, so the fleet never drops connections at once.
+    restarted = 0
+    for status in ready:
+        if not status.get("copied"):
+            continue
+        if restarted:
+            time.sleep(RESTART_STAGGER_SECONDS)
+        restarted += 1
+        try:
+            with metrics.timer("geo_update_phase_seconds", phase="xray_restart"):
+                outage = restart_xray(status["container"])
+            if outage is not None:
+                status["outage"] = outage
+        except Exception as e:
+            log.error(f"Failed to restart xray on {target_label(status['target'])}: {e}")
+            status.setdefault("error", e)
+            errors.append(e)
+
+    report_targets(statuses)
+    if errors:
+        raise errors[0]
+
+    return any(status.get("copied") for status in statuses)
+
+
+def get_targets():
+    """Return push targets: parsed XRAY_TARGETS, or the local xray container"""
+    return targets or [{"name": None, "docker_host": None, "container_name": XRAY_CONTAINER_NAME}]
+
+
+def parse_targets(value):
+    """Parse XRAY_TARGETS into [{"name", "docker_host", "container_name"}]"""
+    parsed = []
+    for item in value.replace("\n", ",").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        docker_host, sep, container_name = item.rpartition("#")
+        if not sep and "://" in item:
+            docker_host, container_name = item, ""
+        parsed.append({"name": item, "docker_host": docker_host or None,
+                       "container_name": container_name or XRAY_CONTAINER_NAME})
+    names = [target["name"] for target in parsed]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate XRAY_TARGETS entries: {value}")
+    return parsed
+
+
+def target_label(target):
+    return target["name"] or target["container_name"]
+
+
+def get_target_container(target):
+    """Return the running container of a push target, keeping a long-lived handle like
+    get_xray_container(). Clients of remote docker hosts are created on first use."""
+    if target["name"] is None:
+        return get_xray_container()
+    handle = target.get("handle")
+    if handle is not None:
+        try:
+            handle.reload()
+            if handle.status == "running":
+                return handle
+        except docker.errors.NotFound:
+            pass
+    if target["docker_host"] is None:
+        client = docker_client
+    else:
+        if "client" not in target:
+            target["client"] = docker.DockerClient(base_url=target["docker_host"])
+        client = target["client"]
+    containers = client.containers.list(filters={"name": target["container_name"]})
+    if not containers:
+        raise RuntimeError(f"Container '{target['container_name']}' not found on {target['docker_host'] or 'local docker'}")
+    target["handle"] = containers[0]
+    return target["handle"]
+
+
+def prepare_target(target, paths):
+    """Return (container, {path: sha256} of its geo files) of a push target.
+    With shared delivery the files are not in the container and are not listed."""
+    container = get_target_container(target)
+    if GEO_DELIVERY == "shared":
+        return container, {}
+    return container, load_container_hashes(container, paths, target["name"])
+
+
+def push_to_target(status, futures):
+    """Stream fetched files that differ from the target container in one archive,
+    opened with the first changed file; the rest join it as downloads land.
+    Return the list of copied local files."""
+    container, hashes, name = status["container"], status["hashes"], status["target"]["name"]
+    copied = []
+    changed = iter_changed_files(futures, hashes)
+    first = next(changed, None)
+    if first:
+        try:
+            copied = copy_files_to_container(container, itertools.chain([first], changed))
+        except Exception:
+            # unknown what made it into the container, list it again next time
+            save_container_hashes(container, None, name)
+            raise
+
+    for local_file in copied:
+        hashes[str(APPDIR / local_file.name)] = get_local_sha256(local_file)
+    save_container_hashes(container, hashes, name)
+    return copied
+
+
+def shared_dir():
+    return WORKDIR / SHARED_DIRNAME
+
+
+def read_shared_version(version_dir):
+    """Return {filename: sha256} of a published version, {} if there is none"""
+    return read_json(version_dir / SHARED_MANIFEST, {})
+
+
+def publish_shared(files):
+    """Publish fetched local files as a new version directory of the shared volume and
+    atomically switch the `current` symlink to it. Files missing from `files` (failed downloads)
+    or not downloaded yet are carried over from the current version if they are there.
+    Return the changed local files, [] if none."""
+    root = shared_dir()
+    current_dir = root / "current"
+    current = read_shared_version(current_dir)
+    wanted = {filename: (current_dir / filename, sha256) for filename, sha256 in current.items()}
+    for local_file in files:
+        if (sha256 := get_local_sha256(local_file)) is not None:
+            wanted[local_file.name] = (local_file, sha256)
+    changed = [source for filename, (source, sha256) in wanted.items() if current.get(filename) != sha256]
+    if not changed:
+        log.debug(f"Shared version in {root} is up-to-date")
+        return []
+
+    with metrics.timer("geo_update_phase_seconds", phase="push"):
+        versions = root / "versions"
+        versions.mkdir(parents=True, exist_ok=True)
+        version = f"{time.time_ns()}"
+        tmp_dir = versions / f".{version}.tmp"
+        tmp_dir.mkdir()
+        for filename, (source, _) in wanted.items():
+            try:
+                # WORKDIR files are only ever replaced by rename, a hard link keeps this version intact
+                os.link(source, tmp_dir / filename)
+            except OSError:
+                shutil.copy2(source, tmp_dir / filename)
+        write_json(tmp_dir / SHARED_MANIFEST, {filename: sha256 for filename, (_, sha256) in wanted.items()})
+        os.rename(tmp_dir, versions / version)
+
+        link_tmp = root / "current.tmp"
+        link_tmp.unlink(missing_ok=True)
+        os.symlink(f"versions/{version}", link_tmp)
+        os.replace(link_tmp, current_dir)
+        fsync_dir(root)
+
+    log.info(f"Published version {version}: {', '.join(source.name for source in changed)}")
+    for old in sorted(versions.iterdir(), key=lambda p: p.name)[:-SHARED_KEEP_VERSIONS]:
+        shutil.rmtree(old, ignore_errors=True)
+    return changed
+
+
+def link_shared_files(container, target_name, missing=()):
+    """Point geo files of container's APPDIR at the current shared version with one exec per
+    new container instance. Return True if links were (re)created, False if they are in place,
+    None if the current version lacks `missing` files and links would dangle."""
+    path = container_state_path(target_name)
+    instance = get_container_instance(container)
+    state = read_json(path, {})
+    if state.get("instance") == instance and state.get("shared"):
+        metrics.inc("geo_update_cache_total", cache="container", result="hit")
+        return False
+    if missing:
+        log.warning(f"Not linking geo files of {container.name}: {', '.join(sorted(missing))} "
+                    f"not published yet, the container keeps its own files")
+        return None
+
+    metrics.inc("geo_update_cache_total", cache="container", result="miss")
+    links = " && ".join(f"ln -sfn {shlex.quote(str(SHARED_MOUNT / 'current' / filename))} "
+                        f"{shlex.quote(str(APPDIR / filename))}" for _, filename in iter_geo_files())
+    r = container.exec_run(["sh", "-c", links], user="root")
+    if r.exit_code != 0:
+        raise RuntimeError(f"Failed to link geo files to {SHARED_MOUNT}: {r.output.decode()}")
+    log.info(f"Linked geo files of container instance {container.name} to {SHARED_MOUNT}")
+    try:
+        write_json(path, {"instance": instance, "shared": True})
+    except OSError as e:
+        log.warning(f"Cannot save container state: {e}")
+    return True
+
+
+def link_shared_targets(statuses, futures):
+    """Shared delivery: publish fetched files once, make sure every target container reads them.
+    A target is restarted when a new version was published or its links were just created.
+    Nothing is linked until the current version has every file of GEO_FILES."""
+    fetched = [future.result() for future in futures if not future.exception()]
+    try:
+        published = publish_shared(fetched)
+    except Exception as e:
+        log.error(f"Failed to publish geo files to {shared_dir()}: {e}")
+        for status in statuses:
+            status["error"] = e
+        return
+    current_dir = shared_dir() / "current"
+    filenames = [filename for _, filename in iter_geo_files()]
+    missing = set(filenames) - set(read_shared_version(current_dir))
+    for status in statuses:
+        try:
+            linked = link_shared_files(status["container"], status["target"]["name"], missing)
+        except Exception as e:
+            log.error(f"Failed to link geo files in {target_label(status['target'])}: {e}")
+            status["error"] = e
+            continue
+        if linked:
+            status["copied"] = [current_dir / filename for filename in filenames]
+        elif linked is False:
+            status["copied"] = published
+
+
+def report_targets(statuses):
+    """Count per-target results in metrics and log them when there are several targets"""
+    for status in statuses:
+        label = target_label(status["target"])
+        if "error" in status:
+            result = "failed"
+        else:
+            result = "updated" if status.get("copied") else "unchanged"
+        metrics.inc("geo_update_target_pushes_total", target=label, result=result)
+        if len(statuses) > 1:
+            details = f", {len(status['copied'])} files" if status.get("copied") else ""
+            if "outage" in status:
+                details += f", xray outage {status['outage']:.2f} sec"
+            if "error" in status:
+                details += f": {status['error']}"
+            log.info(f"Target {label}: {result}{details}")
 
 
 def get_container(container_name):
@@ -201,11 +1495,225 @@ def get_container(container_name):
     return containers[0]
 
 
+def geo_tag(filename, code):
+    """Routing rule syntax for a category of a geo file: geoip:cn or ext:geoip_RU.dat:ru"""
+    stem = filename.removesuffix(".dat")
+    if stem in ("geoip", "geosite"):
+        return f"{stem}:{code.lower()}"
+    return f"ext:{filename}:{code.lower()}"
+
+
+def open_geo_indexes(rebuild=False):
+    """Open lookup indexes of the geo files in WORKDIR as [(filename, GeoIndex)].
+    An index is compiled again only when the manifest hash of its source file changed."""
+    index_dir = WORKDIR / INDEX_DIRNAME
+    index_dir.mkdir(exist_ok=True)
+    indexes = []
+    for _, filename in iter_geo_files():
+        local_file = WORKDIR / filename
+        sha256 = get_local_sha256(local_file)
+        if sha256 is None:
+            log.warning(f"{filename} is not downloaded, skipping")
+            continue
+
+        index_file = index_dir / f"{filename}.idx"
+        index = None
+        if index_file.exists() and not rebuild:
+            try:
+                index = geo_index.GeoIndex(index_file)
+            except ValueError as e:
+                log.info(f"Rebuilding index: {e}")
+            else:
+                if index.source_sha256 != sha256:
+                    index.close()
+                    index = None
+
+        if index is None:
+            start_time = time.time()
+            tmp_path = index_file.with_name(index_file.name + ".tmp")
+            geo_index.build_index(local_file, tmp_path, geo_dat.dat_kind(filename), sha256)
+            os.replace(tmp_path, index_file)
+            log.info(f"Built index of {filename} in {time.time() - start_time:.1f} sec")
+            index = geo_index.GeoIndex(index_file)
+        indexes.append((filename, index))
+    return indexes
+
+
+def classify(value, indexes):
+    """Return routing tags of all geo categories matching an IP address or a domain"""
+    try:
+        ip = ipaddress.ip_address(value)
+    except ValueError:
+        return [geo_tag(filename, code) for filename, index in indexes for code in index.lookup_domain(value)]
+    return [geo_tag(filename, code) for filename, index in indexes for code in index.lookup_ip(ip)]
+
+
+def lookup_argv(argv):
+    """Arguments of --lookup: what follows it. Arguments before it, like --delay of the image
+    entrypoint in `docker compose run --rm geo-update --lookup ...`, belong to the resident mode."""
+    return argv[argv.index("--lookup") + 1:]
+
+
+def lookup_main(argv):
+    """CLI: print geo categories of IP addresses/domains given as arguments or one per line on stdin"""
+    parser = argparse.ArgumentParser(prog="geo_update.py --lookup",
+                                     description="Classify IP addresses and domains by the geo files in WORKDIR")
+    parser.add_argument("values", nargs="*", help="IP addresses or domains, read from stdin if omitted")
+    parser.add_argument("--rebuild", action="store_true", help="compile indexes even if they are up-to-date")
+    args = parser.parse_args(argv)
+
+    indexes = open_geo_indexes(rebuild=args.rebuild)
+    cached_classify = functools.lru_cache(maxsize=65536)(lambda value: " ".join(classify(value, indexes)))
+    values = args.values or (line.strip() for line in sys.stdin)
+    out = sys.stdout
+    for value in values:
+        if value:
+            out.write(f"{value}\t{cached_classify(value)}\n")
+    out.flush()
+    for _, index in indexes:
+        index.close()
+    return 0
+
+
+def get_xray_container():
+    """Return long-lived handle of the running xray container, refreshed with one inspect call.
+    The container is looked up by name only when the handle is missing or stale."""
+    global xray_container
+    if xray_container is not None:
+        try:
+            xray_container.reload()
+            if xray_container.status == "running":
+                return xray_container
+        except docker.errors.NotFound:
+            pass
+    xray_container = get_container(XRAY_CONTAINER_NAME)
+    return xray_container
+
+
+def watch_container_starts():
+    """Background thread: push geo files from WORKDIR to the xray container
+    as soon as it is started, e.g. after being recreated with stock geo files"""
+    global xray_container
+    filters = {"type": "container", "event": "start",
+               "label": f"com.docker.compose.service={XRAY_CONTAINER_NAME}"}
+    while True:
+        try:
+            for event in docker_client.events(decode=True, filters=filters):
+                log.warning(f"{now_str()} Container {XRAY_CONTAINER_NAME} started, pushing geofiles")
+                try:
+                    container = docker_client.containers.get(event["id"])
+                    xray_container = container
+                    # files are swapped under a running xray and picked up by its restart;
+                    # if xray is slow to start, push anyway: it loads the files when it starts
+                    try:
+                        wait_for_xray(container)
+                    except RuntimeError as e:
+                        log.warning(f"{e}, pushing geofiles anyway")
+                    geo_update(push_only=True)
+                except Exception as e:
+                    log.exception("Error pushing geofiles to started container", exc_info=e)
+        except Exception as e:
+            log.warning(f"Docker events stream failed: {e}")
+        time.sleep(EVENTS_RETRY_SECONDS)
+
+
+def watch_trim_codes():
+    """Background thread: a geosite:/ext: rule added in the 3x-ui panel restarts xray inside the
+    container, the events watcher does not see it and xray fails on a trimmed file without the
+    category. Push re-trimmed files as soon as the template uses categories missing in them,
+    and full files when the template can no longer be read."""
+    last_signature = template_signature()
+    last_codes = get_trim_codes()
+    while True:
+        time.sleep(TRIM_CHECK_INTERVAL)
+        signature = template_signature()
+        if signature == last_signature:
+            continue
+        try:
+            codes = get_trim_codes()
+            if codes is None and last_codes is not None:
+                log.warning(f"{now_str()} xray template is unknown, pushing full geofiles")
+                geo_update(push_only=True)
+            elif codes is not None and (missing := get_missing_codes(codes, load_trimmed_codes())):
+                log.warning(f"{now_str()} xray template uses new categories "
+                            + "; ".join(f"{filename}: {', '.join(sorted(used))}"
+                                        for filename, used in sorted(missing.items()))
+                            + ", pushing re-trimmed geofiles")
+                geo_update(push_only=True)
+            last_signature, last_codes = signature, codes
+        except Exception as e:
+            log.exception("Error pushing geofiles for the changed xray template", exc_info=e)
+
+
+def local_docker_socket(docker_host):
+    """Path of the unix socket of a docker host, None if it is not a local socket"""
+    host = docker_host or os.environ.get("DOCKER_HOST") or "unix:///var/run/docker.sock"
+    return host.removeprefix("unix://") if host.startswith("unix://") else None
+
+
+def docker_api_get(socket_path, path):
+    """GET a Docker Engine API path over a unix socket with the standard library only"""
+    conn = http.client.HTTPConnection("localhost", timeout=DOCKER_API_TIMEOUT)
+    conn.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.sock.settimeout(DOCKER_API_TIMEOUT)
+    try:
+        conn.sock.connect(socket_path)
+        conn.request("GET", path)
+        response = conn.getresponse()
+        body = response.read()
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise OSError(f"Docker API {path}: HTTP {response.status}")
+    return json.loads(body)
+
+
+def peek_container_instance(target):
+    """Instance of a target container like get_container_instance(), looked up the same way as
+    get_target_container() but without the docker SDK. None if it is not running or not local."""
+    socket_path = local_docker_socket(target["docker_host"])
+    if socket_path is None:
+        return None
+    filters = quote(json.dumps({"name": [target["container_name"]]}))
+    containers = docker_api_get(socket_path, f"/containers/json?filters={filters}")
+    if not containers:
+        return None
+    info = docker_api_get(socket_path, f"/containers/{containers[0]['Id']}/json")
+    return f"{info['Id']}@{info['State']['StartedAt']}"
+
+
+def cycle_is_cached():
+    """True when a cycle would do nothing: no source is due and every target still runs the
+    container instance that got the files in the last cycle. Nothing is downloaded and no
+    docker client is created to find this out."""
+    if get_due_sources():
+        return False
+    if GEO_TRIM and (codes := get_trim_codes()) is not None and get_missing_codes(codes, load_trimmed_codes()):
+        return False
+    for target in get_targets():
+        state = read_json(container_state_path(target["name"]), {})
+        if not (state.get("shared") if GEO_DELIVERY == "shared" else "files" in state):
+            return False
+        try:
+            instance = peek_container_instance(target)
+        except (OSError, ValueError, KeyError) as e:
+            log.debug(f"Cannot inspect {target_label(target)} without docker client: {e}")
+            return False
+        if instance is None or instance != state.get("instance"):
+            return False
+    return True
+
+
 def get_update_delay():
-    """Return update delay in seconds: base UPDATE_INTERVAL plus random jitter up to MAX_JITTER_SECONDS."""
+    """Return update delay in seconds: time until the earliest source is due by the persisted
+    schedule plus random jitter up to MAX_JITTER_SECONDS."""
+    with _state_lock:
+        schedule = read_json(WORKDIR / SCHEDULE_FILENAME, {})
+    base = int(min(get_next_due(f, schedule) for f in GEO_FILES) - time.time())
+    base = max(MIN_UPDATE_DELAY, base)
     jitter = random.randint(0, MAX_JITTER_SECONDS)
-    total = UPDATE_INTERVAL + jitter
-    log.debug(f"Computed next update delay: base={UPDATE_INTERVAL}s + jitter={jitter}s => {total}s")
+    total = base + jitter
+    log.debug(f"Computed next update delay: base={base}s + jitter={jitter}s => {total}s")
     return total
 
 
@@ -229,15 +1737,58 @@ def initial_delay():
 def now_str():
     return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
+def setup():
+    """Read sources and targets from the environment"""
+    WORKDIR.mkdir(parents=True, exist_ok=True)
+
+    global GEO_FILES
+    if GEO_SOURCES:
+        GEO_FILES = load_geo_files(GEO_SOURCES)
+        log.info(f"Loaded {len(GEO_FILES)} geo sources from GEO_SOURCES")
+
+    global targets
+    targets = parse_targets(XRAY_TARGETS)
+    if GEO_DELIVERY == "shared" and any(target["docker_host"] for target in targets):
+        raise ValueError("GEO_DELIVERY=shared works only with containers on the local docker host")
+    if targets:
+        log.info(f"Pushing geo files to {len(targets)} targets: {', '.join(t['name'] for t in targets)}")
+
+
+def once_main():
+    """Run one cycle and exit with EXIT_UPDATED, EXIT_UNCHANGED or EXIT_FAILED. A recreated
+    container is noticed by the next run, there is no docker events watcher.
+    --delay of the image entrypoint is ignored, the timer or cron decides when to run."""
+    log.info(f"{now_str()} START once")
+    global docker_client
+    try:
+        setup()
+        if cycle_is_cached():
+            log.info("No source is due and containers have the files, nothing to do")
+            metrics.inc("geo_update_cycles_total", result="unchanged")
+            metrics.set("geo_update_last_success_timestamp_seconds", time.time())
+            write_metrics()
+            return EXIT_UNCHANGED
+        docker_client = docker.from_env()
+        updated = geo_update()
+    except Exception as e:
+        log.exception("Error during update", exc_info=e)
+        return EXIT_FAILED
+    log.info(f"Geofiles {'updated' if updated else 'unchanged'}")
+    return EXIT_UPDATED if updated else EXIT_UNCHANGED
+
+
 def main():
     """Main loop"""
     log.info(f"{now_str()} START")
     signal.signal(signal.SIGTERM, _handle_termination)
     signal.signal(signal.SIGINT, _handle_termination)
-    WORKDIR.mkdir(parents=True, exist_ok=True)
+    setup()
 
     global docker_client
     docker_client = docker.from_env()
+    threading.Thread(target=watch_container_starts, name="events", daemon=True).start()
+    if GEO_TRIM:
+        threading.Thread(target=watch_trim_codes, name="template", daemon=True).start()
 
     initial_delay()
 
@@ -252,12 +1803,21 @@ def main():
             log.exception("Error during update", exc_info=e)
         
         update_interval = get_update_delay()
-        log.info(f"Next update in {update_interval // 3600} hours")
+        log.info(f"Next update in {update_interval // 3600} hours {update_interval % 3600 // 60} minutes")
         time.sleep(update_interval)
 
 def _handle_termination(signum, frame):
   os._exit(2)
 
+def dispatch(argv):
+    """Run the mode selected by the command line; the image entrypoint always adds --delay"""
+    if "--lookup" in argv:
+        return lookup_main(lookup_argv(argv))
+    if "--once" in argv:
+        return once_main()
+    return main()
+
+
 if __name__ == "__main__":
-    main()
+    sys.exit(dispatch(sys.argv[1:]))
 
@@ -0,0 +1,92 @@
+"""Counters, gauges and timings of the update loop in Prometheus text format.
+
+Metrics are written to a *.prom file for the node_exporter textfile collector,
+so no HTTP server has to run inside the container.
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+def format_labels(labels):
+    """Render sorted (name, value) pairs as {name="value",...}"""
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+class Metrics:
+    """Thread-safe registry of metric families declared as {name: (type, help)}.
+    Summaries keep only _sum and _count, quantiles are left to Prometheus."""
+
+    def __init__(self, families):
+        self._families = families
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, name, suffix, labels):
+        if name not in self._families:
+            raise KeyError(f"Unknown metric {name}")
+        return name, suffix, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, "", labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = self._key(name, "", labels)
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        """Add one observation to a summary"""
+        sum_key = self._key(name, "_sum", labels)
+        count_key = self._key(name, "_count", labels)
+        with self._lock:
+            self._values[sum_key] = self._values.get(sum_key, 0) + value
+            self._values[count_key] = self._values.get(count_key, 0) + 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe duration of the with-block in seconds, also when it raises"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def get(self, name, suffix="", **labels):
+        """Current value of a sample, 0 if it was never recorded"""
+        with self._lock:
+            return self._values.get(self._key(name, suffix, labels), 0)
+
+    def render(self):
+        """Return all recorded samples in Prometheus text exposition format"""
+        with self._lock:
+            values = dict(self._values)
+        lines = []
+        for name, (kind, help_text) in self._families.items():
+            samples = sorted((key, value) for key, value in values.items() if key[0] == name)
+            if not samples:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (_, suffix, labels), value in samples:
+                lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "".join(line + "\n" for line in lines)
+
+    def write(self, path):
+        """Atomically replace the metrics file, the collector never sees a partial one"""
+        tmp_path = path.with_name(path.name + ".tmp")
+        tmp_path.write_text(self.render())
+        os.replace(tmp_path, path)
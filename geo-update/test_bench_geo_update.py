@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import bench_geo_update
+import geo_update
+
+
+def test_benchmark_scenarios(tmp_path):
+    """Smoke test: all scenarios run real cycles against the local origin and directory container"""
+    results = bench_geo_update.run_benchmark(0.1, root=tmp_path)
+    by_scenario = {r["scenario"]: r for r in results}
+
+    assert [r["scenario"] for r in results] == ["cold", "warm", "partial", "recreated"]
+    assert [r["updated"] for r in results] == [True, False, True, True]
+    assert by_scenario["cold"]["docker_calls_by_method"]["container.put_archive"] == 1
+    assert by_scenario["warm"]["docker_calls"] == 1
+    # the changed file is downloaded and pushed, the others are only checked
+    container_file = tmp_path / "container" / "app" / "bin" / bench_geo_update.FILENAMES[0]
+    assert container_file.read_bytes() == (tmp_path / "assets" / bench_geo_update.FILENAMES[0]).read_bytes()
+    # module globals patched for the run are restored
+    assert geo_update.WORKDIR != tmp_path / "work"
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import sys
+import pytest
+
+# Add parent directory to path to import module
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import geo_dat
+
+
+def field(number, payload):
+    """Encode a length-delimited protobuf field"""
+    return geo_dat.encode_varint((number << 3) | 2) + geo_dat.encode_varint(len(payload)) + payload
+
+
+def make_entry(code, *items):
+    """Encode a GeoIP/GeoSite entry: country_code plus opaque field-2 items"""
+    return field(1, field(1, code.encode()) + b"".join(field(2, item) for item in items))
+
+
+def make_cidr(ip, prefix):
+    """Encode CIDR message"""
+    return field(1, bytes(ip)) + geo_dat.encode_varint(2 << 3) + geo_dat.encode_varint(prefix)
+
+
+def make_domain(value, domain_type=2):
+    """Encode Domain message"""
+    return geo_dat.encode_varint(1 << 3) + geo_dat.encode_varint(domain_type) + field(2, value.encode())
+
+
+GEOIP_DATA = make_entry("CN", make_cidr([1, 2, 3, 0], 24), make_cidr([1, 2, 4, 0], 24)) + \
+    make_entry("PRIVATE", make_cidr([10, 0, 0, 0], 8))
+
+
+class TestVarint:
+    """Tests for varint helpers"""
+
+    @pytest.mark.parametrize("value", [0, 1, 127, 128, 300, 2**32, 2**63 - 1])
+    def test_roundtrip(self, value):
+        """Test that encoded varints decode to the same value"""
+        encoded = geo_dat.encode_varint(value)
+        assert geo_dat.decode_varint(encoded, 0) == (value, len(encoded))
+        assert geo_dat.read_varint(io.BytesIO(encoded)) == value
+
+    def test_read_varint_eof(self):
+        """Test clean and truncated end of stream"""
+        assert geo_dat.read_varint(io.BytesIO(b"")) is None
+        with pytest.raises(geo_dat.DatFormatError):
+            geo_dat.read_varint(io.BytesIO(b"\x80"))
+
+
+class TestIterEntries:
+    """Tests for iter_entries function"""
+
+    def test_codes_and_raw_bytes(self):
+        """Test that entries are yielded with their codes and original encoding"""
+        data = make_entry("CN", b"1.2.3.0/24") + make_entry("private", b"10.0.0.0/8")
+        entries = list(geo_dat.iter_entries(io.BytesIO(data)))
+
+        assert [code for code, _, _ in entries] == ["CN", "private"]
+        assert b"".join(header + payload for _, header, payload in entries) == data
+
+    def test_truncated(self):
+        """Test that a truncated file is rejected"""
+        data = make_entry("CN", b"1.2.3.0/24")
+        with pytest.raises(geo_dat.DatFormatError):
+            list(geo_dat.iter_entries(io.BytesIO(data[:-1])))
+
+    def test_not_protobuf(self):
+        """Test that an HTML error page is rejected"""
+        with pytest.raises(geo_dat.DatFormatError):
+            list(geo_dat.iter_entries(io.BytesIO(b"<html><body>rate limited</body></html>")))
+
+
+class TestTrimDat:
+    """Tests for trim_dat function"""
+
+    def test_keeps_only_wanted_codes(self, tmp_path):
+        """Test that only wanted categories are written, compared case-insensitively"""
+        src = tmp_path / "geosite.dat"
+        src.write_bytes(make_entry("GOOGLE", b"a") + make_entry("CN", b"b") + make_entry("ru-blocked", b"c"))
+        dst = tmp_path / "trimmed.dat"
+
+        kept, total = geo_dat.trim_dat(src, dst, {"google", "RU-BLOCKED", "missing"})
+
+        assert kept == {"GOOGLE", "RU-BLOCKED"}
+        assert total == 3
+        assert dst.read_bytes() == make_entry("GOOGLE", b"a") + make_entry("ru-blocked", b"c")
+
+
+class TestValidateDat:
+    """Tests for validate_dat function"""
+
+    def test_geoip(self, tmp_path):
+        """Test that a valid geoip file is counted"""
+        path = tmp_path / "geoip.dat"
+        path.write_bytes(GEOIP_DATA)
+        assert geo_dat.validate_dat(path, "geoip") == {"entries": 2, "items": 3}
+
+    def test_geosite(self, tmp_path):
+        """Test that a valid geosite file is counted"""
+        path = tmp_path / "geosite.dat"
+        path.write_bytes(make_entry("GOOGLE", make_domain("google.com"), make_domain("^g.*", 1)))
+        assert geo_dat.validate_dat(path, "geosite") == {"entries": 1, "items": 2}
+
+    @pytest.mark.parametrize("kind, data", [
+        ("geoip", make_entry("CN", make_cidr([1, 2, 3], 24))),
+        ("geoip", make_entry("CN", make_cidr([1, 2, 3, 0], 33))),
+        ("geosite", make_entry("CN", make_domain("a.cn", 7))),
+        ("geosite", make_entry("CN", make_domain(""))),
+        ("geoip", GEOIP_DATA[:-3]),
+        ("geoip", b""),
+        (None, b"<!DOCTYPE html><html>"),
+    ])
+    def test_malformed(self, tmp_path, kind, data):
+        """Test that malformed, truncated or empty files are rejected"""
+        path = tmp_path / "file.dat"
+        path.write_bytes(data)
+        with pytest.raises(geo_dat.DatFormatError):
+            geo_dat.validate_dat(path, kind)
+
+    def test_dat_kind(self):
+        """Test list type detection by file name"""
+        assert geo_dat.dat_kind("geoip_RU.dat") == "geoip"
+        assert geo_dat.dat_kind("geosite.dat") == "geosite"
+        assert geo_dat.dat_kind("other.dat") is None
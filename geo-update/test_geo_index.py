@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pytest
+
+# Add parent directory to path to import module
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import geo_index
+from test_geo_dat import make_entry, make_cidr, make_domain
+
+
+@pytest.fixture
+def geoip_index(tmp_path):
+    src = tmp_path / "geoip.dat"
+    src.write_bytes(
+        make_entry("CN", make_cidr([1, 2, 3, 0], 24), make_cidr([0x24, 0x0e] + [0] * 14, 16)) +
+        make_entry("PRIVATE", make_cidr([10, 0, 0, 0], 8), make_cidr([255, 255, 255, 255], 32)) +
+        make_entry("TEST", make_cidr([10, 1, 0, 0], 16)))
+    geo_index.build_index(src, tmp_path / "geoip.idx", "geoip", "sha")
+    with geo_index.GeoIndex(tmp_path / "geoip.idx") as index:
+        yield index
+
+
+@pytest.fixture
+def geosite_index(tmp_path):
+    src = tmp_path / "geosite.dat"
+    src.write_bytes(
+        make_entry("GOOGLE", make_domain("google.com"), make_domain("gmail.com", 3), make_domain("googlevideo", 0)) +
+        make_entry("CN", make_domain("cn"), make_domain(r"^baidu\.", 1)))
+    geo_index.build_index(src, tmp_path / "geosite.idx", "geosite", "sha")
+    with geo_index.GeoIndex(tmp_path / "geosite.idx") as index:
+        yield index
+
+
+class TestGeoipIndex:
+    """Tests for IP lookups"""
+
+    @pytest.mark.parametrize("ip, expected", [
+        ("1.2.3.4", ("CN",)),
+        ("1.2.4.0", ()),
+        ("10.0.0.1", ("PRIVATE",)),
+        ("10.1.2.3", ("PRIVATE", "TEST")),
+        ("10.2.0.0", ("PRIVATE",)),
+        ("255.255.255.255", ("PRIVATE",)),
+        ("0.0.0.0", ()),
+        ("240e::1", ("CN",)),
+        ("2400::1", ()),
+    ])
+    def test_lookup_ip(self, geoip_index, ip, expected):
+        """Test that overlapping CIDRs of several categories are all reported"""
+        assert geoip_index.lookup_ip(ip) == expected
+
+    def test_metadata(self, geoip_index):
+        """Test header fields"""
+        assert geoip_index.kind == "geoip"
+        assert geoip_index.source_sha256 == "sha"
+        assert geoip_index.lookup_domain("google.com") == ()
+
+
+class TestGeositeIndex:
+    """Tests for domain lookups"""
+
+    @pytest.mark.parametrize("domain, expected", [
+        ("google.com", ("GOOGLE",)),
+        ("www.Google.com.", ("GOOGLE",)),
+        ("gmail.com", ("GOOGLE",)),
+        ("mail.gmail.com", ()),
+        ("r1.googlevideo.net", ("GOOGLE",)),
+        ("google.com.cn", ("CN",)),
+        ("baidu.org", ("CN",)),
+        ("example.com", ()),
+    ])
+    def test_lookup_domain(self, geosite_index, domain, expected):
+        """Test suffix, full, keyword and regex rules"""
+        assert geosite_index.lookup_domain(domain) == expected
+
+
+def test_not_an_index(tmp_path):
+    """Test that other files are rejected"""
+    path = tmp_path / "geoip.dat"
+    path.write_bytes(b"not an index at all")
+    with pytest.raises(ValueError):
+        geo_index.GeoIndex(path)
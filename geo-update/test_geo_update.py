@@ -2,19 +2,46 @@
 
 import os
 import sys
+import json
+import time
 import pytest
-from unittest.mock import Mock, patch, mock_open
+import requests
+import socketserver
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+from unittest.mock import Mock, patch
 from pathlib import Path
 
 # Add parent directory to path to import module
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 import geo_update as geo_update
+from test_geo_dat import make_entry, make_cidr, make_domain, GEOIP_DATA
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path):
+    """Keep state files written by geo_update inside a temporary WORKDIR"""
+    path = tmp_path / "work"
+    path.mkdir()
+    with patch('geo_update.WORKDIR', path), patch('geo_update.xray_container', None), \
+            patch('geo_update.METRICS_DIR', tmp_path / "metrics"), \
+            patch('geo_update.metrics', geo_update.Metrics(geo_update.METRIC_FAMILIES)):
+        yield path
+
+
+def make_container(exec_output=b"", container_id="abc123", started_at="2024-01-01T00:00:00Z"):
+    """Mock container whose exec_run returns given output"""
+    container = Mock(id=container_id, attrs={"State": {"StartedAt": started_at}})
+    container.name = "3x-ui"
+    container.exec_run.return_value = Mock(exit_code=0, output=exec_output)
+    return container
 
 
 class TestGetUrlSize:
     """Tests for get_url_size function"""
     
-    @patch('geo_update.requests.head')
+    @patch('geo_update.http_head')
     def test_get_url_size_success(self, mock_head):
         """Test successful retrieval of file size"""
         mock_response = Mock()
@@ -24,9 +51,9 @@ class TestGetUrlSize:
         
         size = geo_update.get_url_size("https://example.com/file.dat")
         assert size == 12345
-        mock_head.assert_called_once_with("https://example.com/file.dat", allow_redirects=True, timeout=30)
+        mock_head.assert_called_once_with("https://example.com/file.dat")
     
-    @patch('geo_update.requests.head')
+    @patch('geo_update.http_head')
     def test_get_url_size_no_content_length(self, mock_head):
         """Test when Content-Length header is missing"""
         mock_response = Mock()
@@ -36,7 +63,7 @@ class TestGetUrlSize:
         with pytest.raises(RuntimeError):
             geo_update.get_url_size("https://example.com/file.dat")
     
-    @patch('geo_update.requests.head')
+    @patch('geo_update.http_head')
     def test_get_url_size_error(self, mock_head):
         """Test error handling"""
         mock_head.side_effect = Exception("Connection error")
@@ -104,6 +131,18 @@ class TestNeedDownload:
         result = geo_update.need_download("https://example.com/file.dat", local_file)
         assert result is False
     
+    @patch('geo_update.get_url_size')
+    def test_need_download_validators_cached(self, mock_get_url_size, workdir):
+        """Test that cached validators skip the HEAD request"""
+        local_file = workdir / "test.dat"
+        local_file.write_bytes(b"test")
+        url = "https://example.com/file.dat"
+        geo_update.write_json(workdir / geo_update.META_CACHE_FILENAME, {
+            "test.dat": {url: {"etag": '"abc"', "size": 4, "sha256": geo_update.get_local_sha256(local_file)}}})
+
+        assert geo_update.need_download(url, local_file) is True
+        mock_get_url_size.assert_not_called()
+
     @patch('geo_update.get_url_size')
     @patch('geo_update.get_file_size')
     def test_need_download_url_size_none(self, mock_get_file_size, mock_get_url_size, tmp_path):
@@ -120,27 +159,28 @@ class TestNeedDownload:
 class TestDownloadFile:
     """Tests for download_file function"""
     
-    @patch('geo_update.requests.get')
+    @patch('geo_update.http_get')
     @patch('geo_update.get_file_size')
     def test_download_file_success(self, mock_get_file_size, mock_get, tmp_path):
         """Test successful file download"""
         test_file = tmp_path / "downloaded.dat"
-        mock_response = Mock()
-        mock_response.iter_content.return_value = [b"chunk1", b"chunk2"]
+        mock_response = Mock(status_code=200, url="https://cdn.example.com/file.dat")
+        mock_response.headers = {'ETag': '"abc"'}
+        mock_response.iter_content.return_value = [GEOIP_DATA[:10], GEOIP_DATA[10:]]
         mock_response.raise_for_status = Mock()
         mock_get.return_value = mock_response
         mock_get_file_size.return_value = 100
         
-        geo_update.download_file("https://example.com/file.dat", test_file)
+        assert geo_update.download_file("https://example.com/file.dat", test_file) is True
         assert test_file.exists()
-        mock_get.assert_called_once_with("https://example.com/file.dat", allow_redirects=True, timeout=20, stream=True)
+        mock_get.assert_called_once_with("https://example.com/file.dat", stream=True, headers={})
     
-    @patch('geo_update.requests.get')
+    @patch('geo_update.http_get')
     @patch('geo_update.get_file_size')
     def test_download_file_empty(self, mock_get_file_size, mock_get, tmp_path):
         """Test when downloaded file is empty"""
         test_file = tmp_path / "empty.dat"
-        mock_response = Mock()
+        mock_response = Mock(status_code=200, headers={})
         mock_response.iter_content.return_value = []
         mock_response.raise_for_status = Mock()
         mock_get.return_value = mock_response
@@ -148,7 +188,176 @@ class TestDownloadFile:
         with pytest.raises(RuntimeError):
             geo_update.download_file("https://example.com/file.dat", test_file)
     
-    @patch('geo_update.requests.get')
+    @patch('geo_update.http_get')
+    def test_download_file_saves_validators(self, mock_get, workdir):
+        """Test that ETag/Last-Modified and final url are cached next to the file"""
+        test_file = workdir / "geoip.dat"
+        mock_response = Mock(status_code=200, url="https://cdn.example.com/geoip.dat")
+        mock_response.headers = {'ETag': '"abc"', 'Last-Modified': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+        mock_response.iter_content.return_value = [GEOIP_DATA]
+        mock_get.return_value = mock_response
+
+        geo_update.download_file("https://example.com/geoip.dat", test_file)
+
+        meta = geo_update.get_source_meta("https://example.com/geoip.dat", test_file)
+        assert meta["etag"] == '"abc"'
+        assert meta["last_modified"] == 'Mon, 01 Jan 2024 00:00:00 GMT'
+        assert meta["final_url"] == "https://cdn.example.com/geoip.dat"
+        # Metadata of another source url is not reused
+        assert geo_update.get_source_meta("https://example.com/other.dat", test_file) == {}
+
+    @patch('geo_update.http_get')
+    def test_validators_per_mirror(self, mock_get, workdir):
+        """Test that every mirror keeps its validators while the local file is the content it served"""
+        test_file = workdir / "geoip.dat"
+        for url, etag in (("https://a/geoip.dat", '"a"'), ("https://b/geoip.dat", '"b"')):
+            mock_response = Mock(status_code=200, url=url, headers={"ETag": etag})
+            mock_response.iter_content.return_value = [GEOIP_DATA]
+            mock_get.return_value = mock_response
+            geo_update.download_file(url, test_file)
+
+        assert geo_update.get_source_meta("https://a/geoip.dat", test_file)["etag"] == '"a"'
+        assert geo_update.get_source_meta("https://b/geoip.dat", test_file)["etag"] == '"b"'
+        assert geo_update.current_mirror(test_file) == "https://b/geoip.dat"
+
+        # same size, other content: nobody's validators describe the local file anymore
+        test_file.write_bytes(bytes(len(GEOIP_DATA)))
+        assert geo_update.get_source_meta("https://a/geoip.dat", test_file) == {}
+        assert geo_update.current_mirror(test_file) is None
+
+    @patch('geo_update.http_get')
+    def test_download_file_not_modified(self, mock_get, workdir):
+        """Test conditional GET: 304 keeps the local file and returns False"""
+        test_file = workdir / "geoip.dat"
+        test_file.write_bytes(b"data")
+        url = "https://example.com/geoip.dat"
+        geo_update.write_json(workdir / geo_update.META_CACHE_FILENAME, {
+            "geoip.dat": {url: {"etag": '"abc"', "last_modified": "yesterday", "size": 4,
+                                "sha256": geo_update.get_local_sha256(test_file)}}})
+        mock_get.return_value = Mock(status_code=304)
+
+        assert geo_update.download_file(url, test_file) is False
+        assert test_file.read_bytes() == b"data"
+        mock_get.assert_called_once_with(url, stream=True,
+                                         headers={"If-None-Match": '"abc"', "If-Modified-Since": "yesterday"})
+
+    @patch('geo_update.http_get')
+    def test_download_file_size_mismatch_drops_validators(self, mock_get, workdir):
+        """Test that a local file that differs from the cached size is downloaded unconditionally"""
+        test_file = workdir / "geoip.dat"
+        test_file.write_bytes(b"trunc")
+        url = "https://example.com/geoip.dat"
+        geo_update.write_json(workdir / geo_update.META_CACHE_FILENAME, {
+            "geoip.dat": {url: {"etag": '"abc"', "size": 100, "sha256": geo_update.get_local_sha256(test_file)}}})
+        mock_response = Mock(status_code=200, url=url, headers={})
+        mock_response.iter_content.return_value = [GEOIP_DATA]
+        mock_get.return_value = mock_response
+
+        assert geo_update.download_file(url, test_file) is True
+        assert mock_get.call_args.kwargs["headers"] == {}
+
+    @patch('geo_update.http_get')
+    def test_download_file_resumes_after_drop(self, mock_get, workdir):
+        """Test that a dropped connection keeps the .part file and the download resumes with Range"""
+        import requests
+        test_file = workdir / "geoip.dat"
+        url = "https://example.com/geoip.dat"
+
+        def dropped():
+            yield GEOIP_DATA[:6]
+            raise requests.exceptions.ChunkedEncodingError("connection reset")
+
+        first = Mock(status_code=200, url=url, headers={'ETag': '"v1"'})
+        first.iter_content.return_value = dropped()
+        second = Mock(status_code=206, url=url, headers={'ETag': '"v1"', 'Content-Range': f'bytes 6-{len(GEOIP_DATA) - 1}/{len(GEOIP_DATA)}'})
+        second.iter_content.return_value = [GEOIP_DATA[6:]]
+        mock_get.side_effect = [first, second]
+
+        assert geo_update.download_file(url, test_file) is True
+        assert test_file.read_bytes() == GEOIP_DATA
+        assert not geo_update.part_path(test_file).exists()
+        assert mock_get.call_args.kwargs["headers"] == {"Range": "bytes=6-", "If-Range": '"v1"'}
+        # The hash covers the whole file, not only the resumed tail
+        assert geo_update.get_local_sha256(test_file) == geo_update.sha256_file(test_file)
+        assert geo_update.get_part_validator(url, geo_update.part_path(test_file)) is None
+
+    @patch('geo_update.http_get')
+    def test_download_file_part_replaced_upstream(self, mock_get, workdir):
+        """Test that a full response to a Range request overwrites the stale part"""
+        test_file = workdir / "geoip.dat"
+        url = "https://example.com/geoip.dat"
+        part = geo_update.part_path(test_file)
+        part.write_bytes(b"stale")
+        geo_update.update_meta_cache(part.name, {"url": url, "validator": '"v1"'})
+        response = Mock(status_code=200, url=url, headers={'ETag': '"v2"'})
+        response.iter_content.return_value = [GEOIP_DATA]
+        mock_get.return_value = response
+
+        assert geo_update.download_file(url, test_file) is True
+        assert test_file.read_bytes() == GEOIP_DATA
+        assert mock_get.call_args.kwargs["headers"]["If-Range"] == '"v1"'
+
+    @patch('geo_update.http_get')
+    def test_download_file_interrupted_keeps_final_file(self, mock_get, workdir):
+        """Test that a failing download never touches the existing file"""
+        import requests
+        test_file = workdir / "geoip.dat"
+        test_file.write_bytes(b"old content")
+        mock_get.side_effect = requests.ConnectionError("reset")
+
+        with pytest.raises(requests.ConnectionError):
+            geo_update.download_file("https://example.com/geoip.dat", test_file)
+        assert test_file.read_bytes() == b"old content"
+        # connect failures are retried by the session, not by another round of requests here
+        assert mock_get.call_count == 1
+
+    @patch('geo_update.http_get')
+    def test_download_file_gives_up_on_repeated_drops(self, mock_get, workdir):
+        """Test that a transfer dropping after some data is resumed up to DOWNLOAD_ATTEMPTS times"""
+        import requests
+        test_file = workdir / "geoip.dat"
+
+        def dropping(*args, **kwargs):
+            def chunks():
+                yield b"x"
+                raise requests.ConnectionError("read timed out")
+            response = Mock(status_code=200, url="https://example.com/geoip.dat", headers={})
+            response.iter_content.return_value = chunks()
+            return response
+        mock_get.side_effect = dropping
+
+        with pytest.raises(requests.ConnectionError):
+            geo_update.download_file("https://example.com/geoip.dat", test_file)
+        assert mock_get.call_count == geo_update.DOWNLOAD_ATTEMPTS
+
+    @patch('geo_update.http_get')
+    def test_download_file_invalid(self, mock_get, workdir):
+        """Test that an error page served with 200 never replaces the existing file"""
+        test_file = workdir / "geoip.dat"
+        test_file.write_bytes(GEOIP_DATA)
+        mock_response = Mock(status_code=200, url="https://example.com/geoip.dat", headers={})
+        mock_response.iter_content.return_value = [b"<html>Too many requests</html>"]
+        mock_get.return_value = mock_response
+
+        with pytest.raises(RuntimeError, match="not a valid geo file"):
+            geo_update.download_file("https://example.com/geoip.dat", test_file)
+        assert test_file.read_bytes() == GEOIP_DATA
+        assert not geo_update.part_path(test_file).exists()
+
+    @patch('geo_update.http_get')
+    def test_download_file_stats_in_manifest(self, mock_get, workdir):
+        """Test that entry counts are recorded in the manifest"""
+        test_file = workdir / "geoip.dat"
+        mock_response = Mock(status_code=200, url="https://example.com/geoip.dat", headers={})
+        mock_response.iter_content.return_value = [GEOIP_DATA]
+        mock_get.return_value = mock_response
+
+        geo_update.download_file("https://example.com/geoip.dat", test_file)
+        manifest = geo_update.read_json(workdir / geo_update.MANIFEST_FILENAME, {})
+        assert manifest["geoip.dat"]["entries"] == 2
+        assert manifest["geoip.dat"]["items"] == 3
+
+    @patch('geo_update.http_get')
     def test_download_file_error(self, mock_get, tmp_path):
         """Test download error handling"""
         test_file = tmp_path / "error.dat"
@@ -157,35 +366,431 @@ class TestDownloadFile:
             geo_update.download_file("https://example.com/file.dat", test_file)
 
 
-class TestCopyFileToContainer:
-    """Tests for copy_file_to_container function"""
+class TestHttpSession:
+    """Tests for the shared HTTP session against a local server"""
+
+    @pytest.fixture
+    def origin(self):
+        """Local HTTP/1.1 server: /latest redirects to /objects; `fail` lists statuses of the next answers"""
+        hits = []
+        fail = []
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                hits.append((self.path, self.client_address[1]))
+                if fail:
+                    self.answer(fail.pop(0))
+                elif self.path == "/latest":
+                    self.send_response(302)
+                    self.send_header("Location", "/objects")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self.answer(200, b"data")
+
+            def answer(self, status, body=b""):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        with patch('geo_update._http_session', None), patch('geo_update._redirects', {}), \
+                patch('geo_update.HTTP_BACKOFF', 0):
+            yield f"http://127.0.0.1:{server.server_port}", hits, fail
+        server.shutdown()
+        server.server_close()
+
+    def test_redirect_target_is_reused(self, origin):
+        """Test that a redirect resolved in the cycle is followed directly the next time"""
+        base, hits, _ = origin
+        assert geo_update.http_get(f"{base}/latest").content == b"data"
+        assert geo_update.http_get(f"{base}/latest").content == b"data"
+        assert [path for path, _ in hits] == ["/latest", "/objects", "/objects"]
+
+    def test_connections_are_kept_alive(self, origin):
+        """Test that requests to one host reuse the pooled connection"""
+        base, hits, _ = origin
+        geo_update.http_get(f"{base}/objects")
+        geo_update.http_get(f"{base}/objects")
+        assert len({port for _, port in hits}) == 1
+
+    def test_expired_redirect_target_is_resolved_again(self, origin):
+        """Test that a failing redirect target (expired signed url) is resolved from the original url"""
+        base, hits, fail = origin
+        geo_update.http_get(f"{base}/latest")
+        fail.append(403)
+        assert geo_update.http_get(f"{base}/latest").content == b"data"
+        assert [path for path, _ in hits] == ["/latest", "/objects", "/objects", "/latest", "/objects"]
+
+    def test_server_errors_are_retried(self, origin):
+        """Test that 5xx answers are retried by the session"""
+        base, hits, fail = origin
+        fail += [503, 502]
+        response = geo_update.http_get(f"{base}/objects")
+        assert response.status_code == 200
+        assert len(hits) == 3
+
+    def test_retries_are_bounded(self, origin):
+        """Test that the session gives up after HTTP_RETRIES retries"""
+        base, hits, fail = origin
+        fail += [503] * 10
+        assert geo_update.http_get(f"{base}/objects").status_code == 503
+        assert len(hits) == geo_update.HTTP_RETRIES + 1
+
+
+class TestSha256:
+    """Tests for SHA-256 manifest and checksum verification"""
+
+    def test_get_local_sha256_uses_manifest(self, workdir):
+        """Test that the manifest value is returned while size and mtime are unchanged"""
+        local_file = workdir / "geoip.dat"
+        local_file.write_bytes(b"data")
+        expected = geo_update.sha256_file(local_file)
+
+        assert geo_update.get_local_sha256(local_file) == expected
+        with patch('geo_update.sha256_file') as mock_sha256_file:
+            assert geo_update.get_local_sha256(local_file) == expected
+            mock_sha256_file.assert_not_called()
+
+    def test_get_local_sha256_missing(self, workdir):
+        """Test that a missing file has no hash"""
+        assert geo_update.get_local_sha256(workdir / "missing.dat") is None
+
+    @patch('geo_update.get_upstream_sha256')
+    @patch('geo_update.http_get')
+    def test_download_file_checksum_mismatch(self, mock_get, mock_upstream, workdir):
+        """Test that a file not matching the published checksum is rejected"""
+        test_file = workdir / "geoip.dat"
+        mock_response = Mock(status_code=200, url="https://example.com/geoip.dat", headers={})
+        mock_response.iter_content.return_value = [b"data"]
+        mock_get.return_value = mock_response
+        mock_upstream.return_value = "0" * 64
+
+        with pytest.raises(RuntimeError, match="Checksum mismatch"):
+            geo_update.download_file("https://example.com/geoip.dat", test_file,
+                                     "https://example.com/geoip.dat.sha256sum")
+        assert not test_file.exists()
+
+    @patch('geo_update.http_get')
+    def test_get_upstream_sha256(self, mock_get):
+        """Test parsing of a sha256sum companion file"""
+        mock_get.return_value = Mock(status_code=200, text="ABCDEF  geoip.dat\n")
+        assert geo_update.get_upstream_sha256("https://example.com/geoip.dat.sha256sum") == "abcdef"
+
+        mock_get.return_value = Mock(status_code=404)
+        assert geo_update.get_upstream_sha256("https://example.com/geoip.dat.sha256sum") is None
+
+    def test_get_container_hashes(self):
+        """Test that all files are hashed with one exec and missing ones are omitted"""
+        container = make_container(
+            b"a" * 64 + b"  /app/bin/geoip.dat\n"
+            b"sha256sum: /app/bin/geosite.dat: No such file or directory\n")
+
+        hashes = geo_update.get_container_hashes(container, [Path("/app/bin/geoip.dat"),
+                                                             Path("/app/bin/geosite.dat")])
+        assert hashes == {"/app/bin/geoip.dat": "a" * 64}
+        container.exec_run.assert_called_once_with(
+            ["sha256sum", "/app/bin/geoip.dat", "/app/bin/geosite.dat"], user="root")
+
+    def test_iter_changed_files_same_hash(self, workdir):
+        """Test that only files with a different hash in container are yielded"""
+        from concurrent.futures import Future
+        same = workdir / "geoip.dat"
+        same.write_bytes(b"data")
+        changed = workdir / "geosite.dat"
+        changed.write_bytes(b"new data")
+        futures = {}
+        for local_file in (same, changed):
+            future = Future()
+            future.set_result(local_file)
+            futures[future] = local_file.name
+        container_hashes = {str(geo_update.APPDIR / "geoip.dat"): geo_update.sha256_file(same),
+                            str(geo_update.APPDIR / "geosite.dat"): geo_update.sha256_file(same)}
+
+        result = list(geo_update.iter_changed_files(futures, container_hashes))
+        assert result == [(changed, geo_update.APPDIR / "geosite.dat")]
+
+
+def consume_archive(path, data):
+    """put_archive side effect: read the streamed tar and return {name: content or None for dirs}"""
+    import io
+    import tarfile
+    with tarfile.open(fileobj=io.BytesIO(b"".join(data)), mode='r:') as tar:
+        return {m.name: (tar.extractfile(m).read() if m.isfile() else None) for m in tar.getmembers()}
+
+
+class TestContainerState:
+    """Tests for recorded container file hashes"""
+
+    def test_same_instance_skips_exec(self, workdir):
+        """Test that recorded hashes are used while the same container instance runs"""
+        container = make_container()
+        geo_update.save_container_hashes(container, {"/app/bin/geoip.dat": "a" * 64})
+
+        hashes = geo_update.load_container_hashes(container, [Path("/app/bin/geoip.dat")])
+        assert hashes == {"/app/bin/geoip.dat": "a" * 64}
+        container.exec_run.assert_not_called()
+
+    def test_new_instance_lists_files(self, workdir):
+        """Test that a restarted or recreated container is listed with one exec"""
+        geo_update.save_container_hashes(make_container(), {"/app/bin/geoip.dat": "a" * 64})
+        restarted = make_container(b"b" * 64 + b"  /app/bin/geoip.dat\n", started_at="2024-02-01T00:00:00Z")
+
+        hashes = geo_update.load_container_hashes(restarted, [Path("/app/bin/geoip.dat")])
+        assert hashes == {"/app/bin/geoip.dat": "b" * 64}
+        restarted.exec_run.assert_called_once()
+
+    def test_forget(self, workdir):
+        """Test that forgotten state makes the next cycle list the container"""
+        container = make_container()
+        geo_update.save_container_hashes(container, {"/app/bin/geoip.dat": "a" * 64})
+        geo_update.save_container_hashes(container, None)
+
+        assert geo_update.load_container_hashes(container, [Path("/app/bin/geoip.dat")]) == {}
+        container.exec_run.assert_called_once()
+
+
+class TestTrim:
+    """Tests for trimming geo files to categories used in routing"""
+
+    def test_get_used_geo_codes(self):
+        """Test that geoip/geosite/ext references are collected from any part of the config"""
+        config = {
+            "routing": {"rules": [
+                {"outboundTag": "blocked", "ip": ["geoip:private", "geoip:!cn"]},
+                {"outboundTag": "direct", "domain": ["geosite:google@cn", "ext:geosite_RU.dat:ru-blocked",
+                                                     "domain:example.com"]},
+                {"outboundTag": "direct", "ip": ["ext-ip:geoip_RU.dat:ru"]},
+            ]},
+            "dns": {"servers": [{"address": "1.1.1.1", "domains": ["geosite:category-ads-all"]}]},
+        }
+        assert geo_update.get_used_geo_codes(config) == {
+            "geoip.dat": {"PRIVATE", "CN"},
+            "geosite.dat": {"GOOGLE", "CATEGORY-ADS-ALL"},
+            "geosite_RU.dat": {"RU-BLOCKED"},
+            "geoip_RU.dat": {"RU"},
+        }
+
+    def test_load_xray_template(self, tmp_path):
+        """Test reading xray template from the 3x-ui settings table"""
+        import json
+        import sqlite3
+        db_path = tmp_path / "x-ui.db"
+        with sqlite3.connect(db_path) as db:
+            db.execute("CREATE TABLE settings (id INTEGER PRIMARY KEY, key TEXT, value TEXT)")
+            db.execute("INSERT INTO settings (key, value) VALUES ('xrayTemplateConfig', ?)",
+                       (json.dumps({"routing": {"rules": []}}),))
+        with patch('geo_update.XUI_DB', db_path):
+            assert geo_update.load_xray_template() == {"routing": {"rules": []}}
+        with patch('geo_update.XUI_DB', tmp_path / "missing.db"):
+            assert geo_update.load_xray_template() is None
+
+    def test_trim_geo_file(self, workdir):
+        """Test that the trimmed copy is written once per source file and codes"""
+        local_file = workdir / "geosite.dat"
+        local_file.write_bytes(make_entry("GOOGLE", b"a") + make_entry("CN", b"b"))
+
+        trimmed = geo_update.trim_geo_file(local_file, {"CN"})
+        assert trimmed == workdir / geo_update.TRIM_DIRNAME / "geosite.dat"
+        assert trimmed.read_bytes() == make_entry("CN", b"b")
+        # Same name as the source but its own manifest entry
+        assert geo_update.get_local_sha256(trimmed) != geo_update.get_local_sha256(local_file)
+
+        with patch('geo_update.geo_dat.trim_dat') as mock_trim_dat:
+            assert geo_update.trim_geo_file(local_file, {"CN"}) == trimmed
+            mock_trim_dat.assert_not_called()
+
+        assert geo_update.trim_geo_file(local_file, {"CN", "GOOGLE"}).read_bytes() == local_file.read_bytes()
+
+    @patch('geo_update.need_download', return_value=False)
+    def test_fetch_geo_file_trimmed(self, mock_need_download, workdir):
+        """Test that the trimmed copy is pushed when trimming is on"""
+        (workdir / "geoip.dat").write_bytes(make_entry("CN", b"a"))
+
+        assert geo_update.fetch_geo_file("https://example.com/geoip.dat", "geoip.dat") == workdir / "geoip.dat"
+        trimmed = geo_update.fetch_geo_file("https://example.com/geoip.dat", "geoip.dat", trim_codes={})
+        assert trimmed == workdir / geo_update.TRIM_DIRNAME / "geoip.dat"
+        assert trimmed.read_bytes() == b""
+
+    def test_get_trim_codes_disabled(self):
+        """Test that trimming is off by default"""
+        with patch('geo_update.load_xray_template') as mock_load:
+            assert geo_update.get_trim_codes() is None
+            mock_load.assert_not_called()
+
+    def test_get_missing_codes(self):
+        """Test that only categories left out of trimmed files are missing"""
+        codes = {"geosite.dat": {"CN", "GOOGLE"}, "geoip.dat": {"CN"}, "other.dat": {"X"}}
+        trimmed = {"geosite.dat": ["CN"], "geoip.dat": ["CN", "RU"]}
+        assert geo_update.get_missing_codes(codes, trimmed) == {"geosite.dat": {"GOOGLE"}}
+        assert geo_update.get_missing_codes({"geosite.dat": {"CN"}}, trimmed) == {}
+
+    @patch('geo_update.GEO_TRIM', True)
+    @patch('geo_update.geo_update')
+    def test_watch_trim_codes_pushes_new_categories(self, mock_geo_update, tmp_path):
+        """Test that a rule with a new category in the panel pushes re-trimmed files, other changes don't"""
+        import sqlite3
+        db_path = tmp_path / "x-ui.db"
+        with sqlite3.connect(db_path) as db:
+            db.execute("CREATE TABLE settings (id INTEGER PRIMARY KEY, key TEXT, value TEXT)")
+            db.execute("INSERT INTO settings (key, value) VALUES ('xrayTemplateConfig', ?)",
+                       (json.dumps({"routing": {"rules": [{"domain": ["geosite:cn"]}]}}),))
+        geo_update.write_json(geo_update.WORKDIR / geo_update.TRIM_STATE_FILENAME,
+                              {"geosite.dat": {"source_sha256": "x", "codes": ["CN"]}})
+
+        def set_rules(domains):
+            with sqlite3.connect(db_path) as db:
+                db.execute("UPDATE settings SET value = ? WHERE key = 'xrayTemplateConfig'",
+                           (json.dumps({"routing": {"rules": [{"domain": domains}]}}),))
+
+        # traffic stats touch the database, an unrelated rule changes the template, a new category needs a push
+        changes = iter([lambda: None, lambda: set_rules(["geosite:cn", "domain:example.com"]),
+                        lambda: set_rules(["geosite:cn", "geosite:google"])])
+        mtimes = iter(range(1, 10))
+
+        def sleep(seconds):
+            change = next(changes, None)
+            if change is None:
+                raise KeyboardInterrupt
+            change()
+            os.utime(db_path, ns=(0, next(mtimes)))
+
+        with patch('geo_update.XUI_DB', db_path), patch('geo_update.time.sleep', side_effect=sleep):
+            with pytest.raises(KeyboardInterrupt):
+                geo_update.watch_trim_codes()
+        mock_geo_update.assert_called_once_with(push_only=True)
+
+    @patch('geo_update.GEO_TRIM', True)
+    @patch('geo_update.peek_container_instance', return_value="abc@2024-01-01T00:00:00Z")
+    def test_new_category_is_not_cached(self, mock_peek):
+        """Test that --once pushes when the template uses a category missing in a trimmed file"""
+        TestOnce().cached_state()
+        geo_update.write_json(geo_update.WORKDIR / geo_update.TRIM_STATE_FILENAME,
+                              {"geosite.dat": {"source_sha256": "x", "codes": ["CN"]}})
+        with patch('geo_update.get_trim_codes', return_value={"geosite.dat": {"CN"}}):
+            assert geo_update.cycle_is_cached()
+        with patch('geo_update.get_trim_codes', return_value={"geosite.dat": {"CN", "GOOGLE"}}):
+            assert not geo_update.cycle_is_cached()
+
+
+class TestLookup:
+    """Tests for --lookup mode"""
+
+    def test_geo_tag(self):
+        """Test routing tag syntax for default and ext files"""
+        assert geo_update.geo_tag("geoip.dat", "CN") == "geoip:cn"
+        assert geo_update.geo_tag("geosite_RU.dat", "RU-BLOCKED") == "ext:geosite_RU.dat:ru-blocked"
+
+    def test_indexes_rebuilt_only_on_change(self, workdir):
+        """Test that indexes are compiled once and again only after the source changes"""
+        (workdir / "geoip.dat").write_bytes(GEOIP_DATA)
+        (workdir / "geosite_RU.dat").write_bytes(make_entry("RU-BLOCKED", make_domain("example.ru")))
+
+        with patch('geo_update.geo_index.build_index', wraps=geo_update.geo_index.build_index) as mock_build:
+            indexes = geo_update.open_geo_indexes()
+            assert [filename for filename, _ in indexes] == ["geoip.dat", "geosite_RU.dat"]
+            assert geo_update.classify("1.2.3.4", indexes) == ["geoip:cn"]
+            assert geo_update.classify("www.example.ru", indexes) == ["ext:geosite_RU.dat:ru-blocked"]
+            for _, index in indexes:
+                index.close()
+            assert mock_build.call_count == 2
+
+            for _, index in geo_update.open_geo_indexes():
+                index.close()
+            assert mock_build.call_count == 2
+
+            (workdir / "geoip.dat").write_bytes(make_entry("US", make_cidr([1, 2, 3, 0], 24)))
+            indexes = geo_update.open_geo_indexes()
+            assert mock_build.call_count == 3
+            assert geo_update.classify("1.2.3.4", indexes) == ["geoip:us"]
+            for _, index in indexes:
+                index.close()
+
+    def test_lookup_main_stdin(self, workdir, capsys):
+        """Test bulk classification of stdin lines"""
+        import io
+        (workdir / "geoip.dat").write_bytes(GEOIP_DATA)
+
+        with patch('sys.stdin', io.StringIO("10.0.0.1\n\n8.8.8.8\n")):
+            assert geo_update.lookup_main([]) == 0
+        assert capsys.readouterr().out == "10.0.0.1\tgeoip:private\n8.8.8.8\t\n"
+
+
+    @patch('geo_update.main')
+    @patch('geo_update.lookup_main', return_value=0)
+    def test_entrypoint_delay_is_ignored(self, mock_lookup_main, mock_main):
+        """Test that `docker compose run --rm geo-update --lookup` runs the lookup, not the resident updater"""
+        assert geo_update.dispatch(["--delay", "--lookup", "1.1.1.1", "--rebuild"]) == 0
+        mock_lookup_main.assert_called_once_with(["1.1.1.1", "--rebuild"])
+        mock_main.assert_not_called()
+
+class TestCopyFilesToContainer:
+    """Tests for copy_files_to_container function"""
     
-    @patch('geo_update.os.unlink')
-    @patch('builtins.open', new_callable=mock_open, read_data=b'tar data')
-    def test_copy_file_to_container_success(self, mock_file, mock_unlink, tmp_path):
-        """Test successful file copy to container"""
+    def test_copy_files_to_container_success(self, tmp_path):
+        """Test that all files go to container in one streamed archive with parent dirs"""
+        first = tmp_path / "first.dat"
+        first.write_bytes(b"test content")
+        second = tmp_path / "second.dat"
+        second.write_bytes(b"x" * 1000)
+        archives = []
+
+        mock_container = make_container()
+        mock_container.put_archive.side_effect = lambda path, data: archives.append(consume_archive(path, data)) or True
+
+        copied = geo_update.copy_files_to_container(mock_container, iter([(first, "/app/bin/first.dat"),
+                                                                          (second, "/app/bin/second.dat")]))
+        assert copied == [first, second]
+        mock_container.put_archive.assert_called_once()
+        assert mock_container.put_archive.call_args.args[0] == "/"
+        # Files are staged under temporary names ...
+        assert archives == [{"app": None, "app/bin": None,
+                             "app/bin/.first.dat.new": b"test content", "app/bin/.second.dat.new": b"x" * 1000}]
+        # ... and renamed into place with one exec
+        mock_container.exec_run.assert_called_once_with(
+            ["sh", "-c", "mv -f /app/bin/.first.dat.new /app/bin/first.dat && "
+                         "mv -f /app/bin/.second.dat.new /app/bin/second.dat"], user="root")
+
+    def test_copy_files_to_container_swap_failure(self, tmp_path):
+        """Test that a failed rename is an error"""
         test_file = tmp_path / "test.dat"
         test_file.write_bytes(b"test content")
-        
+
         mock_container = Mock()
-        mock_container.exec_run.return_value = Mock(exit_code=0)
-        mock_container.put_archive.return_value = True
-        
-        geo_update.copy_file_to_container(mock_container, test_file, "/app/bin/test.dat")
-        mock_container.exec_run.assert_called_once_with("mkdir -p /app/bin", user="root")
-        mock_container.put_archive.assert_called_once()
-        mock_unlink.assert_called()
+        mock_container.put_archive.side_effect = lambda path, data: consume_archive(path, data) or True
+        mock_container.exec_run.return_value = Mock(exit_code=1, output=b"mv: can't rename")
+
+        with pytest.raises(RuntimeError, match="can't rename"):
+            geo_update.copy_files_to_container(mock_container, [(test_file, "/app/bin/test.dat")])
     
-    def test_copy_file_to_container_error(self, tmp_path):
+    def test_copy_files_to_container_error(self, tmp_path):
         """Test error handling in file copy"""
         test_file = tmp_path / "test.dat"
         test_file.write_bytes(b"test content")
         
         mock_container = Mock()
-        mock_container.exec_run.side_effect = Exception("Docker error")
+        mock_container.put_archive.side_effect = Exception("Docker error")
 
         with pytest.raises(Exception):
-            geo_update.copy_file_to_container(mock_container, test_file, "/app/bin/test.dat")
+            geo_update.copy_files_to_container(mock_container, [(test_file, "/app/bin/test.dat")])
+
+    def test_copy_files_to_container_rejected(self, tmp_path):
+        """Test that put_archive returning False is an error"""
+        test_file = tmp_path / "test.dat"
+        test_file.write_bytes(b"test content")
+
+        mock_container = Mock()
+        mock_container.put_archive.side_effect = lambda path, data: consume_archive(path, data) and False
+
+        with pytest.raises(RuntimeError, match="test.dat"):
+            geo_update.copy_files_to_container(mock_container, [(test_file, "/app/bin/test.dat")])
 
 
 class TestRestartXray:
@@ -197,12 +802,48 @@ class TestRestartXray:
         mock_container = Mock()
         mock_kill_result = Mock()
         mock_kill_result.exit_code = 0
+        mock_kill_result.output = b"100\n"
+        mock_pgrep_result = Mock(exit_code=0, output=b"200\n")
         
-        mock_container.exec_run.side_effect = [mock_kill_result]
+        mock_container.exec_run.side_effect = [mock_kill_result, mock_pgrep_result]
         
-        geo_update.restart_xray(mock_container)
-        assert mock_container.exec_run.call_count == 1
+        outage = geo_update.restart_xray(mock_container)
+        assert outage >= 0
+        assert mock_container.exec_run.call_count == 2
         mock_log.info.assert_called()
+
+    @patch('geo_update.time.sleep')
+    def test_restart_xray_waits_for_new_process(self, mock_sleep):
+        """Test that restart waits until a new xray process appears"""
+        mock_container = Mock()
+        mock_container.exec_run.side_effect = [
+            Mock(exit_code=0, output=b"100\n"),  # kill
+            Mock(exit_code=0, output=b"100\n"),  # old process is still exiting
+            Mock(exit_code=1, output=b""),       # no process
+            Mock(exit_code=0, output=b"200\n"),  # restarted
+        ]
+
+        geo_update.restart_xray(mock_container)
+        assert mock_container.exec_run.call_count == 4
+        assert mock_sleep.call_count == 2
+
+    def test_restart_xray_not_running(self):
+        """Test that xray which is not running is not waited for, it loads the files when it starts"""
+        mock_container = Mock()
+        mock_container.exec_run.return_value = Mock(exit_code=3, output=b"")
+        assert geo_update.restart_xray(mock_container) is None
+        mock_container.exec_run.assert_called_once()
+
+    @patch('geo_update.XRAY_RESTART_TIMEOUT', 0.05)
+    @patch('geo_update.XRAY_RESTART_POLL', 0.01)
+    def test_restart_xray_not_back(self):
+        """Test that xray not coming back is an error"""
+        mock_container = Mock()
+        mock_container.exec_run.side_effect = [Mock(exit_code=0, output=b"100\n")] + \
+            [Mock(exit_code=1, output=b"")] * 100
+
+        with pytest.raises(RuntimeError, match="not running"):
+            geo_update.restart_xray(mock_container)
     
     def test_restart_xray_no_process(self):
         """Test when xray process is not found"""
@@ -260,7 +901,7 @@ class TestUpdateGeo:
     """Tests for geo_update function"""
     
     @patch('geo_update.restart_xray')
-    @patch('geo_update.copy_file_to_container')
+    @patch('geo_update.copy_files_to_container')
     @patch('geo_update.download_file')
     @patch('geo_update.need_download')
     def test_update_geo_with_downloads(self, mock_need_download, mock_download_file, 
@@ -274,7 +915,7 @@ class TestUpdateGeo:
             # Mock need_download to return True for all files
             mock_need_download.return_value = True
             mock_download_file.return_value = True
-            mock_copy_file.return_value = True
+            mock_copy_file.side_effect = lambda container, files: [f for f, _ in files]
             mock_restart_xray.return_value = True
 
             for geo_file in geo_update.GEO_FILES:
@@ -282,7 +923,7 @@ class TestUpdateGeo:
                 local_file = workdir / filename
                 local_file.write_bytes(b"dummy data")
             
-            mock_container = Mock()
+            mock_container = make_container()
             mock_docker_client = Mock()
 
             # Ensure get_container finds the mocked container
@@ -294,8 +935,8 @@ class TestUpdateGeo:
             assert result is True
             # Should attempt to download all 4 geo files
             assert mock_download_file.call_count == len(geo_update.GEO_FILES)
-            # Should copy all downloaded files
-            assert mock_copy_file.call_count == len(geo_update.GEO_FILES)
+            # Should copy all downloaded files in one archive
+            mock_copy_file.assert_called_once()
             # Should restart xray once after all files are copied
             mock_restart_xray.assert_called_once()
     
@@ -308,7 +949,7 @@ class TestUpdateGeo:
         with patch('geo_update.WORKDIR', workdir):
             mock_need_download.return_value = False
             
-            mock_container = Mock()
+            mock_container = make_container()
             mock_docker_client = Mock()
 
             # Ensure get_container finds the mocked container
@@ -318,11 +959,11 @@ class TestUpdateGeo:
             result = geo_update.geo_update()
             assert result is False
     
-    @patch('geo_update.copy_file_to_container')
+    @patch('geo_update.copy_files_to_container')
     @patch('geo_update.download_file')
     @patch('geo_update.need_download')
-    @patch('geo_update.get_container_file_size')
-    def test_update_geo_copy_failure(self, mock_get_container_file_size, mock_need_download, 
+    @patch('geo_update.get_container_hashes')
+    def test_update_geo_copy_failure(self, mock_get_container_hashes, mock_need_download, 
                                      mock_download_file, mock_copy_file, tmp_path):
         """Test geo_update when file copy fails"""
         workdir = tmp_path / "geo"
@@ -331,10 +972,12 @@ class TestUpdateGeo:
         with patch('geo_update.WORKDIR', workdir):
             mock_need_download.return_value = True
             mock_download_file.return_value = True
-            mock_get_container_file_size.return_value = 100
+            mock_get_container_hashes.return_value = {}
+            for geo_file in geo_update.GEO_FILES:
+                (workdir / geo_file["filename"]).write_bytes(b"dummy data")
             mock_copy_file.side_effect = Exception("copy failed")  # Copy fails
             
-            mock_container = Mock()
+            mock_container = make_container()
             mock_docker_client = Mock()
 
             # Ensure get_container finds the mocked container
@@ -345,6 +988,717 @@ class TestUpdateGeo:
                 geo_update.geo_update()
 
 
+    @patch('geo_update.restart_xray')
+    @patch('geo_update.copy_files_to_container')
+    @patch('geo_update.need_download', return_value=False)
+    def test_update_geo_second_cycle_no_exec(self, mock_need_download, mock_copy_file,
+                                             mock_restart_xray, workdir):
+        """Test that the cycle after a push needs no exec in the same container instance"""
+        for geo_file in geo_update.GEO_FILES:
+            (workdir / geo_file["filename"]).write_bytes(b"dummy data")
+        mock_copy_file.side_effect = lambda container, files: [f for f, _ in files]
+        mock_container = make_container()
+        mock_docker_client = Mock()
+        mock_docker_client.containers.list.return_value = [mock_container]
+        geo_update.docker_client = mock_docker_client
+
+        assert geo_update.geo_update() is True
+        assert mock_container.exec_run.call_count == 1
+
+        assert geo_update.geo_update() is False
+        assert mock_container.exec_run.call_count == 1
+        mock_copy_file.assert_called_once()
+
+    @patch('geo_update.restart_xray')
+    @patch('geo_update.copy_files_to_container')
+    @patch('geo_update.download_file')
+    @patch('geo_update.need_download')
+    def test_update_geo_partial_failure(self, mock_need_download, mock_download_file,
+                                        mock_copy_file, mock_restart_xray, tmp_path):
+        """Test that one failed download does not block the other files"""
+        workdir = tmp_path / "geo"
+        workdir.mkdir()
+        failing = geo_update.GEO_FILES[0]["url"]
+
+        copied = []
+
+        def download(url, local_file, sha256_url=None):
+            if url == failing:
+                raise RuntimeError("download failed")
+            local_file.write_bytes(b"dummy data")
+            return True
+
+        with patch('geo_update.WORKDIR', workdir):
+            mock_need_download.return_value = True
+            mock_download_file.side_effect = download
+            mock_copy_file.side_effect = lambda container, files: copied.extend(f for f, _ in files) or copied
+
+            mock_docker_client = Mock()
+            mock_docker_client.containers.list.return_value = [make_container()]
+            geo_update.docker_client = mock_docker_client
+
+            with pytest.raises(RuntimeError, match="download failed"):
+                geo_update.geo_update()
+
+            # Other files are still copied and xray is restarted once to pick them up
+            assert len(copied) == len(geo_update.GEO_FILES) - 1
+            mock_restart_xray.assert_called_once()
+
+    @patch('geo_update.restart_xray')
+    @patch('geo_update.copy_files_to_container')
+    @patch('geo_update.need_download')
+    def test_update_geo_concurrency_limit(self, mock_need_download, mock_copy_file,
+                                          mock_restart_xray, tmp_path):
+        """Test that no more than DOWNLOAD_WORKERS downloads run at once"""
+        import threading
+        import time
+        workdir = tmp_path / "geo"
+        workdir.mkdir()
+        lock = threading.Lock()
+        active = [0, 0]  # current, max
+
+        def download(url, local_file, sha256_url=None):
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.05)
+            local_file.write_bytes(b"dummy data")
+            with lock:
+                active[0] -= 1
+            return True
+
+        with patch('geo_update.WORKDIR', workdir), \
+             patch('geo_update.DOWNLOAD_WORKERS', 2), \
+             patch('geo_update.download_file', side_effect=download):
+            mock_need_download.return_value = True
+            mock_copy_file.side_effect = lambda container, files: [f for f, _ in files]
+            mock_docker_client = Mock()
+            mock_docker_client.containers.list.return_value = [make_container()]
+            geo_update.docker_client = mock_docker_client
+
+            assert geo_update.geo_update() is True
+            assert active[1] == 2
+            mock_restart_xray.assert_called_once()
+
+
+
+class TestContainerEvents:
+    """Tests for the long-lived container handle and docker events"""
+
+    def test_get_xray_container_reused(self):
+        """Test that a running container handle is refreshed instead of listing containers"""
+        container = make_container()
+        container.status = "running"
+        mock_client = Mock()
+        mock_client.containers.list.return_value = [container]
+        geo_update.docker_client = mock_client
+
+        assert geo_update.get_xray_container() is container
+        assert geo_update.get_xray_container() is container
+        mock_client.containers.list.assert_called_once()
+        container.reload.assert_called_once()
+
+    def test_get_xray_container_gone(self):
+        """Test that a removed container is looked up again"""
+        import docker
+        old = make_container()
+        old.reload.side_effect = docker.errors.NotFound("gone")
+        new = make_container(container_id="def456")
+        mock_client = Mock()
+        mock_client.containers.list.return_value = [new]
+        geo_update.docker_client = mock_client
+
+        with patch('geo_update.xray_container', old):
+            assert geo_update.get_xray_container() is new
+
+    @patch('geo_update.need_download')
+    def test_fetch_geo_file_push_only(self, mock_need_download, workdir):
+        """Test that push-only cycles do not touch the network"""
+        assert geo_update.fetch_geo_file("https://example.com/geoip.dat", "geoip.dat",
+                                         download=False) == workdir / "geoip.dat"
+        mock_need_download.assert_not_called()
+
+    @patch('geo_update.time.sleep', side_effect=StopIteration)
+    @patch('geo_update.geo_update')
+    @patch('geo_update.wait_for_xray')
+    def test_watch_container_starts(self, mock_wait_for_xray, mock_geo_update, mock_sleep):
+        """Test that a start event pushes files to the new container"""
+        container = make_container(container_id="new")
+        mock_client = Mock()
+        mock_client.events.return_value = iter([{"id": "new", "status": "start"}])
+        mock_client.containers.get.return_value = container
+        geo_update.docker_client = mock_client
+
+        with pytest.raises(StopIteration):
+            geo_update.watch_container_starts()
+
+        assert mock_client.events.call_args.kwargs["filters"]["label"] == "com.docker.compose.service=3x-ui"
+        mock_wait_for_xray.assert_called_once_with(container)
+        mock_geo_update.assert_called_once_with(push_only=True)
+        assert geo_update.xray_container is container
+
+
+    @patch('geo_update.time.sleep', side_effect=StopIteration)
+    @patch('geo_update.geo_update')
+    @patch('geo_update.wait_for_xray', side_effect=RuntimeError("xray-linux is not running in 30 sec"))
+    def test_watch_container_starts_slow_xray(self, mock_wait_for_xray, mock_geo_update, mock_sleep):
+        """Test that files are pushed even if xray does not start in time"""
+        mock_client = Mock()
+        mock_client.events.return_value = iter([{"id": "new", "status": "start"}])
+        mock_client.containers.get.return_value = make_container(container_id="new")
+        geo_update.docker_client = mock_client
+
+        with pytest.raises(StopIteration):
+            geo_update.watch_container_starts()
+
+        mock_geo_update.assert_called_once_with(push_only=True)
+
+
+class TestSchedule:
+    """Tests for the persistent per-source schedule"""
+
+    def test_never_attempted_is_due(self):
+        """Test that all sources are due on the first run"""
+        assert geo_update.get_due_sources() == {f["filename"] for f in geo_update.GEO_FILES}
+
+    def test_recent_success_not_due(self):
+        """Test that a source is skipped until its own interval passes"""
+        now = 1_000_000
+        geo_file = {"filename": "geoip.dat", "interval_hours": 2}
+        schedule = {"geoip.dat": {"last_attempt": now, "last_success": now, "failures": 0}}
+        assert geo_update.get_next_due(geo_file, schedule) == now + 2 * 3600
+        assert geo_update.get_next_due({"filename": "geoip.dat"}, schedule) == now + geo_update.UPDATE_INTERVAL
+
+    def test_failure_backoff(self):
+        """Test that retries back off exponentially up to the cap"""
+        geo_file = {"filename": "geoip.dat"}
+        delays = [geo_update.get_next_due(geo_file, {"geoip.dat": {"last_attempt": 0, "failures": n}})
+                  for n in range(1, 10)]
+        assert delays[:3] == [geo_update.RETRY_MIN_SECONDS, 2 * geo_update.RETRY_MIN_SECONDS,
+                              4 * geo_update.RETRY_MIN_SECONDS]
+        assert delays[-1] == geo_update.RETRY_MAX_SECONDS
+
+    @patch('geo_update.need_download', side_effect=[RuntimeError("github error"), False])
+    def test_fetch_records_attempts(self, mock_need_download, workdir):
+        """Test that download results are persisted per source"""
+        with pytest.raises(RuntimeError):
+            geo_update.fetch_geo_file("https://example.com/geoip.dat", "geoip.dat")
+        schedule = geo_update.read_json(workdir / geo_update.SCHEDULE_FILENAME, {})
+        assert schedule["geoip.dat"]["failures"] == 1
+        assert "geoip.dat" in geo_update.get_due_sources(time.time() + geo_update.RETRY_MIN_SECONDS)
+        assert "geoip.dat" not in geo_update.get_due_sources()
+
+        geo_update.fetch_geo_file("https://example.com/geoip.dat", "geoip.dat")
+        schedule = geo_update.read_json(workdir / geo_update.SCHEDULE_FILENAME, {})
+        assert schedule["geoip.dat"]["failures"] == 0
+        assert schedule["geoip.dat"]["last_success"] == schedule["geoip.dat"]["last_attempt"]
+
+    @patch('geo_update.random.randint', return_value=0)
+    def test_update_delay_until_earliest_due(self, mock_randint):
+        """Test that the loop sleeps until the earliest source is due"""
+        for geo_file in geo_update.GEO_FILES:
+            geo_update.record_source_attempt(geo_file["filename"], ok=True)
+        geo_update.record_source_attempt("geoip.dat", ok=False)
+
+        delay = geo_update.get_update_delay()
+        assert geo_update.RETRY_MIN_SECONDS - 5 <= delay <= geo_update.RETRY_MIN_SECONDS
+
+        geo_update.record_source_attempt("geoip.dat", ok=True)
+        assert geo_update.get_update_delay() > geo_update.UPDATE_INTERVAL - 5
+
+    @patch('geo_update.restart_xray')
+    @patch('geo_update.copy_files_to_container')
+    @patch('geo_update.need_download', return_value=False)
+    def test_restart_skips_recent_downloads(self, mock_need_download, mock_copy_file, mock_restart_xray):
+        """Test that a cycle right after a successful one downloads nothing"""
+        mock_docker_client = Mock()
+        mock_docker_client.containers.list.return_value = [make_container()]
+        geo_update.docker_client = mock_docker_client
+
+        geo_update.geo_update()
+        assert mock_need_download.call_count == len(geo_update.GEO_FILES)
+        geo_update.geo_update()
+        assert mock_need_download.call_count == len(geo_update.GEO_FILES)
+
+
+class TestMirrors:
+    """Tests for mirror lists, scoring and failover"""
+
+    def test_load_geo_files(self, tmp_path):
+        """Test that sources are read from inline JSON or a file and validated"""
+        sources = [{"filename": "geoip.dat", "url": "https://a/geoip.dat", "mirrors": ["https://b/geoip.dat"]}]
+        assert geo_update.load_geo_files(json.dumps(sources)) == sources
+        path = tmp_path / "sources.json"
+        path.write_text(json.dumps(sources))
+        assert geo_update.load_geo_files(str(path)) == sources
+        with pytest.raises(ValueError):
+            geo_update.load_geo_files('[{"filename": "geoip.dat"}]')
+        with pytest.raises(ValueError):
+            geo_update.load_geo_files('[{"filename": "../geoip.dat", "url": "https://a/geoip.dat"}]')
+
+    def test_source_mirrors(self):
+        """Test that the own url comes first and mirrors are normalized and deduplicated"""
+        geo_file = {"filename": "geoip.dat", "url": "https://a/geoip.dat", "sha256_url": "https://a/geoip.dat.sha256sum",
+                    "mirrors": ["https://b/geoip.dat", {"url": "https://c/geoip.dat", "sha256_url": "https://c/sum"},
+                                "https://a/geoip.dat"]}
+        assert geo_update.source_mirrors(geo_file) == [
+            {"url": "https://a/geoip.dat", "sha256_url": "https://a/geoip.dat.sha256sum"},
+            {"url": "https://b/geoip.dat", "sha256_url": None},
+            {"url": "https://c/geoip.dat", "sha256_url": "https://c/sum"},
+        ]
+
+    def test_record_mirror_rolling_score(self, workdir):
+        """Test that latency and throughput are rolling averages and failures are counted"""
+        geo_update.record_mirror("https://a", latency=1.0, throughput=1000)
+        geo_update.record_mirror("https://a", latency=2.0)
+        geo_update.record_mirror("https://a", ok=False)
+        entry = geo_update.read_json(workdir / geo_update.MIRROR_STATE_FILENAME, {})["https://a"]
+        assert entry["latency"] == pytest.approx(1.0 + geo_update.MIRROR_SCORE_ALPHA)
+        assert entry["throughput"] == 1000
+        assert entry["failures"] == 1
+
+    @patch('geo_update.http_head')
+    def test_rank_mirrors(self, mock_head, workdir):
+        """Test that the fastest healthy mirror goes first and only unscored mirrors are probed.
+        A new mirror with low latency is assumed as fast as the best one and gets tried."""
+        now = time.time()
+        geo_update.write_json(workdir / geo_update.MIRROR_STATE_FILENAME, {
+            "https://slow": {"latency": 0.1, "throughput": 1e6, "last_ok": now, "failures": 0},
+            "https://fast": {"latency": 0.5, "throughput": 1e8, "last_ok": now, "failures": 0},
+            "https://down": {"latency": 0.01, "throughput": 1e9, "last_ok": now - 60, "failures": 1,
+                             "last_failure": now},
+        })
+        mirrors = [{"url": url, "sha256_url": None} for url in ("https://down", "https://slow", "https://fast",
+                                                                "https://new")]
+        ranked = geo_update.rank_mirrors(mirrors, 50_000_000)
+        assert [m["url"] for m in ranked] == ["https://new", "https://fast", "https://slow", "https://down"]
+        mock_head.assert_called_once_with("https://new", timeout=geo_update.MIRROR_PROBE_TIMEOUT)
+
+    @pytest.mark.parametrize("current_state, first", [
+        ({"latency": 0.3, "throughput": 5e7, "failures": 0}, "https://current"),      # a bit slower, stays
+        ({"latency": 0.3, "throughput": 1e6, "failures": 0}, "https://fast"),         # 50 s against 1 s
+        ({"latency": 0.1, "throughput": 1e8, "failures": 2}, "https://fast"),         # failed
+    ])
+    def test_rank_mirrors_sticky(self, workdir, current_state, first):
+        """Test that the mirror of the local file is kept unless it failed or another one is clearly faster"""
+        now = time.time()
+        geo_update.write_json(workdir / geo_update.MIRROR_STATE_FILENAME, {
+            "https://current": {**current_state, "last_ok": now, "last_failure": now},
+            "https://fast": {"latency": 0.2, "throughput": 1e8, "last_ok": now, "failures": 0},
+        })
+        mirrors = [{"url": "https://fast", "sha256_url": None}, {"url": "https://current", "sha256_url": None}]
+        ranked = geo_update.rank_mirrors(mirrors, 50_000_000, current="https://current")
+        assert ranked[0]["url"] == first
+
+    @patch('geo_update.download_file', return_value=True)
+    @patch('geo_update.need_download')
+    def test_failover(self, mock_need_download, mock_download_file, workdir):
+        """Test that a failing mirror is skipped in favour of the next one and scored down"""
+        mock_need_download.side_effect = lambda url, local_file: url.startswith("https://b") or \
+            (_ for _ in ()).throw(requests.ConnectionError("throttled"))
+        mirrors = [{"url": "https://a/geoip.dat", "sha256_url": None},
+                   {"url": "https://b/geoip.dat", "sha256_url": "https://b/sum"}]
+        with patch('geo_update.rank_mirrors', side_effect=lambda mirrors, size, current: mirrors):
+            geo_update.fetch_geo_file("https://a/geoip.dat", "geoip.dat", mirrors=mirrors)
+
+        mock_download_file.assert_called_once_with("https://b/geoip.dat", workdir / "geoip.dat", "https://b/sum")
+        state = geo_update.read_json(workdir / geo_update.MIRROR_STATE_FILENAME, {})
+        assert state["https://a/geoip.dat"]["failures"] == 1
+        assert geo_update.metrics.get("geo_update_mirror_failovers_total", file="geoip.dat") == 1
+
+    @patch('geo_update.need_download', side_effect=RuntimeError("down"))
+    def test_all_mirrors_fail(self, mock_need_download, workdir):
+        """Test that the error of the last mirror is raised and the source is retried later"""
+        mirrors = [{"url": "https://a/geoip.dat", "sha256_url": None}, {"url": "https://b/geoip.dat", "sha256_url": None}]
+        with patch('geo_update.rank_mirrors', side_effect=lambda mirrors, size, current: mirrors), \
+                pytest.raises(RuntimeError, match="down"):
+            geo_update.fetch_geo_file("https://a/geoip.dat", "geoip.dat", mirrors=mirrors)
+        assert mock_need_download.call_count == 2
+        assert geo_update.read_json(workdir / geo_update.SCHEDULE_FILENAME, {})["geoip.dat"]["failures"] == 1
+
+
+class TestTargets:
+    """Tests for pushing to several xray hosts"""
+
+    def test_parse_targets(self):
+        """Test docker host and container parsing with defaults"""
+        targets = geo_update.parse_targets("unix:///var/run/docker.sock#3x-ui, ssh://root@node2\n xray2")
+        assert [(t["docker_host"], t["container_name"]) for t in targets] == [
+            ("unix:///var/run/docker.sock", "3x-ui"), ("ssh://root@node2", "3x-ui"), (None, "xray2")]
+        assert geo_update.parse_targets("") == []
+        with pytest.raises(ValueError):
+            geo_update.parse_targets("tcp://a:2375, tcp://a:2375")
+
+    def make_targets(self, *containers):
+        """Targets on separate docker hosts, each with a mocked client listing one container"""
+        targets = geo_update.parse_targets(", ".join(f"tcp://node{i}:2375" for i in range(len(containers))))
+        for target, container in zip(targets, containers):
+            target["client"] = Mock()
+            target["client"].containers.list.return_value = [container] if container else []
+        return targets
+
+    @patch('geo_update.time.sleep')
+    @patch('geo_update.restart_xray', return_value=0.1)
+    @patch('geo_update.copy_files_to_container')
+    @patch('geo_update.download_file', return_value=True)
+    @patch('geo_update.need_download', return_value=True)
+    def test_fan_out(self, mock_need_download, mock_download_file, mock_copy_file, mock_restart_xray,
+                     mock_sleep, workdir):
+        """Test that files are downloaded once, pushed to every target and restarts are staggered"""
+        for geo_file in geo_update.GEO_FILES:
+            (workdir / geo_file["filename"]).write_bytes(b"dummy data")
+        mock_copy_file.side_effect = lambda container, files: [f for f, _ in files]
+        first, second = make_container(container_id="one"), make_container(container_id="two")
+
+        with patch('geo_update.targets', self.make_targets(first, second)):
+            assert geo_update.geo_update() is True
+
+        assert mock_download_file.call_count == len(geo_update.GEO_FILES)
+        assert {call.args[0] for call in mock_copy_file.call_args_list} == {first, second}
+        assert [call.args[0] for call in mock_restart_xray.call_args_list] == [first, second]
+        mock_sleep.assert_called_once_with(geo_update.RESTART_STAGGER_SECONDS)
+        assert len(list(workdir.glob("container_state.tcp_node*.json"))) == 2
+        assert geo_update.metrics.get("geo_update_target_pushes_total", target="tcp://node1:2375",
+                                      result="updated") == 1
+
+    @patch('geo_update.restart_xray', return_value=0.1)
+    @patch('geo_update.copy_files_to_container')
+    @patch('geo_update.need_download', return_value=False)
+    def test_unavailable_target(self, mock_need_download, mock_copy_file, mock_restart_xray, workdir):
+        """Test that a missing container fails only its own target"""
+        for geo_file in geo_update.GEO_FILES:
+            (workdir / geo_file["filename"]).write_bytes(b"dummy data")
+        mock_copy_file.side_effect = lambda container, files: [f for f, _ in files]
+        container = make_container()
+
+        with patch('geo_update.targets', self.make_targets(None, container)), \
+                pytest.raises(RuntimeError, match="not found on tcp://node0:2375"):
+            geo_update.geo_update()
+
+        mock_copy_file.assert_called_once()
+        mock_restart_xray.assert_called_once_with(container)
+        assert geo_update.metrics.get("geo_update_target_pushes_total", target="tcp://node0:2375",
+                                      result="failed") == 1
+
+    def test_no_target_reachable(self):
+        """Test that nothing is downloaded when no target is reachable"""
+        with patch('geo_update.targets', self.make_targets(None)), patch('geo_update.fetch_geo_file') as mock_fetch, \
+                pytest.raises(RuntimeError):
+            geo_update.geo_update()
+        mock_fetch.assert_not_called()
+
+
+class TestSharedDelivery:
+    """Tests for delivery through a volume shared with the 3x-ui container"""
+
+    def write_files(self, workdir, content=b"dummy data"):
+        files = []
+        for geo_file in geo_update.GEO_FILES:
+            local_file = workdir / geo_file["filename"]
+            local_file.write_bytes(content)
+            files.append(local_file)
+        return files
+
+    def test_publish_versions(self, workdir):
+        """Test that versions are published by hard link and the current symlink is switched"""
+        files = self.write_files(workdir)
+        assert geo_update.publish_shared(files) == files
+        current = workdir / "shared" / "current"
+        first_version = os.readlink(current)
+        assert (current / "geoip.dat").stat().st_ino == files[0].stat().st_ino
+        assert geo_update.publish_shared(files) == []
+
+        # geoip.dat changed, geosite.dat failed to download and is carried over
+        files[0].unlink()
+        files[0].write_bytes(b"new data")
+        assert geo_update.publish_shared([files[0]]) == [files[0]]
+        assert os.readlink(current) != first_version
+        assert (current / "geoip.dat").read_bytes() == b"new data"
+        assert (current / "geosite.dat").read_bytes() == b"dummy data"
+        assert (workdir / "shared" / first_version / "geoip.dat").read_bytes() == b"dummy data"
+
+        for i in range(3):
+            files[0].unlink()
+            files[0].write_bytes(b"version %d" % i)
+            geo_update.publish_shared([files[0]])
+        assert len(list((workdir / "shared" / "versions").iterdir())) == geo_update.SHARED_KEEP_VERSIONS
+
+    def test_publish_without_missing_files(self, workdir):
+        """Test that a source that was never downloaded does not block publishing the others"""
+        files = self.write_files(workdir)
+        files[1].unlink()
+        published = [f for f in files if f != files[1]]
+        assert geo_update.publish_shared(files) == published
+        current = workdir / "shared" / "current"
+        assert set(geo_update.read_shared_version(current)) == {f.name for f in published}
+
+        # the missing file is carried over once it was published
+        files[1].write_bytes(b"dummy data")
+        geo_update.publish_shared(files)
+        files[1].unlink()
+        files[0].unlink()
+        files[0].write_bytes(b"new data")
+        assert geo_update.publish_shared(files) == [files[0]]
+        assert (current / files[1].name).read_bytes() == b"dummy data"
+
+    @patch('geo_update.restart_xray')
+    def test_no_links_before_first_download(self, mock_restart_xray, workdir):
+        """Test that a container started before anything is published keeps its own files"""
+        container = make_container()
+        mock_docker_client = Mock()
+        mock_docker_client.containers.list.return_value = [container]
+        geo_update.docker_client = mock_docker_client
+
+        with patch('geo_update.GEO_DELIVERY', "shared"):
+            assert geo_update.geo_update(push_only=True) is False
+
+        container.exec_run.assert_not_called()
+        mock_restart_xray.assert_not_called()
+        assert geo_update.read_json(geo_update.container_state_path(), {}) == {}
+
+    @patch('geo_update.restart_xray', return_value=0.1)
+    @patch('geo_update.need_download', return_value=False)
+    def test_shared_cycle(self, mock_need_download, mock_restart_xray, workdir):
+        """Test that the container is linked once per instance and nothing is copied through Docker"""
+        self.write_files(workdir)
+        container = make_container()
+        mock_docker_client = Mock()
+        mock_docker_client.containers.list.return_value = [container]
+        geo_update.docker_client = mock_docker_client
+
+        with patch('geo_update.GEO_DELIVERY', "shared"):
+            assert geo_update.geo_update() is True
+            assert geo_update.geo_update() is False
+
+        container.put_archive.assert_not_called()
+        container.exec_run.assert_called_once()
+        script = container.exec_run.call_args.args[0][2]
+        assert "ln -sfn /app/geo-shared/current/geoip.dat /app/bin/geoip.dat" in script
+        mock_restart_xray.assert_called_once_with(container)
+
+
+class TestProfiling:
+    """Tests for GEO_PROFILE cycle profiling"""
+
+    @staticmethod
+    def busy_worker(n):
+        return sum(i * i for i in range(n))
+
+    def run_profiled_cycle(self):
+        with geo_update.profile_cycle():
+            with geo_update.ThreadPoolExecutor(max_workers=2) as pool:
+                data = [bytearray(1024) for _ in range(100)]
+                list(pool.map(self.busy_worker, [20000, 20000]))
+        return data
+
+    def test_disabled_by_default(self, workdir):
+        """Test that nothing is profiled or written without GEO_PROFILE"""
+        self.run_profiled_cycle()
+        assert not (workdir / geo_update.PROFILE_DIRNAME).exists()
+
+    @patch('geo_update.GEO_PROFILE', True)
+    def test_profile_and_allocations_are_saved(self, workdir):
+        """Test that a cycle leaves a pstats profile with worker threads, an allocation report and a summary"""
+        import pstats
+        with patch.object(geo_update.log, 'info') as mock_info:
+            self.run_profiled_cycle()
+        directory = workdir / geo_update.PROFILE_DIRNAME
+        [profile] = directory.glob("*.prof")
+        [allocations] = directory.glob("*.alloc.txt")
+        # worker threads are profiled too
+        functions = {func[2] for func in pstats.Stats(str(profile)).stats}
+        assert "busy_worker" in functions
+        assert allocations.read_text().startswith("peak traced memory")
+        summary = "\n".join(call.args[0] for call in mock_info.call_args_list)
+        assert "calls" in summary and str(profile) in summary
+        assert sys.getprofile() is None
+
+    @patch('geo_update.GEO_PROFILE', True)
+    @patch('geo_update.PROFILE_KEEP', 2)
+    def test_rotation(self, workdir):
+        """Test that only the last PROFILE_KEEP profiles are kept"""
+        for _ in range(3):
+            self.run_profiled_cycle()
+        directory = workdir / geo_update.PROFILE_DIRNAME
+        assert len(list(directory.glob("*.prof"))) == 2
+        assert len(list(directory.glob("*.alloc.txt"))) == 2
+
+    @patch('geo_update.GEO_PROFILE', True)
+    def test_failed_cycle_is_profiled(self, workdir):
+        """Test that a cycle that raises is profiled too"""
+        with pytest.raises(RuntimeError):
+            with geo_update.profile_cycle():
+                raise RuntimeError("boom")
+        assert len(list((workdir / geo_update.PROFILE_DIRNAME).glob("*.prof"))) == 1
+
+
+class TestMetrics:
+    """Tests for metrics of the update cycle"""
+
+    @patch('geo_update.restart_xray', return_value=0.5)
+    @patch('geo_update.download_file', return_value=True)
+    @patch('geo_update.need_download', return_value=True)
+    def test_cycle_metrics_written(self, mock_need_download, mock_download_file, mock_restart_xray,
+                                   workdir, tmp_path):
+        """Test that a cycle records phases, cache lookups, pushed bytes and success times"""
+        metrics_dir = tmp_path / "metrics"
+        metrics_dir.mkdir()
+        for geo_file in geo_update.GEO_FILES:
+            (workdir / geo_file["filename"]).write_bytes(b"dummy data")
+        mock_container = make_container()
+        mock_container.put_archive.side_effect = consume_archive
+        mock_docker_client = Mock()
+        mock_docker_client.containers.list.return_value = [mock_container]
+        geo_update.docker_client = mock_docker_client
+
+        assert geo_update.geo_update() is True
+        assert geo_update.geo_update() is False
+
+        m = geo_update.metrics
+        assert m.get("geo_update_cycles_total", result="updated") == 1
+        assert m.get("geo_update_cycles_total", result="unchanged") == 1
+        assert m.get("geo_update_cache_total", cache="container", result="miss") == 1
+        assert m.get("geo_update_cache_total", cache="container", result="hit") == 1
+        assert m.get("geo_update_phase_seconds", "_count", phase="push") == 1
+        assert m.get("geo_update_phase_seconds", "_count", phase="xray_restart") == 1
+        assert m.get("geo_update_pushed_bytes_total") > 4 * len(b"dummy data")
+
+        text = (metrics_dir / geo_update.METRICS_FILENAME).read_text()
+        assert "# TYPE geo_update_phase_seconds summary" in text
+        assert 'geo_update_source_last_success_timestamp_seconds{file="geoip.dat"}' in text
+        assert "geo_update_last_success_timestamp_seconds " in text
+
+    @patch('geo_update.get_xray_container', side_effect=RuntimeError("Container '3x-ui' not found"))
+    def test_failed_cycle_metrics(self, mock_get_xray_container, tmp_path):
+        """Test that a failed cycle is counted and metrics are still written"""
+        (tmp_path / "metrics").mkdir()
+        with pytest.raises(RuntimeError):
+            geo_update.geo_update()
+        text = (tmp_path / "metrics" / geo_update.METRICS_FILENAME).read_text()
+        assert 'geo_update_cycles_total{result="failed"} 1' in text
+        assert "geo_update_last_success_timestamp_seconds" not in text
+
+    @patch('geo_update.http_get')
+    def test_download_metrics(self, mock_get, workdir):
+        """Test that a conditional GET answered with 304 counts as an http cache hit"""
+        local_file = workdir / "geoip.dat"
+        local_file.write_bytes(b"old")
+        geo_update.update_meta_cache("geoip.dat", {"https://example.com/geoip.dat": {
+            "etag": '"abc"', "size": 3, "sha256": geo_update.get_local_sha256(local_file)}})
+        mock_get.return_value = Mock(status_code=304)
+
+        assert geo_update.download_file("https://example.com/geoip.dat", local_file) is False
+        assert mock_get.call_args.kwargs["headers"]["If-None-Match"] == '"abc"'
+        assert geo_update.metrics.get("geo_update_cache_total", cache="http", result="hit") == 1
+        assert geo_update.metrics.get("geo_update_phase_seconds", "_count", phase="check") == 1
+        assert geo_update.metrics.get("geo_update_downloaded_bytes_total", file="geoip.dat") == 0
+
+
+class TestOnce:
+    """Tests for the --once mode and its cache check without docker SDK"""
+
+    def cached_state(self, instance="abc@2024-01-01T00:00:00Z"):
+        for geo_file in geo_update.GEO_FILES:
+            geo_update.record_source_attempt(geo_file["filename"], ok=True)
+        geo_update.write_json(geo_update.container_state_path(), {"instance": instance, "files": {}})
+
+    def test_local_docker_socket(self):
+        """Test that only unix socket docker hosts can be inspected without the docker SDK"""
+        assert geo_update.local_docker_socket("unix:///run/docker.sock") == "/run/docker.sock"
+        assert geo_update.local_docker_socket("ssh://root@node2") is None
+        with patch.dict(os.environ, {"DOCKER_HOST": ""}):
+            assert geo_update.local_docker_socket(None) == "/var/run/docker.sock"
+
+    def test_peek_container_instance_over_unix_socket(self, tmp_path):
+        """Test that the instance is read with two inspect calls like the docker SDK does"""
+        paths = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                paths.append(self.path)
+                if self.path.startswith("/containers/json"):
+                    body = [{"Id": "abc"}]
+                else:
+                    body = {"Id": "abc", "State": {"StartedAt": "2024-01-01T00:00:00Z"}}
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+            def address_string(self):
+                return "unix"
+
+        socket_path = str(tmp_path / "docker.sock")
+        server = socketserver.UnixStreamServer(socket_path, Handler)
+        threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+        try:
+            target = {"name": None, "docker_host": f"unix://{socket_path}", "container_name": "3x-ui"}
+            assert geo_update.peek_container_instance(target) == "abc@2024-01-01T00:00:00Z"
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert "3x-ui" in unquote(paths[0])
+        assert paths[1] == "/containers/abc/json"
+
+    @patch('geo_update.peek_container_instance', return_value="abc@2024-01-01T00:00:00Z")
+    def test_cycle_is_cached(self, mock_peek):
+        """Test that a run with nothing due and the same container instance is cached"""
+        assert not geo_update.cycle_is_cached()  # every source is due on the first run
+        self.cached_state()
+        assert geo_update.cycle_is_cached()
+
+    @patch('geo_update.peek_container_instance', return_value="abc@2024-02-02T00:00:00Z")
+    def test_restarted_container_is_not_cached(self, mock_peek):
+        """Test that a recreated or restarted container gets the files again"""
+        self.cached_state()
+        assert not geo_update.cycle_is_cached()
+
+    @patch('geo_update.peek_container_instance', side_effect=OSError("no socket"))
+    def test_uninspectable_container_is_not_cached(self, mock_peek):
+        """Test that a container that cannot be inspected is not assumed up-to-date"""
+        self.cached_state()
+        assert not geo_update.cycle_is_cached()
+
+    @patch('geo_update.peek_container_instance', return_value="abc@2024-01-01T00:00:00Z")
+    @patch('geo_update.docker.from_env')
+    @patch('sys.argv', ['geo_update.py', '--once'])
+    def test_cached_run_creates_no_client(self, mock_from_env, mock_peek):
+        """Test that a cached run exits unchanged without creating a docker client"""
+        self.cached_state()
+        assert geo_update.once_main() == geo_update.EXIT_UNCHANGED
+        mock_from_env.assert_not_called()
+        assert geo_update.metrics.get("geo_update_cycles_total", result="unchanged") == 1
+
+    @pytest.mark.parametrize("updated, code", [(True, geo_update.EXIT_UPDATED), (False, geo_update.EXIT_UNCHANGED)])
+    @patch('geo_update.docker.from_env')
+    @patch('sys.argv', ['geo_update.py', '--once'])
+    def test_exit_code_of_cycle(self, mock_from_env, updated, code):
+        """Test that the exit code tells an updated cycle from an unchanged one"""
+        with patch('geo_update.geo_update', return_value=updated) as mock_geo_update:
+            assert geo_update.once_main() == code
+        mock_geo_update.assert_called_once_with()
+        mock_from_env.assert_called_once()
+
+    @patch('geo_update.peek_container_instance', return_value="abc@2024-01-01T00:00:00Z")
+    @patch('geo_update.time.sleep')
+    @patch('sys.argv', ['geo_update.py', '--delay', '--once'])
+    def test_entrypoint_delay_is_ignored(self, mock_sleep, mock_peek):
+        """Test that --once from `docker compose run` does not sleep the --delay of the entrypoint"""
+        self.cached_state()
+        assert geo_update.once_main() == geo_update.EXIT_UNCHANGED
+        mock_sleep.assert_not_called()
+
+    @patch('geo_update.docker.from_env', side_effect=Exception("Docker connection error"))
+    @patch('sys.argv', ['geo_update.py', '--once'])
+    def test_failed_run(self, mock_from_env):
+        """Test that a failing cycle exits with EXIT_FAILED"""
+        assert geo_update.once_main() == geo_update.EXIT_FAILED
+
+
 class TestMain:
     """Tests for main function"""
     
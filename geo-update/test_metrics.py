@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from metrics import Metrics
+
+FAMILIES = {
+    "app_requests_total": ("counter", "Requests"),
+    "app_phase_seconds": ("summary", "Phase durations"),
+    "app_last_success_timestamp_seconds": ("gauge", "Last success"),
+}
+
+
+def test_render():
+    """Test text exposition of counters, gauges and summaries"""
+    m = Metrics(FAMILIES)
+    m.inc("app_requests_total", result="hit")
+    m.inc("app_requests_total", 2, result="hit")
+    m.set("app_last_success_timestamp_seconds", 1700000000.5)
+    m.observe("app_phase_seconds", 0.25, phase="push")
+    m.observe("app_phase_seconds", 0.5, phase="push")
+
+    assert m.render() == (
+        '# HELP app_requests_total Requests\n'
+        '# TYPE app_requests_total counter\n'
+        'app_requests_total{result="hit"} 3\n'
+        '# HELP app_phase_seconds Phase durations\n'
+        '# TYPE app_phase_seconds summary\n'
+        'app_phase_seconds_count{phase="push"} 2\n'
+        'app_phase_seconds_sum{phase="push"} 0.75\n'
+        '# HELP app_last_success_timestamp_seconds Last success\n'
+        '# TYPE app_last_success_timestamp_seconds gauge\n'
+        'app_last_success_timestamp_seconds 1700000000.5\n'
+    )
+
+
+def test_label_escaping_and_unknown_metric():
+    """Test that label values are escaped and undeclared metrics are rejected"""
+    m = Metrics(FAMILIES)
+    m.inc("app_requests_total", result='a"b\\c\nd')
+    assert 'app_requests_total{result="a\\"b\\\\c\\nd"} 1' in m.render()
+    with pytest.raises(KeyError):
+        m.inc("app_unknown_total")
+
+
+def test_timer_and_write(tmp_path):
+    """Test that a failing block is still timed and the file is replaced atomically"""
+    m = Metrics(FAMILIES)
+    with pytest.raises(RuntimeError):
+        with m.timer("app_phase_seconds", phase="check"):
+            raise RuntimeError("failed")
+    assert m.get("app_phase_seconds", "_count", phase="check") == 1
+
+    path = tmp_path / "app.prom"
+    m.write(path)
+    assert path.read_text() == m.render()
+    assert list(tmp_path.iterdir()) == [path]
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Build the subscription file served by nginx at $SUBSCRIPTION_URL from the 3x-ui database.
+
+The file is rewritten only when its content changes, so nginx keeps the same
+Last-Modified/ETag and polling clients get 304. Precompressed .gz (and .br when
+the brotli module is installed) siblings are written next to it for gzip_static.
+"""
+
+import os
+import sys
+import json
+import time
+import gzip
+import signal
+import hashlib
+import logging
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from urllib.parse import quote, urlencode
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Configuration
+XUI_DB = Path("/etc/x-ui/x-ui.db")        # 3x-ui database, mounted read-only
+OUTPUT_DIR = Path("/subscription")         # srv/nginx/www/subscription on the host
+OUTPUT_FILENAME = "ss.txt"                 # served by nginx, see ssl_server.conf.template
+EXTRA_FILENAME = "extra.txt"               # hand-written links of other servers, appended as is
+# Address put into the links, the panel host name or IP address of this server
+SUB_HOST = os.environ.get('SUB_HOST') or os.environ.get('VPS_DOMAIN', '')
+CHECK_INTERVAL = int(os.environ.get('SUB_CHECK_INTERVAL', 60))  # seconds between database checks
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 11
+
+_env_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+numeric_level = getattr(logging, _env_level, logging.DEBUG)  # debug if invalid
+logging.basicConfig(level=numeric_level, format='%(levelname)s: %(message)s')
+log = logging.getLogger(__name__)
+
+
+def load_inbounds():
+    """Read enabled inbounds from the 3x-ui database as dicts with parsed settings"""
+    with closing(sqlite3.connect(f"file:{XUI_DB}?mode=ro", uri=True)) as db:
+        rows = db.execute("SELECT remark, port, protocol, settings, stream_settings FROM inbounds "
+                          "WHERE enable = 1 ORDER BY id").fetchall()
+    inbounds = []
+    for remark, port, protocol, settings, stream_settings in rows:
+        try:
+            inbounds.append({"remark": remark or "", "port": port, "protocol": protocol,
+                             "settings": json.loads(settings or "{}"),
+                             "stream": json.loads(stream_settings or "{}")})
+        except ValueError as e:
+            log.warning(f"Skip inbound {remark} on port {port} with broken settings: {e}")
+    return inbounds
+
+
+def client_enabled(client, now_ms):
+    """Disabled and expired clients are not put into the subscription"""
+    if not client.get("enable", True):
+        return False
+    expiry = client.get("expiryTime") or 0
+    return expiry <= 0 or expiry > now_ms
+
+
+def stream_params(stream):
+    """Query parameters of a vless:// link for the transport and security of an inbound"""
+    network = stream.get("network", "tcp")
+    security = stream.get("security", "none")
+    params = {"type": network, "security": security}
+    if network == "ws":
+        ws = stream.get("wsSettings", {})
+        params["path"] = ws.get("path", "/")
+        if host := ws.get("host") or ws.get("headers", {}).get("Host"):
+            params["host"] = host
+    elif network == "grpc":
+        params["serviceName"] = stream.get("grpcSettings", {}).get("serviceName", "")
+    elif network in ("httpupgrade", "xhttp"):
+        section = stream.get(f"{network}Settings", {})
+        params["path"] = section.get("path", "/")
+        if host := section.get("host"):
+            params["host"] = host
+
+    if security == "reality":
+        reality = stream.get("realitySettings", {})
+        settings = reality.get("settings", {})
+        params["pbk"] = settings.get("publicKey", "")
+        params["fp"] = settings.get("fingerprint") or "chrome"
+        params["sni"] = (reality.get("serverNames") or [""])[0]
+        params["sid"] = (reality.get("shortIds") or [""])[0]
+        if spider_x := settings.get("spiderX"):
+            params["spx"] = spider_x
+    elif security == "tls":
+        tls = stream.get("tlsSettings", {})
+        params["sni"] = tls.get("serverName") or SUB_HOST
+        if fingerprint := tls.get("settings", {}).get("fingerprint"):
+            params["fp"] = fingerprint
+        if alpn := tls.get("alpn"):
+            params["alpn"] = ",".join(alpn)
+    return params
+
+
+def build_links(inbounds, host, now_ms=None):
+    """Return vless:// links of all enabled clients, other protocols are skipped"""
+    now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+    links = []
+    for inbound in inbounds:
+        if inbound["protocol"] != "vless":
+            log.debug(f"Skip {inbound['protocol']} inbound {inbound['remark']}, only vless is supported")
+            continue
+        params = stream_params(inbound["stream"])
+        for client in inbound["settings"].get("clients", []):
+            if not client_enabled(client, now_ms):
+                continue
+            query = {"encryption": inbound["settings"].get("decryption", "none"), **params}
+            if flow := client.get("flow"):
+                query["flow"] = flow
+            name = "-".join(part for part in (inbound["remark"], client.get("email", "")) if part)
+            links.append(f"vless://{client['id']}@{host}:{inbound['port']}?"
+                         f"{urlencode(query, quote_via=quote, safe='/,')}#{quote(name)}")
+    return links
+
+
+def read_extra():
+    """Links maintained by hand (other servers), empty lines and # comments are dropped"""
+    try:
+        text = (OUTPUT_DIR / EXTRA_FILENAME).read_text()
+    except FileNotFoundError:
+        return []
+    return [line.strip() for line in text.splitlines() if line.strip() and not line.lstrip().startswith("#")]
+
+
+def build_subscription():
+    """Content of the subscription file as bytes"""
+    lines = build_links(load_inbounds(), SUB_HOST) + read_extra()
+    return "".join(line + "\n" for line in lines).encode()
+
+
+def write_atomic(path, data, mtime):
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    os.utime(tmp_path, (mtime, mtime))
+    os.replace(tmp_path, path)
+
+
+def compressed_variants(data):
+    """{suffix: bytes} of precompressed copies; gzip mtime is 0 so the same content gives the same .gz"""
+    variants = {".gz": gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)}
+    if brotli is not None:
+        variants[".br"] = brotli.compress(data, quality=BROTLI_QUALITY)
+    return variants
+
+
+def publish(data):
+    """Write the subscription and its compressed siblings unless the content is unchanged.
+    Siblings get the mtime of the plain file. Return True if anything was written."""
+    path = OUTPUT_DIR / OUTPUT_FILENAME
+    try:
+        unchanged = hashlib.sha256(path.read_bytes()).digest() == hashlib.sha256(data).digest()
+    except FileNotFoundError:
+        unchanged = False
+    suffixes = [".gz", ".br"] if brotli is not None else [".gz"]
+    if unchanged and all(path.with_name(path.name + suffix).exists() for suffix in suffixes):
+        return False
+
+    mtime = path.stat().st_mtime if unchanged else time.time()
+    variants = compressed_variants(data)
+    # the plain file goes last, its new mtime marks a complete update
+    for suffix, content in variants.items():
+        write_atomic(path.with_name(path.name + suffix), content, mtime)
+    if not unchanged:
+        write_atomic(path, data, mtime)
+    links = data.count(b"\n")
+    log.info(f"Subscription {path} updated: {links} links, {len(data)} bytes, "
+             + ", ".join(f"{suffix} {len(variants[suffix])} bytes" for suffix in variants))
+    return True
+
+
+def sources_signature():
+    """mtime and size of the database (with its WAL) and extra.txt, to skip rebuilding when nothing changed"""
+    signature = []
+    for path in (XUI_DB, XUI_DB.with_name(XUI_DB.name + "-wal"), OUTPUT_DIR / EXTRA_FILENAME):
+        try:
+            stat = path.stat()
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return signature
+
+
+def main():
+    """Rebuild the subscription whenever the 3x-ui database or extra.txt changes"""
+    log.info(f"Subscription generator START, links for {SUB_HOST}")
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    if not SUB_HOST:
+        raise ValueError("Set SUB_HOST or VPS_DOMAIN")
+    if brotli is None:
+        log.info("brotli module is not installed, only .gz is written")
+    last_signature = None
+    while True:
+        signature = sources_signature()
+        if signature != last_signature:
+            try:
+                publish(build_subscription())
+                last_signature = signature
+            except (OSError, sqlite3.Error) as e:
+                log.error(f"Cannot build subscription: {e}")
+        time.sleep(CHECK_INTERVAL)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
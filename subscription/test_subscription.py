@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import gzip
+import json
+import sqlite3
+import pytest
+from contextlib import closing
+from unittest.mock import patch
+from urllib.parse import urlsplit, parse_qs, unquote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import subscription
+
+
+REALITY_STREAM = {
+    "network": "tcp",
+    "security": "reality",
+    "realitySettings": {
+        "serverNames": ["www.example.org"],
+        "shortIds": ["ab12"],
+        "settings": {"publicKey": "PUBKEY", "fingerprint": "firefox", "spiderX": "/"},
+    },
+}
+
+
+def make_db(path, inbounds):
+    """Create a minimal 3x-ui database with the given (remark, port, protocol, settings, stream, enable) rows"""
+    with closing(sqlite3.connect(path)) as db:
+        db.execute("CREATE TABLE inbounds (id INTEGER PRIMARY KEY, remark TEXT, port INTEGER, protocol TEXT, "
+                   "settings TEXT, stream_settings TEXT, enable INTEGER)")
+        db.executemany("INSERT INTO inbounds (remark, port, protocol, settings, stream_settings, enable) "
+                       "VALUES (?, ?, ?, ?, ?, ?)",
+                       [(remark, port, protocol, json.dumps(settings), json.dumps(stream), enable)
+                        for remark, port, protocol, settings, stream, enable in inbounds])
+        db.commit()
+
+
+@pytest.fixture(autouse=True)
+def paths(tmp_path):
+    """Keep the database and the output inside tmp_path"""
+    out = tmp_path / "subscription"
+    out.mkdir()
+    with patch('subscription.XUI_DB', tmp_path / "x-ui.db"), patch('subscription.OUTPUT_DIR', out), \
+            patch('subscription.SUB_HOST', "vps.example.com"):
+        yield tmp_path
+
+
+class TestBuildLinks:
+
+    def test_reality_link(self):
+        inbounds = [{"remark": "main", "port": 443, "protocol": "vless", "stream": REALITY_STREAM,
+                     "settings": {"decryption": "none",
+                                  "clients": [{"id": "uuid-1", "email": "alice", "flow": "xtls-rprx-vision"}]}}]
+        [link] = subscription.build_links(inbounds, "vps.example.com")
+        url = urlsplit(link)
+        assert url.scheme == "vless"
+        assert url.netloc == "uuid-1@vps.example.com:443"
+        assert unquote(url.fragment) == "main-alice"
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        assert query == {"encryption": "none", "type": "tcp", "security": "reality", "pbk": "PUBKEY",
+                         "fp": "firefox", "sni": "www.example.org", "sid": "ab12", "spx": "/",
+                         "flow": "xtls-rprx-vision"}
+
+    def test_ws_tls_link(self):
+        stream = {"network": "ws", "security": "tls", "wsSettings": {"path": "/vless", "headers": {"Host": "cdn.example"}},
+                  "tlsSettings": {"serverName": "vps.example.com", "alpn": ["h2", "http/1.1"]}}
+        inbounds = [{"remark": "ws", "port": 8443, "protocol": "vless", "stream": stream,
+                     "settings": {"clients": [{"id": "uuid-2", "email": "bob"}]}}]
+        [link] = subscription.build_links(inbounds, "vps.example.com")
+        query = {key: value[0] for key, value in parse_qs(urlsplit(link).query).items()}
+        assert query["path"] == "/vless"
+        assert query["host"] == "cdn.example"
+        assert query["alpn"] == "h2,http/1.1"
+        assert "flow" not in query
+
+    def test_skips_disabled_expired_and_other_protocols(self):
+        clients = [{"id": "on", "email": "a"}, {"id": "off", "email": "b", "enable": False},
+                   {"id": "old", "email": "c", "expiryTime": 1000}, {"id": "future", "email": "d", "expiryTime": 5000}]
+        inbounds = [{"remark": "r", "port": 1, "protocol": "vless", "stream": {}, "settings": {"clients": clients}},
+                    {"remark": "t", "port": 2, "protocol": "trojan", "stream": {},
+                     "settings": {"clients": [{"password": "x"}]}}]
+        links = subscription.build_links(inbounds, "h", now_ms=2000)
+        assert [urlsplit(link).username for link in links] == ["on", "future"]
+
+
+class TestPublish:
+
+    def test_writes_file_and_gzip(self, paths):
+        assert subscription.publish(b"vless://a\n")
+        out = paths / "subscription"
+        assert (out / "ss.txt").read_bytes() == b"vless://a\n"
+        assert gzip.decompress((out / "ss.txt.gz").read_bytes()) == b"vless://a\n"
+        assert (out / "ss.txt.gz").stat().st_mtime == (out / "ss.txt").stat().st_mtime
+
+    def test_unchanged_content_keeps_mtime(self, paths):
+        path = paths / "subscription" / "ss.txt"
+        subscription.publish(b"vless://a\n")
+        os.utime(path, (1000, 1000))
+        assert not subscription.publish(b"vless://a\n")
+        assert path.stat().st_mtime == 1000
+
+    def test_missing_gzip_is_restored_with_same_mtime(self, paths):
+        path = paths / "subscription" / "ss.txt"
+        subscription.publish(b"vless://a\n")
+        os.utime(path, (1000, 1000))
+        (paths / "subscription" / "ss.txt.gz").unlink()
+        assert subscription.publish(b"vless://a\n")
+        assert path.stat().st_mtime == 1000
+        assert (paths / "subscription" / "ss.txt.gz").stat().st_mtime == 1000
+
+    def test_changed_content_is_rewritten(self, paths):
+        subscription.publish(b"vless://a\n")
+        assert subscription.publish(b"vless://b\n")
+        assert gzip.decompress((paths / "subscription" / "ss.txt.gz").read_bytes()) == b"vless://b\n"
+
+    def test_gzip_is_deterministic(self):
+        assert subscription.compressed_variants(b"x" * 100) == subscription.compressed_variants(b"x" * 100)
+
+
+class TestBuildSubscription:
+
+    def test_database_links_and_extra(self, paths):
+        make_db(paths / "x-ui.db", [
+            ("main", 443, "vless", {"clients": [{"id": "uuid-1", "email": "alice"}]}, REALITY_STREAM, 1),
+            ("off", 444, "vless", {"clients": [{"id": "uuid-2", "email": "bob"}]}, REALITY_STREAM, 0),
+        ])
+        (paths / "subscription" / "extra.txt").write_text("# other servers\n\nvless://other@donor.com:443#Cool\n")
+        lines = subscription.build_subscription().decode().splitlines()
+        assert len(lines) == 2
+        assert lines[0].startswith("vless://uuid-1@vps.example.com:443?")
+        assert lines[1] == "vless://other@donor.com:443#Cool"
+
+    def test_signature_changes_with_extra(self, paths):
+        before = subscription.sources_signature()
+        (paths / "subscription" / "extra.txt").write_text("vless://x\n")
+        assert subscription.sources_signature() != before